@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of `GraphQLClient` against a local Apollo protocol server: query
+latency and throughput, subscription throughput by payload size and number
+of subscriptions, subscriptions consumed in batches, memory growth over a
+long subscription, the time to recover from a lost connection, the threads
+and throughput of many connections with and without a reactor, and
+subscription throughput with worker processes.
+
+Run them from the root of the repository, saving the results and comparing
+them with an earlier run:
+
+    python -m benchmarks run --save --compare benchmarks/results/baseline.json
+    python -m benchmarks compare old.json new.json
+
+Both exit with status 1 when a metric got worse by more than `--threshold`.
+"""
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+python -m benchmarks run [--quick] [--only CASE ...] [--save [PATH]] [--compare BASELINE]
+python -m benchmarks compare BASELINE CURRENT
+"""
+
+import argparse
+import logging
+import sys
+
+from .cases import CASES
+from .results import (
+    compare_runs,
+    default_path,
+    format_comparison,
+    format_results,
+    load_run,
+    make_run,
+    save_run,
+)
+from .server import BenchmarkServer
+
+
+def run(args):
+    # the reconnect benchmark loses the connection on purpose
+    logging.getLogger('graphql_client').setLevel(logging.ERROR)
+    results = {}
+    with BenchmarkServer(args.port) as server:
+        for name in args.only or CASES:
+            print(f'running {name}...', file=sys.stderr)
+            results.update(CASES[name](server, args.quick, codec=args.codec))
+    current = make_run(results, quick=args.quick, codec=args.codec)
+    print(format_results(results))
+
+    if args.save is not None:
+        path = args.save or default_path(current)
+        save_run(current, path)
+        print(f'saved to {path}', file=sys.stderr)
+    if args.compare:
+        return compare(load_run(args.compare), current, args.threshold)
+    return 0
+
+
+def compare(baseline, current, threshold):
+    rows = compare_runs(baseline, current, threshold)
+    print(format_comparison(rows))
+    regressions = sum(1 for row in rows if row[-1])
+    if regressions:
+        print(f'{regressions} metric(s) regressed by more than {threshold:.0%}', file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='benchmarks of the GraphQL client')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--quick', action='store_true',
+                            help='fewer iterations, for a smoke test')
+    run_parser.add_argument('--only', nargs='+', choices=list(CASES), metavar='CASE',
+                            help=f'run only these cases, of: {", ".join(CASES)}')
+    run_parser.add_argument('--codec', help='the codec of the client (default: the fastest)')
+    run_parser.add_argument('--port', type=int, default=9101, help='port of the local server')
+    run_parser.add_argument('--save', nargs='?', const='', metavar='PATH',
+                            help='save the results, by default in benchmarks/results/')
+    run_parser.add_argument('--compare', metavar='BASELINE',
+                            help='compare the results with a saved run')
+    run_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='the change (a fraction) reported as a regression')
+
+    compare_parser = commands.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='the change (a fraction) reported as a regression')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        return run(args)
+    return compare(load_run(args.baseline), load_run(args.current), args.threshold)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+The benchmarks. Every case takes the server and whether this is a quick run,
+and returns a map of result name to its metrics. Metric names end with their
+unit; for the ones ending with `_per_s` higher is better, for the others
+lower is better.
+"""
+
+import gc
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from graphql_client import GraphQLClient, ReconnectPolicy, GQL_DATA, GQL_COMPLETE
+from graphql_client.multiproc import MultiprocessSubscriber
+from graphql_client.reactor import Reactor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+QUERY = 'query bench($size: Int) { msg(size: $size) }'
+SUBSCRIPTION = 'subscription bench($count: Int, $size: Int) { msg(count: $count, size: $size) }'
+
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _latencies(samples):
+    """ the percentiles of latencies in seconds, in milliseconds """
+    return {
+        'p50_ms': _percentile(samples, 0.5) * 1000,
+        'p90_ms': _percentile(samples, 0.9) * 1000,
+        'p99_ms': _percentile(samples, 0.99) * 1000,
+        'mean_ms': statistics.mean(samples) * 1000,
+    }
+
+
+class _Streams():
+    """ a subscription callback counting messages, and waiting for `expected` completes """
+    def __init__(self, expected=1, on_data=None):
+        self.received = 0
+        self._expected = expected
+        self._completed = 0
+        self._on_data = on_data
+        self.done = threading.Event()
+
+    def __call__(self, op_id, msg):
+        if msg['type'] == GQL_DATA:
+            self.received += 1
+            if self._on_data is not None:
+                self._on_data(self.received)
+        elif msg['type'] == GQL_COMPLETE:
+            self._completed += 1
+            if self._completed == self._expected:
+                self.done.set()
+
+
+def query_latency(server, quick, codec=None):
+    """ the latency of queries run one after the other """
+    count = 300 if quick else 3000
+    with GraphQLClient(server.url, codec=codec) as client:
+        for _ in range(count // 10):
+            client.query(QUERY)
+        samples = []
+        for _ in range(count):
+            started = time.perf_counter()
+            client.query(QUERY)
+            samples.append(time.perf_counter() - started)
+    return {'query_latency': _latencies(samples)}
+
+
+def query_throughput(server, quick, codec=None):
+    """ queries per second, run from many threads on one client """
+    count = 1000 if quick else 10000
+    results = {}
+    with GraphQLClient(server.url, codec=codec) as client:
+        client.query(QUERY)
+        for threads in (1, 4, 16):
+            per_thread = count // threads
+
+            def run():
+                for _ in range(per_thread):
+                    client.query(QUERY)
+
+            workers = [threading.Thread(target=run) for _ in range(threads)]
+            started = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+            results[f'query_throughput[threads={threads}]'] = {
+                'queries_per_s': per_thread * threads / elapsed,
+            }
+    return results
+
+
+def subscription_throughput(server, quick, codec=None):
+    """ subscription messages per second, by payload size and number of subscriptions """
+    # enough messages to measure, without streaming gigabytes of large payloads
+    max_messages = 5000 if quick else 50000
+    max_bytes = 5_000_000 if quick else 50_000_000
+    results = {}
+    with GraphQLClient(server.url, codec=codec) as client:
+        for size in (64, 1024, 16384):
+            for fanout in (1, 8):
+                count = max(1, min(max_messages, max_bytes // size) // fanout)
+                streams = _Streams(expected=fanout)
+                started = time.perf_counter()
+                for _ in range(fanout):
+                    client.subscribe(SUBSCRIPTION, variables={'count': count, 'size': size},
+                                     callback=streams)
+                streams.done.wait()
+                elapsed = time.perf_counter() - started
+                results[f'subscription_throughput[size={size},fanout={fanout}]'] = {
+                    'msgs_per_s': streams.received / elapsed,
+                }
+    return results
+
+
+def subscription_batches(server, quick, codec=None):
+    """ subscription messages per second, consumed by a callback or in batches """
+    count = 20000 if quick else 200000
+    variables = {'count': count, 'size': 64}
+    results = {}
+    with GraphQLClient(server.url, codec=codec) as client:
+        streams = _Streams()
+        started = time.perf_counter()
+        client.subscribe(SUBSCRIPTION, variables=variables, callback=streams)
+        streams.done.wait()
+        results['subscription_batches[callback]'] = {
+            'msgs_per_s': streams.received / (time.perf_counter() - started),
+        }
+
+        received = 0
+        started = time.perf_counter()
+        with client.subscribe_batches(SUBSCRIPTION, variables=variables, max_items=500,
+                                      max_wait=0.01) as batches:
+            for payloads in batches:
+                received += len(payloads)
+        results['subscription_batches[max_items=500]'] = {
+            'msgs_per_s': received / (time.perf_counter() - started),
+        }
+    return results
+
+
+def memory_growth(server, quick, codec=None):
+    """ how much the memory in use grows over a long subscription """
+    count = 20000 if quick else 200000
+    # measured from a tenth of the way in, once the client has warmed up
+    start_at = count // 10
+    usage = {}
+
+    def on_data(received):
+        if received == start_at or received == count:
+            usage[received] = tracemalloc.get_traced_memory()[0]
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with GraphQLClient(server.url, codec=codec) as client:
+            streams = _Streams(on_data=on_data)
+            client.subscribe(SUBSCRIPTION, variables={'count': count, 'size': 256},
+                             callback=streams)
+            streams.done.wait()
+    finally:
+        tracemalloc.stop()
+    return {'memory_growth': {'growth_kib': (usage[count] - usage[start_at]) / 1024}}
+
+
+def reconnect_recovery(server, quick, codec=None):
+    """ the time from losing the connection to getting subscription data again """
+    count = 10 if quick else 50
+    got_data = threading.Event()
+
+    def callback(op_id, msg):
+        if msg['type'] == GQL_DATA:
+            got_data.set()
+
+    policy = ReconnectPolicy(initial_delay=0, jitter=0, resubscribe_rate=None)
+    samples = []
+    with GraphQLClient(server.url, codec=codec, reconnect_policy=policy) as client:
+        client.subscribe(SUBSCRIPTION, variables={'count': 0}, callback=callback)
+        got_data.wait()
+        for _ in range(count):
+            got_data.clear()
+            started = time.perf_counter()
+            server.drop_clients()
+            got_data.wait()
+            samples.append(time.perf_counter() - started)
+    return {'reconnect_recovery': _latencies(samples)}
+
+
+def _context_switches():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+
+def many_connections(server, quick, codec=None):
+    """ the threads, and the cost of queries, of many connections with and without a reactor """
+    connections = 50
+    count = 2000 if quick else 20000
+    results = {}
+    for mode in ('threads', 'reactor'):
+        reactor = Reactor() if mode == 'reactor' else None
+        clients = [GraphQLClient(server.url, codec=codec, reactor=reactor)
+                   for _ in range(connections)]
+        try:
+            threads = sum(1 for thread in threading.enumerate() if thread.name.startswith('gql-'))
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                switches = _context_switches() if resource is not None else 0
+                started = time.perf_counter()
+                for _ in executor.map(lambda i: clients[i % connections].query(QUERY),
+                                      range(count)):
+                    pass
+                elapsed = time.perf_counter() - started
+                switches = _context_switches() - switches if resource is not None else 0
+        finally:
+            for client in clients:
+                client.close()
+            if reactor is not None:
+                reactor.stop()
+        metrics = {'threads': threads, 'queries_per_s': count / elapsed}
+        if resource is not None:
+            metrics['ctx_switches_per_query'] = switches / count
+        results[f'many_connections[{mode},connections={connections}]'] = metrics
+    return results
+
+
+def multiprocess_subscriptions(server, quick, codec=None):
+    """ subscription messages per second, received in this process or in worker processes """
+    fanout = 8
+    count = (20000 if quick else 200000) // fanout
+    variables = {'count': count, 'size': 1024}
+    processes = max(2, min(4, os.cpu_count() or 1))
+    results = {}
+    for mode in ('single', f'processes={processes}'):
+        streams = _Streams(expected=fanout)
+        if mode == 'single':
+            subscriber = GraphQLClient(server.url, codec=codec)
+        else:
+            subscriber = MultiprocessSubscriber(server.url, processes=processes,
+                                                client_kwargs={'codec': codec})
+        with subscriber:
+            # a subscription per worker first, so that they have started and connected
+            warm_up = _Streams(expected=processes)
+            for _ in range(processes):
+                subscriber.subscribe(SUBSCRIPTION, variables={'count': 1}, callback=warm_up)
+            warm_up.done.wait()
+            started = time.perf_counter()
+            for _ in range(fanout):
+                subscriber.subscribe(SUBSCRIPTION, variables=variables, callback=streams)
+            streams.done.wait()
+            elapsed = time.perf_counter() - started
+        results[f'multiprocess_subscriptions[{mode}]'] = {'msgs_per_s': streams.received / elapsed}
+    return results
+
+
+# all the cases, by name, in the order they run
+CASES = {
+    'query_latency': query_latency,
+    'query_throughput': query_throughput,
+    'subscription_throughput': subscription_throughput,
+    'subscription_batches': subscription_batches,
+    'memory_growth': memory_growth,
+    'reconnect_recovery': reconnect_recovery,
+    'many_connections': many_connections,
+    'multiprocess_subscriptions': multiprocess_subscriptions,
+}
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Storing the results of benchmark runs, and comparing two runs.
+"""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# changes smaller than these are noise, whatever their ratio, by metric unit
+_NOISE_FLOORS = {'kib': 64.0}
+
+
+def higher_is_better(metric: str) -> bool:
+    """ whether a bigger value of the metric is an improvement """
+    return metric.endswith('_per_s')
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_run(results: dict, **meta) -> dict:
+    """ a run: its results, and the details of the machine and code it ran on """
+    return {
+        'meta': dict(meta,
+                     date=datetime.datetime.now().isoformat(timespec='seconds'),
+                     commit=_git_commit(),
+                     python=platform.python_version(),
+                     implementation=platform.python_implementation(),
+                     platform=platform.platform()),
+        'results': results,
+    }
+
+
+def default_path(run: dict) -> str:
+    """ where to save a run by default: the results directory, by date and commit """
+    meta = run['meta']
+    name = meta['date'].replace(':', '')
+    if meta['commit']:
+        name += '-' + meta['commit']
+    return os.path.join(RESULTS_DIR, name + '.json')
+
+
+def save_run(run: dict, path: str) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as results_file:
+        json.dump(run, results_file, indent=2, sort_keys=True)
+        results_file.write('\n')
+
+
+def load_run(path: str) -> dict:
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def compare_runs(baseline: dict, current: dict, threshold: float = 0.1) -> list:
+    """
+    Compare the metrics found in both runs. Returns a row per metric, as
+    `(result, metric, baseline value, current value, relative change,
+    regressed)`, the change being positive when the metric got better. A
+    metric regressed when it got worse by more than `threshold` (a fraction
+    of the baseline value).
+    """
+    rows = []
+    for name, metrics in baseline['results'].items():
+        current_metrics = current['results'].get(name, {})
+        for metric, old in metrics.items():
+            new = current_metrics.get(metric)
+            if new is None:
+                continue
+            gain = new - old if higher_is_better(metric) else old - new
+            change = gain / abs(old) if old else 0.0
+            floor = _NOISE_FLOORS.get(metric.rsplit('_', 1)[-1], 0.0)
+            regressed = change < -threshold and abs(new - old) > floor
+            rows.append((name, metric, old, new, change, regressed))
+    return rows
+
+
+def format_results(results: dict) -> str:
+    lines = []
+    for name, metrics in results.items():
+        values = '  '.join(f'{metric}={value:.4g}' for metric, value in metrics.items())
+        lines.append(f'{name:<48} {values}')
+    return '\n'.join(lines)
+
+
+def format_comparison(rows: list) -> str:
+    lines = [f'{"result":<48} {"metric":<14} {"baseline":>10} {"current":>10} {"change":>8}']
+    for name, metric, old, new, change, regressed in rows:
+        mark = '  REGRESSION' if regressed else ''
+        lines.append(f'{name:<48} {metric:<14} {old:>10.4g} {new:>10.4g} {change:>+8.1%}{mark}')
+    return '\n'.join(lines)
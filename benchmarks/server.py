@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+An Apollo protocol server for the benchmarks, on top of the websocket server
+of the tests. Unlike the mock server of the tests it answers right away, and
+writes pre-encoded frames, so that the client is what gets measured.
+
+The variables of an operation say what it gets back:
+- a query gets one `data` message with a `msg` of `size` characters
+- a subscription gets `count` `data` messages with a `msg` of `size`
+  characters, then a `complete`. With a `count` of 0, it gets a single
+  `data` message and stays open.
+"""
+
+import json
+import logging
+import socket
+import struct
+import threading
+
+from tests.websocket_server import WebsocketServer
+
+# how many frames of a subscription are written at once
+_CHUNK_FRAMES = 256
+
+
+def _ws_frame(data: bytes) -> bytes:
+    """ an unmasked websocket text frame """
+    length = len(data)
+    if length <= 125:
+        header = struct.pack('>BB', 0x81, length)
+    elif length <= 65535:
+        header = struct.pack('>BBH', 0x81, 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x81, 127, length)
+    return header + data
+
+
+def _message(op_id, msg_type, payload=None) -> bytes:
+    message = {'id': op_id, 'type': msg_type}
+    if payload is not None:
+        message['payload'] = payload
+    return _ws_frame(json.dumps(message).encode('utf-8'))
+
+
+class BenchmarkServer():
+    """ a local Apollo protocol server, answering as fast as it can """
+    def __init__(self, port: int = 9101):
+        self.port = port
+        self.server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f'ws://localhost:{self.port}'
+
+    def start(self) -> None:
+        self.server = WebsocketServer(self.port, loglevel=logging.ERROR)
+        self.server.set_fn_message_received(self._message_received)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join(timeout=2)
+
+    def drop_clients(self) -> None:
+        """ abruptly close the connections of all the clients """
+        for client in list(self.server.clients):
+            try:
+                client['handler'].request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def _message_received(self, client, server, message):
+        sock = client['handler'].request
+        try:
+            for chunk in self._answer(json.loads(message)):
+                sock.sendall(chunk)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _answer(frame):
+        """ the chunks of frames answering a message """
+        if frame['type'] == 'connection_init':
+            yield _ws_frame(b'{"type":"connection_ack"}')
+        elif frame['type'] == 'stop':
+            yield _message(frame['id'], 'complete')
+        elif frame['type'] == 'start':
+            op_id = frame['id']
+            variables = frame['payload'].get('variables') or {}
+            data = _message(op_id, 'data', {'data': {'msg': 'x' * variables.get('size', 16)}})
+            if not frame['payload']['query'].lstrip().startswith('subscription'):
+                yield data + _message(op_id, 'complete')
+                return
+            count = variables.get('count', 1)
+            if count == 0:
+                yield data
+                return
+            for sent in range(0, count, _CHUNK_FRAMES):
+                yield data * min(_CHUNK_FRAMES, count - sent)
+            yield _message(op_id, 'complete')
@@ -7,14 +7,87 @@ https://github.com/apollographql/subscriptions-transport-ws/blob/master/PROTOCOL
 """
 
 import json
+import selectors
+import socket
+import ssl
 import threading
 import uuid
 import queue
+import re
+import time
 import logging
-from typing import Callable
+import functools
+import importlib
+import itertools
+import collections
+from concurrent.futures import CancelledError, Executor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Union
 
 import websocket
 
+from .buffer import (
+    OperationBuffer,
+    OVERFLOW_BLOCK,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DROP_NEWEST,
+    OVERFLOW_LATEST,
+)
+from .dispatch import CallbackDispatcher
+from .codec import get_codec, JSONCodec, LazyPayload
+from . import metrics as gql_metrics
+from .reconnect import ReconnectPolicy
+from .http_transport import HTTPTransport, HTTPTransportException, HTTPTransportTimeout
+from .batch import Batcher
+from .cache import QueryCache, is_mutation
+from .store import EntityStore
+from .prepared import PreparedOperation, GraphQLSyntaxError
+from .reactor import Reactor
+from .persisted import (
+    persisted_query_error,
+    persisted_query_extension,
+    query_hash,
+    PERSISTED_QUERY_NOT_SUPPORTED,
+)
+
+# the asyncio client is left out, so that `import *` doesn't need `websockets`
+__all__ = [
+    'GraphQLClient',
+    'GraphQLClientPool',
+    'MultiprocessSubscriber',
+    'QueryHandle',
+    'SubscriptionBatches',
+    'ConnectionException',
+    'InvalidPayloadException',
+    'QueryTimeoutException',
+    'SubscriptionException',
+    'GraphQLSyntaxError',
+    'PreparedOperation',
+    'QueryCache',
+    'EntityStore',
+    'ReconnectPolicy',
+    'Reactor',
+    'HTTPTransport',
+    'HTTPTransportException',
+    'HTTPTransportTimeout',
+    'counter_op_ids',
+    'uuid_op_id',
+    'OVERFLOW_BLOCK',
+    'OVERFLOW_DROP_OLDEST',
+    'OVERFLOW_DROP_NEWEST',
+    'OVERFLOW_LATEST',
+    'GQL_WS_SUBPROTOCOL',
+    'GQL_CONNECTION_INIT',
+    'GQL_START',
+    'GQL_STOP',
+    'GQL_CONNECTION_TERMINATE',
+    'GQL_CONNECTION_ERROR',
+    'GQL_CONNECTION_ACK',
+    'GQL_DATA',
+    'GQL_ERROR',
+    'GQL_COMPLETE',
+    'GQL_CONNECTION_KEEP_ALIVE',
+]
 
 GQL_WS_SUBPROTOCOL = "graphql-ws"
 
@@ -40,15 +113,188 @@ class ConnectionException(Exception):
 class InvalidPayloadException(Exception):
     """Exception thrown if payload recived from server is mal-formed or cannot be parsed """
 
+class QueryTimeoutException(ConnectionException):
+    """Exception thrown when a query gets no result within its timeout"""
+
+class SubscriptionException(Exception):
+    """Exception thrown when the server ends a subscription with an `error` message"""
+    def __init__(self, payload):
+        self.payload = payload
+        super().__init__(payload)
+
+_OPERATION_NAME_RE = re.compile(r'^\s*(?:query|mutation|subscription)\s+([_A-Za-z][_0-9A-Za-z]*)')
+
+
+@functools.lru_cache(maxsize=256)
+def _operation_name(query):
+    """ the name of the operation in a query document, '' if it is anonymous """
+    match = _OPERATION_NAME_RE.match(query)
+    return match.group(1) if match else ''
+
+
+def _payload_operation_name(payload):
+    """ the name of the operation a payload runs, '' if it is anonymous """
+    return payload.get('operationName') or _operation_name(payload.get('query') or '')
+
+
+def _materialize(msg):
+    """ decode the payload of a message, if it was decoded lazily """
+    payload = msg.get('payload')
+    if isinstance(payload, LazyPayload):
+        msg['payload'] = payload.decode()
+    return msg
+
+
+def counter_op_ids() -> Callable[[], str]:
+    """
+    The default operation ids: a counter, '1', '2' and so on. Ids only need
+    to be unique on a connection, and these are cheap to make, to send, and
+    to look up for every message received.
+    """
+    counter = itertools.count(1)
+    return lambda: str(next(counter))
+
+
+def uuid_op_id() -> str:
+    """ a random operation id (a UUIDv4), unique across connections """
+    return uuid.uuid4().hex
+
+
+def _sent_operation_name(prepared):
+    """
+    the name of the operation to run in the document of a prepared operation,
+    None if the document has only one, or for a plain query string
+    """
+    if prepared is None:
+        return None
+    return prepared.payload().get('operationName')
+
+
+def _is_mutation(query, prepared=None):
+    if prepared is not None:
+        return prepared.operation_type == 'mutation'
+    return is_mutation(query)
+
+
+def _is_cacheable(res):
+    """ whether a query result can be cached: data without errors """
+    return res['type'] == GQL_DATA and not res.get('payload', {}).get('errors')
+
+
 class GraphQLClient():
     """
     A simple GraphQL client that works over Websocket as the transport
     protocol, instead of HTTP.
     This follows the Apollo protocol.
     https://github.com/apollographql/subscriptions-transport-ws/blob/master/PROTOCOL.md
+
+    Parameters:
+    url (str): the websocket url of the GraphQL server. Can be None if
+    `http_url` is given, for a client which only runs queries and mutations.
+    subscription_buffer_size (int): default number of messages buffered per
+    subscription, see `subscribe`. 0 keeps no buffer for subscriptions which
+    have a callback.
+    subscription_overflow (str): default policy when a subscription buffer is
+    full; one of `OVERFLOW_BLOCK`, `OVERFLOW_DROP_OLDEST`,
+    `OVERFLOW_DROP_NEWEST` or `OVERFLOW_LATEST`
+    callback_executor (Executor or int): (optional) run the subscription
+    callbacks on this `concurrent.futures.Executor`, or on a pool of these many
+    worker threads, instead of the thread receiving from the server. The
+    callbacks of one subscription still run one at a time, in order.
+    codec (str or JSONCodec): (optional) how frames are encoded and decoded;
+    one of 'json', 'orjson', 'msgspec', 'ujson' or a codec instance. Defaults
+    to the fastest one installed.
+    lazy_payloads (bool): (optional) decode only the `id` and `type` of the
+    subscription frames upfront. The `payload` passed to callbacks is a
+    `LazyPayload`, decoded when it is first read; its `raw` attribute has the
+    payload as received. Skipping the payload needs the `msgspec` codec, other
+    codecs still decode it upfront.
+    metrics (MetricsSink): (optional) where to report latencies, frame and
+    byte counts, callback times, buffer depths and reconnects. See
+    `graphql_client.metrics`.
+    reconnect_policy (ReconnectPolicy): (optional) how to reconnect when the
+    connection is lost. Defaults to `ReconnectPolicy()`, exponential backoff
+    with jitter which never gives up.
+    share_subscriptions (bool): (optional) run identical subscriptions (same
+    query, variables and headers) as a single operation on the server, and
+    fan out its messages to every local subscriber. A subscriber joining a
+    running subscription first gets its latest `data` message.
+    http_url (str, list or HTTPTransport): (optional) run queries and
+    mutations as HTTP `POST`s to this url (or these urls, round-robin) over
+    kept-alive connections, instead of over the websocket. Subscriptions
+    still use the websocket. See `graphql_client.http_transport`.
+    batch_window (float): (optional) batch the queries made within these many
+    seconds of each other: over HTTP they are sent as one array-batched
+    request (the server has to support batching), over the websocket their
+    `start` messages are sent with a single write. None disables batching.
+    batch_size (int): the most queries in a batch; a full batch is sent right
+    away, without waiting for the rest of the `batch_window`
+    cache (QueryCache): (optional) cache the results of queries (never of
+    mutations), see `graphql_client.cache`. It is available as `client.cache`,
+    for invalidating results.
+    store (EntityStore): (optional) keep the entities of query results and
+    subscription messages normalized, and answer repeated queries from them,
+    see `graphql_client.store`. It is available as `client.store`.
+    persisted_queries (bool): (optional) send queries and mutations as
+    automatic persisted queries, see `graphql_client.persisted`. The document
+    of a query is sent along with its hash the first time; once the server
+    has accepted it, only the hash is sent, and the document again only if
+    the server answers `PersistedQueryNotFound`.
+    op_id_factory (function): (optional) returns the id of every new
+    operation, which must be unique on the connection. Defaults to a counter
+    for each client, see `counter_op_ids`; `uuid_op_id` makes random ids.
+    query_timeout (float): (optional) default seconds to wait for the result
+    of a query, see `query`. None waits forever.
+    reactor (Reactor): (optional) read the connection on this reactor's
+    thread, shared with other clients, instead of on a receiver thread of
+    its own. See `graphql_client.reactor`.
     """
-    def __init__(self, url):
+    def __init__(self, url, subscription_buffer_size: int = 0,
+                 subscription_overflow: str = OVERFLOW_DROP_OLDEST,
+                 callback_executor: Union[Executor, int] = None,
+                 codec: Union[str, JSONCodec] = None, lazy_payloads: bool = False,
+                 metrics: gql_metrics.MetricsSink = None,
+                 reconnect_policy: ReconnectPolicy = None,
+                 share_subscriptions: bool = False,
+                 http_url: Union[str, list, HTTPTransport] = None,
+                 batch_window: float = None, batch_size: int = 32,
+                 cache: QueryCache = None, store: EntityStore = None,
+                 persisted_queries: bool = False,
+                 op_id_factory: Callable[[], str] = None,
+                 query_timeout: float = None, reactor: Reactor = None):
+        if url is None and http_url is None:
+            raise ValueError('either the argument `url` or `http_url` is needed')
         self.ws_url = url
+        # ids stay unique across reconnects, since subscriptions keep theirs
+        self._new_op_id = op_id_factory or counter_op_ids()
+        self._connection = None
+        self._recevier_thread = None
+        self._reactor = reactor
+        self._channel = reactor.channel(self) if reactor is not None else None
+        self._share_subscriptions = share_subscriptions
+        # map of subscription key to the id of the server operation serving it
+        self._shared = {}
+        # map of server operation id to its local subscribers and latest data
+        self._fanouts = {}
+        # map of local subscriber id to the id of its server operation
+        self._handles = {}
+        self._fanout_lock = threading.Lock()
+        self._reconnect_policy = reconnect_policy or ReconnectPolicy()
+        self.metrics = metrics if metrics is not None else gql_metrics.MetricsSink()
+        self._metrics_enabled = self.metrics.enabled
+        # map of operation id to [start time, operation name, got first data]
+        self._op_timings = {}
+        self._codec = get_codec(codec)
+        self._lazy_payloads = lazy_payloads
+        self._decode = self._codec.decode_envelope if lazy_payloads else self._codec.decode
+        self._subscription_buffer_size = subscription_buffer_size
+        self._subscription_overflow = subscription_overflow
+        self._owns_executor = isinstance(callback_executor, int)
+        if self._owns_executor:
+            callback_executor = ThreadPoolExecutor(max_workers=callback_executor,
+                                                   thread_name_prefix='gql-callback')
+        self._callback_executor = callback_executor
+        self._dispatcher = CallbackDispatcher(callback_executor) if callback_executor else None
         self._connection_init_done = False
         # cache of the headers for a session
         self._headers = None
@@ -58,118 +304,476 @@ class GraphQLClient():
         self._queue = queue.Queue()
         # map of queues for each subscriber
         self._subscriber_queues = {}
-        self._shutdown_receiver = False
-        self._subscriptions = []
+        # queries which got their result, but whose `complete` is yet to arrive
+        self._draining = set()
+        self._draining_lock = threading.Lock()
+        # websocket-client's send is not safe to call from many threads at once
+        self._send_lock = threading.Lock()
+        # serializes `connection_init`, so that threads don't steal each other's ack
+        self._init_lock = threading.Lock()
+        self._shutdown_receiver = threading.Event()
+        # the number of queries waiting for their result over the websocket,
+        # which `close` lets finish
+        self._queries_in_flight = 0
+        self._in_flight_changed = threading.Condition()
+        # map of operation id to the details of the live subscriptions, to
+        # restart them after a reconnect
+        self._subscriptions = {}
+        # ids of the subscriptions waiting to be restarted after a reconnect
+        self._pending_resubscribes = collections.deque()
+        self._resubscribe_limiter = None
+        # cheap running counters, see `counters`
+        self._frames_received = 0
+        self._bytes_received = 0
+        self._frames_sent = 0
+        self._bytes_sent = 0
+        self._invalid_frames = 0
+        self._unrouted_frames = 0
+        self._reconnects = 0
+        self._owns_http = http_url is not None and not isinstance(http_url, HTTPTransport)
+        self._http = HTTPTransport(http_url, codec=self._codec) if self._owns_http else http_url
+        self.cache = cache
+        self.store = store
+        self._persisted_queries = persisted_queries
+        # hashes of the documents the server has accepted as persisted queries
+        self._persisted_hashes = set()
+        self._query_timeout = query_timeout
+        self._batcher = None
+        if batch_window is not None:
+            flush = self._post_batch if self._http is not None else self._start_many
+            self._batcher = Batcher(flush, batch_window, batch_size)
         self.connect()
 
     def connect(self) -> None:
         """
         Initializes a connection with the server.
         """
-        self._connection = websocket.create_connection(self.ws_url,
-                                                       subprotocols=[GQL_WS_SUBPROTOCOL])
-        # start the reciever thread
-        self._recevier_thread = threading.Thread(target=self._receiver_task)
+        if self.ws_url is None:
+            return
+        self._open_connection()
+        self._connection.settimeout(None)
+        self._shutdown_receiver.clear()
+        if self._channel is not None:
+            self._channel.attach()
+            return
+        # start the reciever thread; a daemon, since `close` doesn't wait for
+        # it past its timeout
+        self._recevier_thread = threading.Thread(target=self._receiver_task, name='gql-receiver',
+                                                 daemon=True)
         self._recevier_thread.start()
 
+    def _open_connection(self):
+        self._connection = websocket.create_connection(
+            self.ws_url,
+            subprotocols=[GQL_WS_SUBPROTOCOL],
+            timeout=self._reconnect_policy.connect_timeout)
+
+    @property
+    def is_connected(self) -> bool:
+        """ whether the connection is open and the client is receiving from it """
+        if self._connection is None:
+            return False
+        if self._channel is not None:
+            return self._channel.attached and bool(self._connection.connected) \
+                and self._reactor.is_running
+        return bool(self._connection.connected) and self._recevier_thread.is_alive()
+
     def _reconnect(self):
-        subscriptions = self._subscriptions
-        self.__init__(self.ws_url)
+        """
+        Reconnect after the connection was lost, waiting between the attempts
+        as per the reconnect policy. This runs on the receiver thread; returns
+        False if it gave up, or the client was closed meanwhile.
+        """
+        self._connection_lost()
+        policy = self._reconnect_policy
+        attempt = 0
+        while policy.should_retry(attempt):
+            if self._shutdown_receiver.wait(policy.delay(attempt)):
+                return False
+            try:
+                self._reopen()
+            except (OSError, websocket.WebSocketException, ConnectionException) as exc:
+                attempt += 1
+                logger.warning('Reconnect attempt %d to %s failed: %s', attempt, self.ws_url, exc)
+                continue
+            if self._shutdown_receiver.is_set():
+                # the client was closed while connecting
+                self._connection.close()
+                return False
+            self._reconnected()
+            return True
+
+        if attempt:
+            logger.error('Giving up reconnecting to %s after %d attempts', self.ws_url, attempt)
+        return False
+
+    def _connection_lost(self):
+        """ fail what was waiting on the lost connection """
+        if self._reconnect_policy.should_retry(0):
+            logger.warning('Lost the connection to %s, reconnecting', self.ws_url)
+        else:
+            logger.info('Lost the connection to %s', self.ws_url)
+        err = ConnectionException('Lost the connection to the server')
+        self._connection_init_done = False
+        # wake up a `connection_init` waiting for an ack which will never come
+        self._queue.put(err)
+        self._fail_queries(err)
+
+    def _reopen(self):
+        """ open a new connection and `connection_init` it, blocking until it is done """
+        with self._init_lock:
+            with self._queue.mutex:
+                self._queue.queue.clear()
+            self._open_connection()
+            self._handshake(self._headers)
+            self._connection.settimeout(None)
+
+    def _reconnected(self):
+        logger.info('Reconnected to %s', self.ws_url)
+        self._reconnects += 1
+        self.metrics.increment(gql_metrics.RECONNECTS)
+        self._pending_resubscribes = collections.deque(list(self._subscriptions))
+        self._resubscribe_limiter = self._reconnect_policy.rate_limiter()
+
+    def _handshake(self, headers):
+        """
+        `connection_init` on a fresh connection, reading the ack right here;
+        only for the receiver thread, which owns the reads.
+        """
+        self._send({'type': GQL_CONNECTION_INIT, 'payload': {'headers': headers}})
+        while True:
+            opcode, res = self._connection.recv_data()
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                raise ConnectionException('Connection closed by the server')
+            msg = self._codec.decode(res)
+            if msg.get('type') == GQL_CONNECTION_ACK:
+                self._connection_init_done = True
+                return
+            if msg.get('type') == GQL_CONNECTION_ERROR:
+                raise ConnectionException(msg.get('payload', 'unknown error'))
 
-        for subscription in subscriptions:
-            self.subscribe(query=subscription['query'],
-                           variables=subscription['variables'],
-                           headers=subscription['headers'],
-                           callback=subscription['callback'])
+    def _resubscribe_some(self):
+        """
+        restart as many of the pending subscriptions as the rate limit allows,
+        with their original operation ids, in a single write. Returns the
+        seconds until the rest can be restarted, or None if none are left.
+        """
+        limiter = self._resubscribe_limiter
+        frames = []
+        for _ in range(limiter.take(len(self._pending_resubscribes))):
+            op_id = self._pending_resubscribes.popleft()
+            subscription = self._subscriptions.get(op_id)
+            # it may have been stopped meanwhile
+            if subscription is not None:
+                frames.append({'id': op_id, 'type': GQL_START, 'payload': subscription['payload']})
+        if frames:
+            self._send_batch(frames)
+        if self._pending_resubscribes:
+            return max(limiter.wait_time(), 0.001)
+        return None
+
+    def _fail_queries(self, err):
+        """ fail the in-flight queries; subscriptions are restarted on reconnect """
+        subscription_ids = set(self._subscriptions) | set(self._handles)
+        with self._draining_lock:
+            for op_id in list(self._draining):
+                self._remove_operation_queue(op_id)
+            self._draining.clear()
+        for op_id, op_queue in list(self._subscriber_queues.items()):
+            if op_id not in subscription_ids:
+                op_queue.fail(err)
+                self._remove_operation_queue(op_id)
+                self._op_timings.pop(op_id, None)
+
+    def debug_snapshot(self) -> dict:
+        """
+        A snapshot of the internal state of the client, for debugging: the
+        frame counters, and the state of every live operation. This walks all
+        the operations, so don't call it on a hot path.
+        """
+        operations = {}
+        for op_id in set(self._subscriber_queues) | set(self._subscriber_callbacks):
+            op_queue = self._subscriber_queues.get(op_id)
+            operations[op_id] = {
+                'buffered': op_queue.qsize() if op_queue is not None else None,
+                'dropped': op_queue.dropped if op_queue is not None else 0,
+                'has_callback': op_id in self._subscriber_callbacks,
+                'draining': op_id in self._draining,
+            }
+        return {
+            'connected': self.is_connected,
+            'counters': self.counters,
+            'global_queue': list(self._queue.queue),
+            'pending_callbacks': self._dispatcher.pending() if self._dispatcher else 0,
+            'operations': operations,
+        }
 
-    def __dump_queues(self):
-        logger.debug('[GQL_CLIENT] => Dump of all the internal queues')
-        logger.debug('[GQL_CLIENT] => Global queue => \n %s', self._queue.queue)
-        dumps = list(map(lambda q: (q[0], q[1].queue), self._subscriber_queues.items()))
-        logger.debug('[GQL_CLIENT] => Operation queues: \n %s', dumps)
+    @property
+    def counters(self) -> dict:
+        """ running totals of the frames and bytes sent and received, and of reconnects """
+        return {
+            'frames_received': self._frames_received,
+            'bytes_received': self._bytes_received,
+            'frames_sent': self._frames_sent,
+            'bytes_sent': self._bytes_sent,
+            'invalid_frames': self._invalid_frames,
+            'unrouted_frames': self._unrouted_frames,
+            'reconnects': self._reconnects,
+        }
 
     # wait for any valid message, while ignoring GQL_CONNECTION_KEEP_ALIVE
     def _receiver_task(self):
         """the recieve function of the client. Which validates response from the
-        server and queues data """
-        reconnected = False
-        while not self._shutdown_receiver and not reconnected:
-            self.__dump_queues()
+        server and queues data. If the connection is lost, it reconnects. """
+        while not self._shutdown_receiver.is_set():
             try:
-                res = self._connection.recv()
-            except websocket._exceptions.WebSocketConnectionClosedException as e:
-                self._reconnect()
-                reconnected = True
+                if self._pending_resubscribes:
+                    # come back for the rest, even if the server sends nothing meanwhile
+                    self._connection.settimeout(self._resubscribe_some())
+                # raw bytes, so that the codec can decode without an intermediate `str`
+                opcode, res = self._connection.recv_data()
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    raise websocket._exceptions.WebSocketConnectionClosedException(
+                        'Connection closed by the server')
+            except websocket._exceptions.WebSocketTimeoutException:
                 continue
+            except (websocket.WebSocketException, OSError):
+                # lost while reading, or while restarting the subscriptions
+                if self._shutdown_receiver.is_set() or not self._reconnect():
+                    break
+                continue
+
+            self._handle_frame(res)
+
+    def _handle_frame(self, res):
+        """ decode a frame received from the server, and route it to its operation """
+        self._frames_received += 1
+        self._bytes_received += len(res)
+        if self._metrics_enabled:
+            self.metrics.increment(gql_metrics.FRAMES_RECEIVED)
+            self.metrics.increment(gql_metrics.BYTES_RECEIVED, len(res))
+
+        try:
+            msg = self._decode(res)
+        except self._codec.DecodeError as err:
+            self._invalid_frames += 1
+            logger.warning('Ignoring. Server sent invalid JSON data: %s \n %s', res, err)
+            return
+
+        # ignore messages which are GQL_CONNECTION_KEEP_ALIVE
+        if msg['type'] == GQL_CONNECTION_KEEP_ALIVE:
+            return
+
+        # check all GQL_DATA and GQL_COMPLETE should have 'id'.
+        # Otherwise, server is sending malformed responses, error out!
+        if msg['type'] in [GQL_DATA, GQL_COMPLETE] and 'id' not in msg:
+            # TODO: main thread can't catch this exception; setup
+            # exception queues. but this scenario will only happen with
+            # servers having glaring holes in implementing the protocol
+            # correctly, which is rare. hence this is not very urgent
+            err = f'Protocol Violation.\nExpected "id" in {msg}, but could not find.'
+            raise InvalidPayloadException(err)
+
+        # if it doesn't have an id, put in the global queue
+        if 'id' not in msg:
+            self._queue.put(_materialize(msg))
+            return
+
+        # if the message has an id, it is meant for a particular operation
+        op_id = msg['id']
+        op_queue = self._subscriber_queues.get(op_id)
+        user_fn = self._subscriber_callbacks.get(op_id)
+        if op_queue is None and user_fn is None:
+            self._unrouted_frames += 1
+            logger.debug('Ignoring message for unknown operation: %s', msg)
+            return
 
+        if self._metrics_enabled:
+            op_name = self._record_operation_frame(op_id, msg, op_queue)
+
+        # the server ended the subscription, don't restart it after a reconnect
+        if msg['type'] in [GQL_COMPLETE, GQL_ERROR]:
+            self._subscriptions.pop(op_id, None)
+        elif self.store is not None and msg['type'] == GQL_DATA and op_id in self._subscriptions:
+            self._merge_subscription_data(msg)
+
+        # put it in the correct operation/subscriber queue
+        if op_queue is not None:
+            op_queue.put(msg)
+            if op_id in self._draining:
+                self._drain(op_id)
+
+        # if a callback fn exists with the id, call it
+        if user_fn is not None:
+            if self._metrics_enabled:
+                user_fn = functools.partial(self._timed_callback, user_fn, op_name)
+            if self._dispatcher:
+                self._dispatcher.dispatch(op_id, user_fn, op_id, msg)
+            else:
+                user_fn(op_id, msg)
+
+    def _merge_subscription_data(self, msg):
+        payload = msg.get('payload')
+        if isinstance(payload, LazyPayload):
+            payload = payload.decode()
+        if payload and payload.get('data'):
+            self.store.merge(payload['data'])
+
+    def _record_operation_frame(self, op_id, msg, op_queue):
+        """ record the metrics of an operation's frame, returns the operation name """
+        timing = self._op_timings.get(op_id)
+        name = ''
+        if timing is not None:
+            started, name, got_data = timing
+            if msg['type'] == GQL_DATA and not got_data:
+                timing[2] = True
+                self.metrics.observe(gql_metrics.FIRST_DATA_SECONDS,
+                                     time.monotonic() - started, operation=name)
+            elif msg['type'] in [GQL_COMPLETE, GQL_ERROR]:
+                self._op_timings.pop(op_id, None)
+                self.metrics.observe(gql_metrics.COMPLETE_SECONDS,
+                                     time.monotonic() - started, operation=name)
+        # only subscription buffers are bounded
+        if op_queue is not None and op_queue.maxsize:
+            self.metrics.gauge(gql_metrics.BUFFER_DEPTH, op_queue.qsize() + 1, operation=name)
+        return name
+
+    def _timed_callback(self, user_fn, op_name, op_id, msg):
+        started = time.monotonic()
+        try:
+            user_fn(op_id, msg)
+        finally:
+            self.metrics.observe(gql_metrics.CALLBACK_SECONDS, time.monotonic() - started,
+                                 operation=op_name)
+
+    def _drain(self, op_id):
+        """ handle the trailing messages of a query which has already returned """
+        with self._draining_lock:
+            op_queue = self._subscriber_queues.get(op_id)
+            while op_queue is not None:
+                try:
+                    msg = op_queue.get_nowait()
+                except queue.Empty:
+                    return
+                if msg['type'] in [GQL_COMPLETE, GQL_ERROR]:
+                    self._draining.discard(op_id)
+                    self._remove_operation_queue(op_id)
+                    return
+                if msg['type'] == GQL_DATA:
+                    # the server is streaming more results than the caller asked
+                    # for, ask it to stop; it will answer with a `complete`
+                    logger.warning('Received more data for a finished query, stopping it: %s', msg)
+                    self._stop(op_id)
+
+    def _ws_frame(self, data, opcode=websocket.ABNF.OPCODE_TEXT):
+        """ a websocket frame carrying `data`, masked as the connection does """
+        ws_frame = websocket.ABNF.create_frame(data, opcode)
+        if self._connection.get_mask_key:
+            ws_frame.get_mask_key = self._connection.get_mask_key
+        return ws_frame.format()
+
+    def _write(self, data):
+        """
+        write to the socket, with the send lock held. A reactor makes the
+        socket non-blocking while it reads it, so then this waits for room to
+        write in the socket buffer.
+        """
+        sock = self._connection.sock
+        if sock is None:
+            raise websocket.WebSocketConnectionClosedException('socket is already closed.')
+        if sock.gettimeout() != 0:
+            sock.sendall(data)
+            return
+        view = memoryview(data)
+        while view:
             try:
-                msg = json.loads(res)
-            except json.JSONDecodeError as err:
-                logger.warning('Ignoring. Server sent invalid JSON data: %s \n %s', res, err)
-                continue
+                view = view[sock.send(view):]
+            except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                with selectors.DefaultSelector() as selector:
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    selector.select()
 
-            # ignore messages which are GQL_CONNECTION_KEEP_ALIVE
-            if msg['type'] != GQL_CONNECTION_KEEP_ALIVE:
-
-                # check all GQL_DATA and GQL_COMPLETE should have 'id'.
-                # Otherwise, server is sending malformed responses, error out!
-                if msg['type'] in [GQL_DATA, GQL_COMPLETE] and 'id' not in msg:
-                    # TODO: main thread can't catch this exception; setup
-                    # exception queues. but this scenario will only happen with
-                    # servers having glaring holes in implementing the protocol
-                    # correctly, which is rare. hence this is not very urgent
-                    err = f'Protocol Violation.\nExpected "id" in {msg}, but could not find.'
-                    raise InvalidPayloadException(err)
-
-                # if the message has an id, it is meant for a particular operation
-                if 'id' in msg:
-                    op_id = msg['id']
-
-                    # put it in the correct operation/subscriber queue
-                    if op_id in self._subscriber_queues:
-                        self._subscriber_queues[op_id].put(msg)
-                    else:
-                        self._subscriber_queues[op_id] = queue.Queue()
-                        self._subscriber_queues[op_id].put(msg)
-
-                    # if a callback fn exists with the id, call it
-                    if op_id in self._subscriber_callbacks:
-                        user_fn = self._subscriber_callbacks[op_id]
-                        user_fn(op_id, msg)
-
-                # if it doesn't have an id, put in the global queue
-                else:
-                    self._queue.put(msg)
+    def _send_batch(self, frames):
+        """ send many frames with a single write to the socket """
+        datas = [self._codec.encode(frame) for frame in frames]
+        chunks = [self._ws_frame(data) for data in datas]
+        sent = sum(len(data) for data in datas)
+        with self._send_lock:
+            self._write(b''.join(chunks))
+            self._frames_sent += len(frames)
+            self._bytes_sent += sent
+        if self._metrics_enabled:
+            self.metrics.increment(gql_metrics.FRAMES_SENT, len(frames))
+            self.metrics.increment(gql_metrics.BYTES_SENT, sent)
+
+    def _send(self, frame):
+        """ send a frame, or an already encoded one """
+        data = frame if isinstance(frame, bytes) else self._codec.encode(frame)
+        chunk = self._ws_frame(data)
+        with self._send_lock:
+            self._write(chunk)
+            self._frames_sent += 1
+            self._bytes_sent += len(data)
+        if self._metrics_enabled:
+            self.metrics.increment(gql_metrics.FRAMES_SENT)
+            self.metrics.increment(gql_metrics.BYTES_SENT, len(data))
+
+    def _pong(self, payload):
+        """ answer a ping of the server; the receiver thread has websocket-client do it """
+        chunk = self._ws_frame(payload, websocket.ABNF.OPCODE_PONG)
+        with self._send_lock:
+            self._write(chunk)
 
     def _insert_subscriber(self, op_id, callback_fn):
         self._subscriber_callbacks[op_id] = callback_fn
 
     def _remove_subscriber(self, op_id):
-        del self._subscriber_callbacks[op_id]
+        self._subscriber_callbacks.pop(op_id, None)
 
-    def _create_operation_queue(self, op_id):
-        self._subscriber_queues[op_id] = queue.Queue()
+    def _create_operation_queue(self, op_id, maxsize=0, overflow=OVERFLOW_BLOCK):
+        self._subscriber_queues[op_id] = OperationBuffer(maxsize, overflow)
 
     def _remove_operation_queue(self, op_id):
-        if op_id in self._subscriber_queues:
-            del self._subscriber_queues[op_id]
-
-    def _get_operation_result(self, op_id):
-        return self._subscriber_queues[op_id].get()
+        op_queue = self._subscriber_queues.pop(op_id, None)
+        if op_queue is not None:
+            # releases the receiver, if it is waiting for room in a full buffer
+            op_queue.close()
 
-    def _connection_init(self, headers=None):
+    def _connection_init(self, headers=None, timeout=None):
         # if we have already initialized and the passed headers are same as
         # prev headers, then do nothing and return
         if self._connection_init_done and headers == self._headers:
             return
 
+        # the lock is held while waiting for an ack, and while reconnecting
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._init_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise QueryTimeoutException(
+                f'Could not connection_init with the server within {timeout} seconds')
+        try:
+            # another thread may have finished the init while we were waiting
+            if self._connection_init_done and headers == self._headers:
+                return
+            self._connection_init_done = False
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            self.__send_connection_init(headers, remaining)
+        finally:
+            self._init_lock.release()
+
+    def __send_connection_init(self, headers, timeout=None):
         self._headers = headers
         # send the `connection_init` message with the payload
         payload = {'type': GQL_CONNECTION_INIT, 'payload': {'headers': headers}}
-        self._connection.send(json.dumps(payload))
+        self._send(payload)
 
-        res = self._queue.get()
+        try:
+            res = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            raise QueryTimeoutException(
+                f'No connection_ack from the server within {timeout} seconds') from None
 
+        if isinstance(res, Exception):
+            raise res
         if res['type'] == GQL_CONNECTION_ERROR:
             err = res['payload'] if 'payload' in res else 'unknown error'
             raise ConnectionException(err)
@@ -181,87 +785,579 @@ class GraphQLClient():
             "Original message: " + res['type']
         raise ConnectionException(err_msg)
 
-    def _start(self, payload, callback=None):
-        """ pass a callback function only if this is a subscription """
-        op_id = uuid.uuid4().hex
+    def _start(self, payload, callback=None, buffer_size=0, overflow=OVERFLOW_BLOCK,
+               subscription=False, prepared=None):
+        """
+        pass a callback function only if this is a subscription. A buffer for
+        the messages is kept unless this is a subscription with a callback and
+        no `buffer_size`. Subscriptions are registered to be restarted after
+        a reconnect. With a `prepared` operation (for the `payload`), its
+        pre-encoded frame is sent.
+        """
+        op_id = self._new_op_id()
         frame = {'id': op_id, 'type': GQL_START, 'payload': payload}
-        self._create_operation_queue(op_id)
+        if not callback or buffer_size:
+            self._create_operation_queue(op_id, buffer_size, overflow)
         if callback:
             self._insert_subscriber(op_id, callback)
-        self._connection.send(json.dumps(frame))
+        if subscription:
+            self._subscriptions[op_id] = {'payload': payload}
+        if self._metrics_enabled:
+            name = _payload_operation_name(payload)
+            self._op_timings[op_id] = [time.monotonic(), name, False]
+        if prepared is not None:
+            frame = prepared.start_frame(op_id, payload['variables'], payload['headers'])
+        self._send(frame)
         return op_id
 
+    def _start_many(self, payloads):
+        """ start a batch of queries with a single write, returns their operation ids """
+        frames = []
+        for payload in payloads:
+            op_id = self._new_op_id()
+            self._create_operation_queue(op_id)
+            if self._metrics_enabled:
+                name = _payload_operation_name(payload)
+                self._op_timings[op_id] = [time.monotonic(), name, False]
+            frames.append({'id': op_id, 'type': GQL_START, 'payload': payload})
+        self._send_batch(frames)
+        return [frame['id'] for frame in frames]
+
     def _stop(self, op_id):
         payload = {'id': op_id, 'type': GQL_STOP}
-        self._connection.send(json.dumps(payload))
+        self._send(payload)
+
+    def prepare(self, query: str, operation_name: str = None) -> PreparedOperation:
+        """
+        Prepare an operation to be run many times with `query` or `subscribe`:
+        its syntax is checked (raising `GraphQLSyntaxError`), and the parts of
+        the messages which never change are encoded once. `operation_name`
+        picks the operation to run, in a document with many.
+        """
+        return PreparedOperation(query, self._codec, operation_name)
 
-    def query(self, query: str, variables: dict = None, headers: dict = None) -> dict:
+    def query(self, query: Union[str, PreparedOperation], variables: dict = None,
+              headers: dict = None, use_cache: bool = True, timeout: float = None) -> dict:
         """
         Run a GraphQL query or mutation. The `query` argument is a GraphQL query
-        string. You can pass optional variables and headers.
+        string, or an operation made by `prepare`. You can pass optional
+        variables and headers.
+
+        If there is no result within `timeout` seconds (the `query_timeout` of
+        the client by default), the query is stopped on the server and
+        `QueryTimeoutException` is raised. See `start_query` to cancel queries.
 
         PS: To run a subscription, see the `subscribe` method.
+
+        This is safe to call from many threads at once; all the queries are
+        multiplexed over the same connection. With an `http_url`, the query
+        is sent over HTTP instead, and `headers` are sent as HTTP headers.
+
+        If the client has a `cache` (or a `store`), query results are taken
+        from it; pass `use_cache=False` to neither read nor fill the cache,
+        and not read from the store.
         """
-        self._connection_init(headers)
-        payload = {'headers': headers, 'query': query, 'variables': variables}
-        op_id = self._start(payload)
-        res = self._get_operation_result(op_id)
-        self._stop(op_id)
-        ack = self._get_operation_result(op_id)
-        if ack['type'] != GQL_COMPLETE:
-            logger.warning('Expected to recieve complete, but received: %s', ack)
-        self._remove_operation_queue(op_id)
+        prepared = None
+        if isinstance(query, PreparedOperation):
+            prepared, query = query, query.document
+        mutation = _is_mutation(query, prepared)
+        if timeout is None:
+            timeout = self._query_timeout
+
+        if self.store is not None and use_cache and not mutation:
+            data = self.store.read_query(query, variables, headers, _sent_operation_name(prepared))
+            if data is not None:
+                return {'type': GQL_DATA, 'payload': {'data': data}}
+        if self.cache is not None and use_cache and not mutation:
+            key = self.cache.key(query, variables, headers, _sent_operation_name(prepared))
+            load = functools.partial(self._query, query, variables, headers, prepared, timeout)
+            return self.cache.get_or_load(key, load, _is_cacheable)
+        return self._query(query, variables, headers, prepared, timeout)
+
+    def start_query(self, query: Union[str, PreparedOperation], variables: dict = None,
+                    headers: dict = None, timeout: float = None) -> 'QueryHandle':
+        """
+        Start a query or mutation over the websocket, without waiting for its
+        result: returns a `QueryHandle`, to wait for the result or to cancel
+        the query. Unlike `query`, this never goes through the cache, the
+        store, persisted queries or HTTP.
+        """
+        if self.ws_url is None:
+            raise ConnectionException('start_query needs the websocket `url` of the server')
+        prepared = None
+        if isinstance(query, PreparedOperation):
+            prepared = query
+            payload = prepared.payload(variables, headers)
+        else:
+            payload = {'headers': headers, 'query': query, 'variables': variables}
+        if timeout is None:
+            timeout = self._query_timeout
+        return self._start_query(payload, prepared, timeout)
+
+    def _query(self, query, variables, headers, prepared=None, timeout=None):
+        if self._persisted_queries:
+            res = self._persisted_query(query, variables, headers, prepared, timeout)
+        else:
+            res = self._send_query(query, variables, headers, prepared=prepared, timeout=timeout)
+        if self.store is not None and _is_cacheable(res) and res['payload'].get('data'):
+            if _is_mutation(query, prepared):
+                self.store.merge(res['payload']['data'])
+            else:
+                self.store.write_query(query, variables, headers, res['payload']['data'],
+                                       _sent_operation_name(prepared))
         return res
 
-    def subscribe(self, query: str, variables: dict = None, headers: dict = None,
-                  callback: Callable[[str, dict], None] = None) -> str:
+    def _persisted_query(self, query, variables, headers, prepared=None, timeout=None):
+        """ run a query as an automatic persisted query """
+        send = functools.partial(self._send_query, query, variables, headers, prepared=prepared,
+                                 timeout=timeout)
+        extensions = persisted_query_extension(query)
+        digest = query_hash(query)
+        if digest in self._persisted_hashes:
+            res = send(extensions, send_document=False)
+            error = persisted_query_error(res.get('payload'))
+            if error is None:
+                return res
+            # the server has forgotten it (say, it restarted)
+            self._persisted_hashes.discard(digest)
+            if error == PERSISTED_QUERY_NOT_SUPPORTED:
+                logger.warning('The server does not support persisted queries anymore')
+                self._persisted_queries = False
+                return send()
+
+        res = send(extensions)
+        error = persisted_query_error(res.get('payload'))
+        if error is None:
+            self._persisted_hashes.add(digest)
+        elif error == PERSISTED_QUERY_NOT_SUPPORTED:
+            logger.warning('The server does not support persisted queries, sending documents')
+            self._persisted_queries = False
+            res = send()
+        return res
+
+    def _send_query(self, query, variables, headers, extensions=None, send_document=True,
+                    prepared=None, timeout=None):
+        """
+        run a query over HTTP or the websocket. A `prepared` operation's
+        pre-encoded message is sent, unless the message is altered for a
+        persisted query, or goes into a batch.
+        """
+        if prepared is not None:
+            # carries the `operationName`, if the document needs one
+            payload = prepared.payload(variables, headers)
+            if extensions or self._batcher is not None:
+                prepared = None
+        else:
+            payload = {'headers': headers, 'query': query, 'variables': variables}
+        if not send_document:
+            del payload['query']
+        if extensions:
+            payload['extensions'] = extensions
+        if self._http is not None:
+            return self._http_query(payload, prepared, timeout)
+        return self._start_query(payload, prepared, timeout).result()
+
+    def _start_query(self, payload, prepared=None, timeout=None):
+        """ start a query over the websocket, returns its `QueryHandle` """
+        if self._shutdown_receiver.is_set():
+            raise ConnectionException('The client is closed')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._in_flight_changed:
+            self._queries_in_flight += 1
+        try:
+            self._connection_init(payload['headers'], timeout)
+            if self._batcher is not None:
+                op_id = self._batcher.submit(payload).result()
+            else:
+                op_id = self._start(payload, prepared=prepared)
+            op_queue = self._subscriber_queues.get(op_id)
+            if op_queue is None:
+                # failed already, by a lost connection
+                raise ConnectionException('Lost the connection to the server')
+        except BaseException:
+            self._query_done()
+            raise
+        return QueryHandle(self, op_id, op_queue, timeout, deadline)
+
+    def _query_done(self):
+        """ a query is not in flight anymore """
+        with self._in_flight_changed:
+            self._queries_in_flight -= 1
+            self._in_flight_changed.notify_all()
+
+    def _abandon_query(self, op_id):
+        """ stop a query whose result nobody waits for anymore, and forget it """
+        self._remove_operation_queue(op_id)
+        self._op_timings.pop(op_id, None)
+        try:
+            self._stop(op_id)
+        except (OSError, websocket.WebSocketException):
+            # the connection is gone, and the operation with it
+            pass
+
+    def _http_query(self, payload, prepared=None, timeout=None):
+        """ run a query over HTTP; the response is shaped like a `data` message """
+        started = time.monotonic()
+        # the headers go in the HTTP request instead
+        payload = dict(payload)
+        headers = payload.pop('headers')
+        try:
+            if self._batcher is not None:
+                # the caller opening the batch sends it, within this future's
+                # `result`, so the deadline has to go along with the query
+                deadline = None if timeout is None else started + timeout
+                res = self._batcher.submit((payload, headers, deadline)).result(timeout)
+            elif prepared is not None:
+                res = self._http.post(prepared.http_body(payload['variables']), headers, timeout)
+            else:
+                res = self._http.post(payload, headers, timeout)
+        except (HTTPTransportTimeout, FutureTimeoutError) as exc:
+            raise QueryTimeoutException(f'No result within {timeout} seconds') from exc
+        except HTTPTransportException as exc:
+            raise ConnectionException(str(exc)) from exc
+        if self._metrics_enabled:
+            self.metrics.observe(gql_metrics.COMPLETE_SECONDS, time.monotonic() - started,
+                                 operation=_payload_operation_name(payload))
+        return {'type': GQL_DATA, 'payload': res}
+
+    def _post_batch(self, items):
+        """
+        send a batch of `(payload, headers, deadline)` over HTTP, one request
+        per distinct headers, each within the earliest deadline of its queries
+        """
+        groups = {}
+        for i, (_, headers, _) in enumerate(items):
+            key = json.dumps(headers, sort_keys=True, default=str)
+            groups.setdefault(key, (headers, []))[1].append(i)
+        results = [None] * len(items)
+        for headers, indexes in groups.values():
+            payloads = [items[i][0] for i in indexes]
+            deadlines = [items[i][2] for i in indexes if items[i][2] is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            try:
+                if len(payloads) == 1:
+                    responses = [self._http.post(payloads[0], headers, timeout)]
+                else:
+                    responses = self._http.post_batch(payloads, headers, timeout)
+            except HTTPTransportException as exc:
+                responses = [exc] * len(indexes)
+            for i, res in zip(indexes, responses):
+                results[i] = res
+        return results
+
+    def _finish_query(self, op_id, res):
+        # the server sends a `complete` on its own after the result of a query,
+        # so there is no need to wait for it (or to send a `stop`). If it has
+        # already arrived, we are done, otherwise the receiver discards it.
+        if res['type'] in [GQL_COMPLETE, GQL_ERROR]:
+            self._remove_operation_queue(op_id)
+            return
+        with self._draining_lock:
+            self._draining.add(op_id)
+        self._drain(op_id)
+
+    def subscribe(self, query: Union[str, PreparedOperation], variables: dict = None,
+                  headers: dict = None,
+                  callback: Callable[[str, dict], None] = None,
+                  buffer_size: int = None, overflow: str = None) -> str:
         """
         Run a GraphQL subscription.
 
         Parameters:
-        query (str): the GraphQL query string
-        callback (function): a callback function. This is mandatory.
+        query (str or PreparedOperation): the GraphQL query string, or an
+        operation made by `prepare`
+        callback (function): a callback function. This is mandatory, unless
+        the subscription has a buffer.
         This callback function is called, everytime there is new data from the
         subscription.
         variables (dict): (optional) GraphQL variables
         headers (dict): (optional) a dictionary of headers for the session
+        buffer_size (int): (optional) keep up to these many messages in a
+        buffer, to be consumed with `receive`. With 0, no buffer is kept and
+        the messages only go to the callback. Defaults to the
+        `subscription_buffer_size` of the client.
+        overflow (str): (optional) what to do when the buffer is full. Defaults
+        to the `subscription_overflow` of the client.
 
         Returns:
-        op_id (str): The operation id (a UUIDv4) for this subscription operation
+        op_id (str): The operation id for this subscription operation
         """
+        if buffer_size is None:
+            buffer_size = self._subscription_buffer_size
+        if overflow is None:
+            overflow = self._subscription_overflow
 
         # sanity check that the user passed a valid function
-        if not callback or not callable(callback):
-            raise TypeError('the argument `callback` is mandatory and it should be a function')
+        if callback is not None and not callable(callback):
+            raise TypeError('the argument `callback` should be a function')
+        if callback is None and not buffer_size:
+            raise TypeError('the argument `callback` is mandatory for a subscription '
+                            'without a buffer, and it should be a function')
+        return self._subscribe(query, variables, headers, callback, buffer_size, overflow)
+
+    def _subscribe(self, query, variables, headers, callback, buffer_size, overflow):
+        """
+        start a subscription. Without a callback it is buffered, without a
+        limit if there is no `buffer_size`.
+        """
+        if self.ws_url is None:
+            raise ConnectionException('subscriptions need the websocket `url` of the server')
 
         self._connection_init(headers)
-        payload = {'headers': headers, 'query': query, 'variables': variables}
-        op_id = self._start(payload, callback)
-        self._subscriptions.append({
-            'query': query,
-            'variables': variables,
-            'headers': headers,
-            'callback': callback
-        })
-        return op_id
+        prepared = None
+        if isinstance(query, PreparedOperation):
+            prepared = query
+            payload = prepared.payload(variables, headers)
+        else:
+            payload = {'headers': headers, 'query': query, 'variables': variables}
+        if self._share_subscriptions:
+            return self._subscribe_shared(payload, callback, buffer_size, overflow)
+        return self._start(payload, callback, buffer_size, overflow, subscription=True,
+                           prepared=prepared)
+
+    def subscribe_batches(self, query: Union[str, PreparedOperation], variables: dict = None,
+                          headers: dict = None, max_items: int = 500, max_wait: float = 0.1,
+                          buffer_size: int = None, overflow: str = None) -> 'SubscriptionBatches':
+        """
+        Run a GraphQL subscription, consumed as batches of payloads:
+
+            with client.subscribe_batches(query, max_items=500, max_wait=1.0) as batches:
+                for payloads in batches:
+                    datastore.insert_many(payloads)
+
+        Every batch is a list of the payloads of the `data` messages which
+        arrived in the meantime, drained from the buffer of the subscription
+        at once. The iteration blocks until a message arrives, and then up to
+        `max_wait` seconds more for the batch to reach `max_items`. It ends
+        when the server completes the subscription; an `error` message from
+        the server raises `SubscriptionException`, and a closed client
+        `ConnectionException`, once the payloads before them are consumed.
+
+        Parameters:
+        query (str or PreparedOperation): the GraphQL query string, or an
+        operation made by `prepare`
+        variables (dict): (optional) GraphQL variables
+        headers (dict): (optional) a dictionary of headers for the session
+        max_items (int): the most payloads in a batch, None for no limit
+        max_wait (float): the most seconds to wait for a batch to fill up,
+        once it has a payload
+        buffer_size (int): (optional) keep up to these many messages while
+        they wait to be consumed; 0 keeps them all. Defaults to the
+        `subscription_buffer_size` of the client.
+        overflow (str): (optional) what to do when the buffer is full. Defaults
+        to the `subscription_overflow` of the client.
+
+        Returns:
+        SubscriptionBatches: an iterator of lists of payloads, with the
+        operation id as `op_id`. Closing it stops the subscription.
+        """
+        if max_items is not None and max_items < 1:
+            raise ValueError('the argument `max_items` should be at least 1')
+        if buffer_size is None:
+            buffer_size = self._subscription_buffer_size
+        if overflow is None:
+            overflow = self._subscription_overflow
+        op_id = self._subscribe(query, variables, headers, None, buffer_size, overflow)
+        return SubscriptionBatches(self, op_id, self._subscriber_queues[op_id],
+                                   max_items, max_wait)
+
+    def subscribe_iter(self, query: Union[str, PreparedOperation], variables: dict = None,
+                       headers: dict = None, buffer_size: int = None,
+                       overflow: str = None) -> 'SubscriptionBatches':
+        """
+        Run a GraphQL subscription, consumed as lists of the payloads which
+        are waiting in its buffer, without waiting for more. Same as
+        `subscribe_batches` with no `max_items` and no `max_wait`.
+        """
+        return self.subscribe_batches(query, variables, headers, max_items=None, max_wait=0.0,
+                                      buffer_size=buffer_size, overflow=overflow)
+
+    def _end_subscription(self, op_id):
+        """ forget a subscription which the server has ended """
+        if op_id in self._handles or op_id in self._subscriptions:
+            self.stop_subscribe(op_id)
+            return
+        self._remove_operation_queue(op_id)
+        self._op_timings.pop(op_id, None)
+
+    def _subscribe_shared(self, payload, callback, buffer_size, overflow):
+        """ join the server operation of an identical subscription, or start one """
+        key = json.dumps([payload['query'], payload['variables'], payload['headers']],
+                         sort_keys=True, default=str)
+        handle = self._new_op_id()
+        if callback is None or buffer_size:
+            self._create_operation_queue(handle, buffer_size, overflow)
+
+        while True:
+            # held while starting, so that the first messages find their subscribers
+            with self._fanout_lock:
+                server_op_id = self._shared.get(key)
+                if server_op_id is None:
+                    server_op_id = self._start(payload, self._fan_out, subscription=True)
+                    self._shared[key] = server_op_id
+                    self._fanouts[server_op_id] = {'key': key, 'members': {handle: callback},
+                                                   'last_data': None,
+                                                   'delivering': threading.RLock()}
+                    self._handles[handle] = server_op_id
+                    return handle
+                fanout = self._fanouts[server_op_id]
+
+            # `_fan_out` holds it while delivering, so the last message is
+            # replayed to the new subscriber before any newer one reaches it
+            with fanout['delivering']:
+                with self._fanout_lock:
+                    if self._shared.get(key) != server_op_id:
+                        # it ended meanwhile
+                        continue
+                    fanout['members'][handle] = callback
+                    self._handles[handle] = server_op_id
+                    last_data = fanout['last_data']
+                if last_data is not None:
+                    self._deliver(handle, callback, last_data)
+            return handle
+
+    def _fan_out(self, server_op_id, msg):
+        """ the callback of a shared server operation; hands the message to its subscribers """
+        # waits for `_subscribe_shared` to finish registering it
+        with self._fanout_lock:
+            fanout = self._fanouts.get(server_op_id)
+        if fanout is None:
+            return
+        with fanout['delivering']:
+            with self._fanout_lock:
+                if msg['type'] == GQL_DATA:
+                    fanout['last_data'] = msg
+                elif msg['type'] in [GQL_COMPLETE, GQL_ERROR]:
+                    # it is over; new subscribers start a fresh operation
+                    if self._shared.get(fanout['key']) == server_op_id:
+                        del self._shared[fanout['key']]
+                members = list(fanout['members'].items())
+            for handle, callback in members:
+                self._deliver(handle, callback, msg)
+
+    def _deliver(self, handle, callback, msg):
+        msg = dict(msg, id=handle)
+        op_queue = self._subscriber_queues.get(handle)
+        if op_queue is not None:
+            op_queue.put(msg)
+        if callback is not None:
+            callback(handle, msg)
+
+    def receive(self, op_id: str, timeout: float = None) -> dict:
+        """
+        Get the next message of a subscription which has a buffer, waiting up
+        to `timeout` seconds for one (forever, if `timeout` is None). Raises
+        `queue.Empty` if no message arrived in time.
+        """
+        try:
+            op_queue = self._subscriber_queues[op_id]
+        except KeyError:
+            raise ValueError(f'no buffered operation with id {op_id!r}') from None
+        res = op_queue.get(timeout=timeout)
+        if isinstance(res, Exception):
+            raise res
+        return res
 
     def stop_subscribe(self, op_id: str) -> None:
         """
         Stop a subscription. Takes an operation ID (`op_id`) and stops the
         subscription.
         """
-        self._stop(op_id)
+        if op_id in self._handles:
+            op_id = self._leave_shared(op_id)
+            if op_id is None:
+                return
+
+        # unregister first, so that the `complete` answering the `stop` isn't
+        # delivered to the callback
+        self._subscriptions.pop(op_id, None)
         self._remove_subscriber(op_id)
         self._remove_operation_queue(op_id)
+        self._op_timings.pop(op_id, None)
+        self._stop(op_id)
 
-    def close(self) -> None:
+    def _leave_shared(self, handle):
+        """
+        remove a subscriber from its shared server operation. Returns the id
+        of the server operation if this was its last subscriber, and it should
+        be stopped.
+        """
+        self._remove_operation_queue(handle)
+        with self._fanout_lock:
+            server_op_id = self._handles.pop(handle)
+            fanout = self._fanouts.get(server_op_id)
+            if fanout is None:
+                return None
+            fanout['members'].pop(handle, None)
+            if fanout['members']:
+                return None
+            del self._fanouts[server_op_id]
+            if self._shared.get(fanout['key']) == server_op_id:
+                del self._shared[fanout['key']]
+        if server_op_id not in self._subscriptions:
+            # the server has already ended it
+            self._remove_subscriber(server_op_id)
+            return None
+        return server_op_id
+
+    def close(self, timeout: float = 5.0) -> None:
         """
         Close the connection with the server. To reconnect, use the `connect`
         method.
+
+        The queries in flight get up to `timeout` seconds to finish, then the
+        rest of them fail with a `ConnectionException`, and so do the
+        `receive` calls waiting on subscriptions. The receiver thread is woken
+        up right away; if it is still running a callback after `timeout`
+        seconds, `close` returns without waiting for it. The same goes for the
+        callbacks running on the client's own `callback_executor`.
         """
-        self._shutdown_receiver = True
-        self._recevier_thread.join()
-        self._connection.close()
+        deadline = time.monotonic() + timeout
+        with self._in_flight_changed:
+            self._in_flight_changed.wait_for(lambda: not self._queries_in_flight or
+                                             not self.is_connected, timeout)
+        self._shutdown_receiver.set()
+        if self._owns_http:
+            self._http.close()
+        if self._connection is not None:
+            self._terminate()
+            if self._channel is not None:
+                self._channel.detach(max(0.0, deadline - time.monotonic()))
+            # stop reading: this wakes up a receiver thread blocked on a quiet
+            # connection, and saves waiting for the server's close frame
+            try:
+                self._connection.sock.shutdown(socket.SHUT_RD)
+            except (AttributeError, OSError):
+                pass
+            # nobody consumes the buffers anymore, and the receiver may be
+            # waiting for room in one of them
+            for op_queue in list(self._subscriber_queues.values()):
+                op_queue.close()
+            if self._channel is None:
+                self._recevier_thread.join(max(0.0, deadline - time.monotonic()))
+                if self._recevier_thread.is_alive():
+                    logger.warning('Closing while the receiver thread is still busy')
+            self._connection.close()
+            err = ConnectionException('The client was closed')
+            # a `connection_init` may be waiting for its ack
+            self._queue.put(err)
+            self._fail_queries(err)
+            for op_queue in list(self._subscriber_queues.values()):
+                op_queue.fail(err)
+        if self._owns_executor:
+            if not self._dispatcher.wait_idle(max(0.0, deadline - time.monotonic())):
+                logger.warning('Closing with %d subscription callbacks still to run',
+                               self._dispatcher.pending())
+            self._callback_executor.shutdown(wait=False)
+
+    def _terminate(self):
+        """ tell the server we are leaving, if it can still hear it """
+        if not self._connection.connected:
+            return
+        try:
+            self._send({'type': GQL_CONNECTION_TERMINATE})
+        except (OSError, websocket.WebSocketException):
+            pass
 
     def __enter__(self):
         """ enter method for context manager """
@@ -270,3 +1366,156 @@ class GraphQLClient():
     def __exit__(self, exc_type, exc_value, exc_traceback):
         """ exit method for context manager """
         self.close()
+
+
+class QueryHandle():
+    """
+    A query in flight over the websocket, made by `GraphQLClient.start_query`.
+
+    Attributes:
+    op_id (str): the operation id of the query
+    """
+    def __init__(self, client, op_id, op_queue, timeout, deadline):
+        self.op_id = op_id
+        self._client = client
+        self._queue = op_queue
+        self._timeout = timeout
+        self._deadline = deadline
+        self._lock = threading.Lock()
+        self._done = False
+        # the result, or the exception to raise
+        self._outcome = None
+
+    def result(self) -> dict:
+        """
+        Wait for the result of the query, as `GraphQLClient.query` returns it.
+        Raises `QueryTimeoutException` when the timeout of the query has
+        passed, after stopping it, and `CancelledError` if it was cancelled.
+        Call it from one thread at a time.
+        """
+        if not self._done:
+            timeout = None if self._deadline is None else \
+                max(0.0, self._deadline - time.monotonic())
+            try:
+                res = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                err = QueryTimeoutException(
+                    f'No result for operation {self.op_id} within {self._timeout} seconds')
+                if self._finish(err):
+                    self._client._abandon_query(self.op_id)
+            else:
+                if isinstance(res, Exception):
+                    self._finish(res)
+                elif self._finish(res):
+                    self._client._finish_query(self.op_id, res)
+                    _materialize(res)
+        if isinstance(self._outcome, Exception):
+            raise self._outcome
+        return self._outcome
+
+    def cancel(self) -> bool:
+        """
+        Give up on the query: it is stopped on the server, and `result` raises
+        `CancelledError`. Returns False if the query was over already.
+        """
+        if not self._finish(CancelledError(f'operation {self.op_id} was cancelled')):
+            return False
+        self._client._abandon_query(self.op_id)
+        # wake up the thread waiting for the result, if any
+        self._queue.fail(self._outcome)
+        return True
+
+    def _finish(self, outcome):
+        """ settle the outcome of the query, once; returns whether this call did """
+        with self._lock:
+            if self._done:
+                return False
+            self._done = True
+            self._outcome = outcome
+        self._client._query_done()
+        return True
+
+    def __repr__(self):
+        return f'<QueryHandle {self.op_id}>'
+
+
+class SubscriptionBatches():
+    """
+    The payloads of a subscription, in batches, made by
+    `GraphQLClient.subscribe_batches` or `subscribe_iter`. Iterate it from
+    one thread at a time.
+
+    Attributes:
+    op_id (str): the operation id of the subscription
+    """
+    def __init__(self, client, op_id, op_queue, max_items, max_wait):
+        self.op_id = op_id
+        self._client = client
+        self._queue = op_queue
+        self._max_items = max_items
+        self._max_wait = max_wait
+        self._done = False
+        # the exception to raise once the payloads before it are consumed
+        self._error = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> list:
+        while True:
+            if self._error is not None:
+                err, self._error = self._error, None
+                raise err
+            if self._done:
+                raise StopIteration
+            payloads = []
+            for msg in self._queue.get_many(self._max_items, max_wait=self._max_wait):
+                if isinstance(msg, Exception):
+                    self._end(msg)
+                elif msg['type'] == GQL_DATA:
+                    payloads.append(msg.get('payload'))
+                elif msg['type'] == GQL_COMPLETE:
+                    self._end()
+                elif msg['type'] == GQL_ERROR:
+                    self._end(SubscriptionException(msg.get('payload')))
+            if payloads:
+                return payloads
+
+    def _end(self, err=None):
+        self._done = True
+        self._error = err
+        self._client._end_subscription(self.op_id)
+
+    def close(self) -> None:
+        """ stop the subscription, if the server hasn't ended it """
+        if not self._done:
+            self._done = True
+            self._client.stop_subscribe(self.op_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __repr__(self):
+        return f'<SubscriptionBatches {self.op_id}>'
+
+
+# the modules of these are only imported when someone actually asks for them:
+# they import this module themselves, and the asyncio client depends on the
+# optional `websockets` library
+_LAZY_ATTRIBUTES = {
+    'AsyncGraphQLClient': 'aio',
+    'AsyncSubscription': 'aio',
+    'AsyncSubscriptionBatches': 'aio',
+    'GraphQLClientPool': 'pool',
+    'MultiprocessSubscriber': 'multiproc',
+}
+
+
+def __getattr__(name):
+    module = _LAZY_ATTRIBUTES.get(name)
+    if module is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(importlib.import_module(f'.{module}', __name__), name)
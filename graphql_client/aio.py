@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+An asyncio flavour of the GraphQL client. It speaks exactly the same Apollo
+protocol as `GraphQLClient`, but all the connections and operations are
+driven by a single event loop instead of a receiver thread per connection.
+https://github.com/apollographql/subscriptions-transport-ws/blob/master/PROTOCOL.md
+
+This module needs the `websockets` library:
+
+    pip install py-graphql-client[asyncio]
+"""
+
+import asyncio
+import logging
+import time
+
+import websockets
+
+from . import (
+    GQL_WS_SUBPROTOCOL,
+    GQL_CONNECTION_INIT,
+    GQL_START,
+    GQL_STOP,
+    GQL_CONNECTION_TERMINATE,
+    GQL_CONNECTION_ERROR,
+    GQL_CONNECTION_ACK,
+    GQL_DATA,
+    GQL_ERROR,
+    GQL_COMPLETE,
+    GQL_CONNECTION_KEEP_ALIVE,
+    ConnectionException,
+    InvalidPayloadException,
+    QueryTimeoutException,
+    SubscriptionException,
+    counter_op_ids,
+)
+from .codec import get_codec
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class AsyncSubscription():
+    """
+    An async iterator over the messages of a single subscription. Returned by
+    `AsyncGraphQLClient.subscribe`. The subscription is started on the server
+    when the iteration begins (or when `start` is awaited), and stopped when
+    the iteration ends or `stop` is awaited.
+    """
+    def __init__(self, client, payload):
+        self._client = client
+        self._payload = payload
+        self._queue = None
+        self._done = False
+        self.op_id = None
+
+    async def start(self) -> str:
+        """ start the subscription on the server, returns the operation id """
+        if self.op_id is None:
+            self.op_id, self._queue = await self._client._start(self._payload)
+        return self.op_id
+
+    async def stop(self) -> None:
+        """ stop the subscription on the server """
+        if self.op_id is not None and not self._done:
+            self._done = True
+            await self._client.stop_subscribe(self.op_id)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        if self._done:
+            raise StopAsyncIteration
+        await self.start()
+        msg = await self._queue.get()
+        if isinstance(msg, Exception):
+            self._done = True
+            self._client._remove_operation_queue(self.op_id)
+            raise msg
+        if msg['type'] == GQL_COMPLETE:
+            self._done = True
+            self._client._remove_operation_queue(self.op_id)
+            raise StopAsyncIteration
+        if msg['type'] == GQL_ERROR:
+            # the server does not send anything for an operation after an error
+            self._done = True
+            self._client._remove_operation_queue(self.op_id)
+        return msg
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.stop()
+
+
+class AsyncSubscriptionBatches(AsyncSubscription):
+    """
+    An async iterator over the payloads of a single subscription, in batches.
+    Returned by `AsyncGraphQLClient.subscribe_batches`, see
+    `GraphQLClient.subscribe_batches`.
+    """
+    def __init__(self, client, payload, max_items, max_wait):
+        super().__init__(client, payload)
+        self._max_items = max_items
+        self._max_wait = max_wait
+        # the exception to raise once the payloads before it are consumed
+        self._error = None
+
+    async def __anext__(self) -> list:
+        await self.start()
+        while True:
+            if self._error is not None:
+                err, self._error = self._error, None
+                raise err
+            if self._done:
+                raise StopAsyncIteration
+            payloads = []
+            for msg in await self._get_many():
+                if isinstance(msg, Exception):
+                    self._end(msg)
+                elif msg['type'] == GQL_DATA:
+                    payloads.append(msg.get('payload'))
+                elif msg['type'] == GQL_COMPLETE:
+                    self._end()
+                elif msg['type'] == GQL_ERROR:
+                    self._end(SubscriptionException(msg.get('payload')))
+            if payloads:
+                return payloads
+
+    async def _get_many(self):
+        """ wait for a message, then up to `max_wait` for more, and take them all """
+        op_queue = self._queue
+        msgs = [await op_queue.get()]
+        deadline = time.monotonic() + self._max_wait
+        while self._max_items is None or len(msgs) < self._max_items:
+            if not op_queue.empty():
+                msgs.append(op_queue.get_nowait())
+                continue
+            last = msgs[-1]
+            if isinstance(last, Exception) or last['type'] in [GQL_COMPLETE, GQL_ERROR]:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                msgs.append(await asyncio.wait_for(op_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return msgs
+
+    def _end(self, err=None):
+        self._done = True
+        self._error = err
+        self._client._remove_operation_queue(self.op_id)
+
+
+class AsyncGraphQLClient():
+    """
+    A GraphQL client that works over Websocket as the transport protocol,
+    running on an asyncio event loop.
+    This follows the Apollo protocol.
+    https://github.com/apollographql/subscriptions-transport-ws/blob/master/PROTOCOL.md
+
+    Usage:
+
+        async with AsyncGraphQLClient('ws://localhost:8080/graphql') as client:
+            res = await client.query(query, variables={'limit': 10})
+            async for msg in client.subscribe(subscription):
+                ...
+
+    The `codec`, `op_id_factory` and `query_timeout` arguments pick how
+    frames are encoded and decoded, how operation ids are made, and how long
+    queries wait for their result, like for `GraphQLClient`. Other keyword
+    arguments are passed to `websockets.connect`.
+    """
+    def __init__(self, url, codec=None, op_id_factory=None, query_timeout=None,
+                 **connect_kwargs):
+        self.ws_url = url
+        self._query_timeout = query_timeout
+        self._new_op_id = op_id_factory or counter_op_ids()
+        self._codec = get_codec(codec)
+        # extra keyword arguments passed as-is to `websockets.connect`
+        self._connect_kwargs = connect_kwargs
+        self._connection = None
+        self._receiver = None
+        # the `connect` made by the first operation, which the operations
+        # starting meanwhile wait for, instead of connecting again
+        self._connecting = None
+        self._connection_init_done = False
+        # cache of the headers for a session
+        self._headers = None
+        # serializes `connection_init` between concurrent operations
+        self._init_lock = None
+        # the pending `connection_init`, resolved by the receiver with the ack
+        self._init_waiter = None
+        # map of operation id to its queue of messages
+        self._subscriber_queues = {}
+
+    async def connect(self) -> None:
+        """
+        Initializes a connection with the server.
+        """
+        self._connection = await websockets.connect(self.ws_url,
+                                                    subprotocols=[GQL_WS_SUBPROTOCOL],
+                                                    **self._connect_kwargs)
+        self._connection_init_done = False
+        self._init_lock = asyncio.Lock()
+        self._receiver = asyncio.ensure_future(self._receiver_task())
+
+    async def _receiver_task(self):
+        """the recieve coroutine of the client. Which validates response from the
+        server and routes the data to the operation queues """
+        connection = self._connection
+        try:
+            async for res in connection:
+                try:
+                    msg = self._codec.decode(res)
+                except self._codec.DecodeError as err:
+                    logger.warning('Ignoring. Server sent invalid JSON data: %s \n %s', res, err)
+                    continue
+                self._route(msg)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if self._connection is connection:
+                # the next operation connects again
+                self._connection = None
+            self._fail_all(ConnectionException('connection to the server was closed'))
+
+    def _route(self, msg):
+        msg_type = msg.get('type')
+        # ignore messages which are GQL_CONNECTION_KEEP_ALIVE
+        if msg_type == GQL_CONNECTION_KEEP_ALIVE:
+            return
+
+        if 'id' not in msg:
+            # check all GQL_DATA and GQL_COMPLETE should have 'id'.
+            if msg_type in [GQL_DATA, GQL_COMPLETE]:
+                err = f'Protocol Violation.\nExpected "id" in {msg}, but could not find.'
+                self._fail_all(InvalidPayloadException(err))
+            elif self._init_waiter is not None and not self._init_waiter.done():
+                self._init_waiter.set_result(msg)
+            else:
+                logger.debug('Ignoring message not meant for any operation: %s', msg)
+            return
+
+        op_queue = self._subscriber_queues.get(msg['id'])
+        if op_queue is None:
+            logger.debug('Ignoring message for unknown operation: %s', msg)
+            return
+        op_queue.put_nowait(msg)
+
+    def _fail_all(self, exc):
+        if self._init_waiter is not None and not self._init_waiter.done():
+            self._init_waiter.set_exception(exc)
+        for op_queue in self._subscriber_queues.values():
+            op_queue.put_nowait(exc)
+        self._subscriber_queues = {}
+        self._connection_init_done = False
+
+    async def _send(self, frame):
+        if self._connection is None:
+            raise ConnectionException('client is not connected, call `connect` first')
+        data = self._codec.encode(frame)
+        # `websockets` sends bytes as a binary frame, the protocol wants text
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        try:
+            await self._connection.send(data)
+        except websockets.ConnectionClosed as exc:
+            raise ConnectionException(f'connection to the server was closed: {exc}') from exc
+
+    def _remove_operation_queue(self, op_id):
+        self._subscriber_queues.pop(op_id, None)
+
+    async def _ensure_connected(self):
+        """ connect, unless connected already, or connecting for another operation """
+        if self._connection is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self.connect())
+        connecting = self._connecting
+        try:
+            # shielded, so that an operation giving up doesn't cancel it for the others
+            await asyncio.shield(connecting)
+        finally:
+            if connecting.done() and self._connecting is connecting:
+                self._connecting = None
+
+    async def _connection_init(self, headers=None):
+        await self._ensure_connected()
+        async with self._init_lock:
+            # if we have already initialized and the passed headers are same as
+            # prev headers, then do nothing and return
+            if self._connection_init_done and headers == self._headers:
+                return
+
+            self._headers = headers
+            self._init_waiter = asyncio.get_running_loop().create_future()
+            await self._send({'type': GQL_CONNECTION_INIT, 'payload': {'headers': headers}})
+            res = await self._init_waiter
+
+            if res['type'] == GQL_CONNECTION_ERROR:
+                err = res['payload'] if 'payload' in res else 'unknown error'
+                raise ConnectionException(err)
+            if res['type'] == GQL_CONNECTION_ACK:
+                self._connection_init_done = True
+                return
+
+            err_msg = "Unknown message from server, this client did not understand. " + \
+                "Original message: " + res['type']
+            raise ConnectionException(err_msg)
+
+    async def _start(self, payload):
+        await self._connection_init(payload['headers'])
+        op_id = self._new_op_id()
+        op_queue = asyncio.Queue()
+        self._subscriber_queues[op_id] = op_queue
+        try:
+            await self._send({'id': op_id, 'type': GQL_START, 'payload': payload})
+        except BaseException:
+            self._remove_operation_queue(op_id)
+            raise
+        return op_id, op_queue
+
+    async def _stop(self, op_id):
+        await self._send({'id': op_id, 'type': GQL_STOP})
+
+    async def query(self, query: str, variables: dict = None, headers: dict = None,
+                    timeout: float = None) -> dict:
+        """
+        Run a GraphQL query or mutation. The `query` argument is a GraphQL query
+        string. You can pass optional variables and headers.
+
+        If there is no result within `timeout` seconds (the `query_timeout` of
+        the client by default), counting the time to connect, the query is
+        stopped on the server and `QueryTimeoutException` is raised. A query
+        whose task is cancelled is stopped on the server too.
+
+        PS: To run a subscription, see the `subscribe` method.
+        """
+        if timeout is None:
+            timeout = self._query_timeout
+        payload = {'headers': headers, 'query': query, 'variables': variables}
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        # connecting and the connection_init count in the timeout too
+        try:
+            op_id, op_queue = await asyncio.wait_for(self._start(payload), timeout)
+        except asyncio.TimeoutError:
+            raise QueryTimeoutException(
+                f'Could not start the operation within {timeout} seconds') from None
+        try:
+            remaining = None if deadline is None else max(0.0, deadline - loop.time())
+            res = await asyncio.wait_for(op_queue.get(), remaining)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            self._remove_operation_queue(op_id)
+            try:
+                await self._stop(op_id)
+            except ConnectionException:
+                pass
+            if isinstance(exc, asyncio.TimeoutError):
+                raise QueryTimeoutException(
+                    f'No result for operation {op_id} within {timeout} seconds') from None
+            raise
+        finally:
+            # the server sends a `complete` on its own after the result of a
+            # query; the receiver discards it once the queue is gone
+            self._remove_operation_queue(op_id)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def subscribe(self, query: str, variables: dict = None,
+                  headers: dict = None) -> AsyncSubscription:
+        """
+        Run a GraphQL subscription. Returns an async iterator yielding every
+        message the server sends for this subscription:
+
+            async for msg in client.subscribe(query):
+                ...
+
+        Parameters:
+        query (str): the GraphQL query string
+        variables (dict): (optional) GraphQL variables
+        headers (dict): (optional) a dictionary of headers for the session
+
+        Returns:
+        AsyncSubscription: the operation id is available as `op_id` once the
+        subscription has started
+        """
+        payload = {'headers': headers, 'query': query, 'variables': variables}
+        return AsyncSubscription(self, payload)
+
+    def subscribe_batches(self, query: str, variables: dict = None, headers: dict = None,
+                          max_items: int = 500, max_wait: float = 0.1) -> AsyncSubscriptionBatches:
+        """
+        Run a GraphQL subscription. Returns an async iterator yielding lists
+        of the payloads of its `data` messages, of up to `max_items` payloads
+        and waiting up to `max_wait` seconds for a batch to fill up once it
+        has one:
+
+            async with client.subscribe_batches(query, max_items=500) as batches:
+                async for payloads in batches:
+                    await datastore.insert_many(payloads)
+
+        An `error` message from the server raises `SubscriptionException`,
+        see `GraphQLClient.subscribe_batches`.
+        """
+        if max_items is not None and max_items < 1:
+            raise ValueError('the argument `max_items` should be at least 1')
+        payload = {'headers': headers, 'query': query, 'variables': variables}
+        return AsyncSubscriptionBatches(self, payload, max_items, max_wait)
+
+    def subscribe_iter(self, query: str, variables: dict = None,
+                       headers: dict = None) -> AsyncSubscriptionBatches:
+        """
+        Run a GraphQL subscription. Returns an async iterator yielding lists
+        of the payloads waiting for it, without waiting for more. Same as
+        `subscribe_batches` with no `max_items` and no `max_wait`.
+        """
+        return self.subscribe_batches(query, variables, headers, max_items=None, max_wait=0.0)
+
+    async def stop_subscribe(self, op_id: str) -> None:
+        """
+        Stop a subscription. Takes an operation ID (`op_id`) and stops the
+        subscription.
+        """
+        self._remove_operation_queue(op_id)
+        await self._stop(op_id)
+
+    async def close(self) -> None:
+        """
+        Close the connection with the server. To reconnect, use the `connect`
+        method.
+        """
+        connection = self._connection
+        if connection is None:
+            return
+        try:
+            await self._send({'type': GQL_CONNECTION_TERMINATE})
+        except ConnectionException:
+            pass
+        await connection.close()
+        await self._receiver
+        self._connection = None
+
+    async def __aenter__(self):
+        """ enter method for async context manager """
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        """ exit method for async context manager """
+        await self.close()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Coalesces many small operations into batches: whatever is submitted within a
+short window (or until the batch is full) is flushed together, and every
+caller gets its own result back.
+"""
+
+import threading
+from concurrent.futures import Future
+from typing import Callable
+
+
+class Batcher():
+    """
+    Collects items into batches for `flush`, a function taking a list of
+    items and returning the list of their results, in the same order. A
+    result which is an `Exception` is raised to its caller only.
+
+    The first item of a batch waits at most `window` seconds for company; a
+    batch is flushed as soon as it has `max_size` items. There is no
+    background thread: the caller which opened a batch (or filled it) is the
+    one flushing it.
+    """
+    def __init__(self, flush: Callable[[list], list], window: float = 0.002,
+                 max_size: int = 32):
+        if window < 0:
+            raise ValueError('the argument `window` should not be negative')
+        if max_size < 1:
+            raise ValueError('the argument `max_size` should be at least 1')
+        self._flush_fn = flush
+        self._window = window
+        self._max_size = max_size
+        self._lock = threading.Condition()
+        self._batch = []
+
+    def submit(self, item) -> Future:
+        """ add an item to the current batch; returns the future of its result """
+        future = Future()
+        with self._lock:
+            batch = self._batch
+            batch.append((item, future))
+            if len(batch) >= self._max_size:
+                # full, flush it right away and wake up the one waiting for it
+                self._batch = []
+                self._lock.notify_all()
+            elif len(batch) == 1:
+                self._lock.wait_for(lambda: self._batch is not batch, self._window)
+                if self._batch is not batch:
+                    # it filled up, and the caller who filled it flushes it
+                    return future
+                self._batch = []
+            else:
+                return future
+        self._flush(batch)
+        return future
+
+    def _flush(self, batch):
+        futures = [future for _, future in batch]
+        try:
+            results = self._flush_fn([item for item, _ in batch])
+        except Exception as exc:  # pylint: disable=broad-except
+            for future in futures:
+                future.set_exception(exc)
+            return
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded buffers for the messages of an operation, with a choice of what to do
+when a consumer falls behind and the buffer fills up.
+"""
+
+import collections
+import queue
+import threading
+import time
+
+# what to do when a message arrives for a full buffer
+# wait for the consumer to make room (this blocks the receiver of the connection)
+OVERFLOW_BLOCK = 'block'
+# discard the oldest buffered message to make room for the new one
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+# discard the new message
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+# discard everything buffered and keep only the new message
+OVERFLOW_LATEST = 'latest'
+
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_LATEST)
+
+# messages after which nothing else arrives for an operation; these are never
+# dropped, so that a consumer always gets to know that an operation is over
+_TERMINAL_TYPES = ('complete', 'error')
+
+
+class OperationBuffer():
+    """
+    A FIFO of messages for a single operation. It has the same `put`/`get`
+    interface as `queue.Queue`, but when `maxsize` is reached it applies the
+    `overflow` policy instead of growing. A `maxsize` of 0 means unbounded.
+    """
+    def __init__(self, maxsize: int = 0, overflow: str = OVERFLOW_BLOCK):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'unknown overflow policy {overflow!r}, '
+                             f'expected one of {OVERFLOW_POLICIES}')
+        if maxsize < 0:
+            raise ValueError('the argument `maxsize` should not be negative')
+        self.maxsize = maxsize
+        self.overflow = overflow
+        # number of messages discarded because of the overflow policy
+        self.dropped = 0
+        self._items = collections.deque()
+        # how many messages wake up the consumer; `get_many` raises it while
+        # it waits for a batch to fill up, so that it isn't woken for each
+        self._wake_at = 1
+        # set once the consumer is gone; later messages are discarded
+        self._closed = False
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+
+    def _full(self):
+        return 0 < self.maxsize <= len(self._items)
+
+    def put(self, msg) -> None:
+        """ add a message, applying the overflow policy if the buffer is full """
+        with self._mutex:
+            if self._closed:
+                return
+            if self._full() and msg.get('type') not in _TERMINAL_TYPES:
+                if self.overflow == OVERFLOW_BLOCK:
+                    # a consumer waiting for a batch to fill up takes what there is
+                    self._not_empty.notify()
+                    while self._full() and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.overflow == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                else:
+                    self.dropped += len(self._items)
+                    self._items.clear()
+            self._items.append(msg)
+            if len(self._items) >= self._wake_at or msg.get('type') in _TERMINAL_TYPES:
+                self._not_empty.notify()
+
+    def close(self) -> None:
+        """
+        the consumer is gone: discard the messages from now on, and release a
+        producer waiting for room in the buffer. What is buffered can still be
+        taken, and `fail` still reaches a consumer which is waiting.
+        """
+        with self._mutex:
+            self._closed = True
+            self._not_full.notify_all()
+
+    def fail(self, exc: Exception) -> None:
+        """
+        add an exception for the consumer, bypassing the size limit; the
+        consumer is expected to raise it
+        """
+        with self._mutex:
+            self._items.append(exc)
+            self._not_empty.notify()
+
+    def get(self, block: bool = True, timeout: float = None):
+        """
+        Remove and return the oldest message. Raises `queue.Empty` if there is
+        nothing to return within the `timeout`.
+        """
+        with self._not_empty:
+            if not block:
+                if not self._items:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self._items:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            msg = self._items.popleft()
+            self._not_full.notify()
+            return msg
+
+    def get_many(self, max_items: int = None, timeout: float = None,
+                 max_wait: float = 0.0) -> list:
+        """
+        Remove and return up to `max_items` of the oldest messages at once
+        (all of them, with None). Waits up to `timeout` seconds for a first
+        message, raising `queue.Empty` if none arrives, then up to `max_wait`
+        seconds more for the batch to fill up. A batch ends early with a
+        message after which nothing else arrives.
+        """
+        with self._not_empty:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._items:
+                if deadline is None:
+                    self._not_empty.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                self._not_empty.wait(remaining)
+
+            if max_wait > 0:
+                fill_deadline = time.monotonic() + max_wait
+                self._wake_at = max_items or float('inf')
+                try:
+                    while max_items is None or len(self._items) < max_items:
+                        last = self._items[-1]
+                        if isinstance(last, Exception) or last.get('type') in _TERMINAL_TYPES \
+                                or self._full():
+                            break
+                        remaining = fill_deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._not_empty.wait(remaining)
+                finally:
+                    self._wake_at = 1
+
+            count = len(self._items) if max_items is None else min(max_items, len(self._items))
+            msgs = [self._items.popleft() for _ in range(count)]
+            self._not_full.notify_all()
+            return msgs
+
+    def get_nowait(self):
+        """ same as `get(block=False)` """
+        return self.get(block=False)
+
+    def qsize(self) -> int:
+        """ number of messages currently buffered """
+        return len(self._items)
+
+    @property
+    def queue(self):
+        """ the buffered messages, oldest first """
+        return self._items
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+A client-side cache for query results, with a time to live and LRU eviction.
+Identical queries which miss the cache at the same time share a single
+request to the server.
+
+    client = GraphQLClient(url, cache=QueryCache(max_size=1000, ttl=60))
+"""
+
+import collections
+import functools
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Iterable
+
+# a string literal, or a run of insignificant characters and comments
+_TOKEN_RE = re.compile(r'("(?:[^"\\]|\\.)*")|(?:[\s,]|#[^\n]*)+')
+_MUTATION_RE = re.compile(r'^(?:\s|#[^\n]*)*mutation\b')
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_query(query: str) -> str:
+    """
+    the query with its whitespace, commas and comments collapsed, so that
+    differently formatted copies of a query compare equal
+    """
+    normalized = _TOKEN_RE.sub(lambda m: m.group(1) or ' ', query)
+    return normalized.strip()
+
+
+def is_mutation(query: str) -> bool:
+    """ whether the document is a mutation """
+    return _MUTATION_RE.match(query) is not None
+
+
+class QueryCache():
+    """
+    Caches query results by the normalized query, its variables and headers,
+    and the name of the operation to run, for documents with many.
+
+    Mutations are never cached, nor are results with `errors`. The cached
+    results are shared by all the callers getting them; treat them as
+    read-only.
+
+    Parameters:
+    max_size (int): the most results kept; the least recently used one is
+    evicted to make room for a new one
+    ttl (float): seconds a result stays valid; None to keep results until
+    they are evicted or invalidated
+    vary_headers (list): (optional) names of the headers which are part of
+    the cache key, for example `['Authorization']`. By default all the
+    headers are, so that users never get each other's results.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0,
+                 vary_headers: Iterable[str] = None):
+        if max_size < 1:
+            raise ValueError('the argument `max_size` should be at least 1')
+        self.max_size = max_size
+        self.ttl = ttl
+        self._vary_headers = None if vary_headers is None else \
+            tuple(sorted(name.lower() for name in vary_headers))
+        self._lock = threading.Lock()
+        # map of key to (expiry time, result), least recently used first
+        self._entries = collections.OrderedDict()
+        # map of key to the future of the request loading it
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, query: str, variables: dict = None, headers: dict = None,
+            operation_name: str = None) -> tuple:
+        """ the cache key of a query, and of its operation named `operation_name` """
+        if headers:
+            headers = {name.lower(): value for name, value in headers.items()}
+            if self._vary_headers is not None:
+                headers = {name: headers.get(name) for name in self._vary_headers}
+        return (normalize_query(query),
+                json.dumps(variables, sort_keys=True, default=str) if variables else '',
+                json.dumps(headers, sort_keys=True, default=str) if headers else '',
+                operation_name or '')
+
+    def get(self, key):
+        """ the cached result for `key`, or None """
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, result = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, key, result) -> None:
+        """ cache a result """
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, load: Callable[[], dict],
+                    cacheable: Callable[[dict], bool] = None) -> dict:
+        """
+        The cached result for `key`, or else the result of `load()`, which is
+        cached if `cacheable(result)` allows it. While one caller is loading
+        a key, other callers asking for it wait for that result instead of
+        loading it again.
+        """
+        with self._lock:
+            result = self._get(key)
+            if result is not None:
+                self.hits += 1
+                return result
+            self.misses += 1
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = load()
+        except BaseException as exc:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(exc)
+            raise
+        if cacheable is None or cacheable(result):
+            self.put(key, result)
+        with self._lock:
+            del self._inflight[key]
+        future.set_result(result)
+        return result
+
+    def invalidate(self, query: str = None, variables: dict = None,
+                   headers: dict = None) -> int:
+        """
+        Drop cached results: all of them, or those of a query (with any
+        variables and headers), or those of a query with exactly these
+        `variables` (and `headers`, if given). Returns how many were dropped.
+        """
+        with self._lock:
+            if query is None:
+                dropped = len(self._entries)
+                self._entries.clear()
+                return dropped
+            if variables is None and headers is None:
+                normalized = normalize_query(query)
+                keys = [key for key in self._entries if key[0] == normalized]
+            elif headers is None:
+                prefix = self.key(query, variables)[:2]
+                keys = [key for key in self._entries if key[:2] == prefix]
+            else:
+                prefix = self.key(query, variables, headers)[:3]
+                keys = [key for key in self._entries if key[:3] == prefix]
+            dropped = 0
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    dropped += 1
+            return dropped
+
+    def __len__(self):
+        return len(self._entries)
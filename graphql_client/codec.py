@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Codecs to encode the frames sent to, and decode the frames received from the
+server. The standard library `json` module is always available; the faster
+`orjson` and `msgspec` libraries are picked up automatically if installed.
+"""
+
+import json
+from collections.abc import Mapping
+
+
+class LazyPayload(Mapping):
+    """
+    The `payload` of a frame, decoded only when it is first read. It behaves
+    like a read-only dict; `decode()` returns the decoded payload and `raw`
+    the payload as it was received, for forwarding it without decoding.
+    """
+    __slots__ = ('_raw', '_codec', '_value', '_decoded')
+
+    def __init__(self, raw=None, codec=None, value=None, decoded=False):
+        self._raw = raw
+        self._codec = codec
+        self._value = value
+        self._decoded = decoded
+
+    @classmethod
+    def from_value(cls, value, codec):
+        """ wrap an already decoded payload """
+        return cls(codec=codec, value=value, decoded=True)
+
+    @property
+    def is_decoded(self) -> bool:
+        """ whether the payload has been decoded already """
+        return self._decoded
+
+    @property
+    def raw(self):
+        """ the encoded payload, as `str` or UTF-8 `bytes` """
+        if self._raw is None:
+            self._raw = self._codec.encode(self._value)
+        return self._raw
+
+    def decode(self):
+        """ the decoded payload """
+        if not self._decoded:
+            self._value = self._codec.decode(self._raw)
+            self._decoded = True
+        return self._value
+
+    def __getitem__(self, key):
+        return self.decode()[key]
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __repr__(self):
+        if self._decoded:
+            return f'LazyPayload({self._value!r})'
+        return f'LazyPayload(raw={self._raw!r})'
+
+
+class JSONCodec():
+    """ encodes and decodes frames with the standard library `json` module """
+    name = 'json'
+    # the exception raised by `decode` on invalid data
+    DecodeError = ValueError
+
+    def encode(self, obj) -> str:
+        """ encode a frame for sending; returns `str` or UTF-8 `bytes` """
+        return json.dumps(obj)
+
+    def decode(self, data):
+        """ decode a received frame, from either `str` or UTF-8 `bytes` """
+        return json.loads(data)
+
+    def decode_envelope(self, data):
+        """
+        decode only what is needed to route a received frame (its `id` and
+        `type`); the `payload`, if any, is returned as a `LazyPayload`. This
+        codec can't skip over the payload, so it is decoded upfront.
+        """
+        msg = self.decode(data)
+        if 'payload' in msg:
+            msg['payload'] = LazyPayload.from_value(msg['payload'], self)
+        return msg
+
+
+class OrjsonCodec(JSONCodec):
+    """ encodes and decodes frames with `orjson` """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        self.DecodeError = orjson.JSONDecodeError
+
+    def encode(self, obj) -> bytes:
+        return self._dumps(obj)
+
+    def decode(self, data):
+        return self._loads(data)
+
+
+class MsgspecCodec(JSONCodec):
+    """ encodes and decodes frames with `msgspec` """
+    name = 'msgspec'
+
+    def __init__(self):
+        import msgspec
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+        self._envelope_decoder = msgspec.json.Decoder(_msgspec_envelope())
+        self.DecodeError = msgspec.DecodeError
+
+    def encode(self, obj) -> bytes:
+        return self._encoder.encode(obj)
+
+    def decode(self, data):
+        return self._decoder.decode(data)
+
+    def decode_envelope(self, data):
+        """ the payload is kept as the raw bytes, and decoded only if read """
+        envelope = self._envelope_decoder.decode(data)
+        msg = {'type': envelope.type}
+        if envelope.id is not None:
+            msg['id'] = envelope.id
+        if envelope.payload:
+            msg['payload'] = LazyPayload(bytes(envelope.payload), self)
+        return msg
+
+
+_MSGSPEC_ENVELOPE = None
+
+
+def _msgspec_envelope():
+    """ the msgspec type of a frame, which leaves the payload undecoded """
+    global _MSGSPEC_ENVELOPE  # pylint: disable=global-statement
+    if _MSGSPEC_ENVELOPE is None:
+        import msgspec
+        from typing import Optional, Union
+
+        class Envelope(msgspec.Struct):
+            type: str
+            id: Optional[Union[str, int]] = None
+            # an empty `Raw` when the frame has no payload
+            payload: msgspec.Raw = msgspec.Raw()
+
+        _MSGSPEC_ENVELOPE = Envelope
+    return _MSGSPEC_ENVELOPE
+
+
+class UjsonCodec(JSONCodec):
+    """ encodes and decodes frames with `ujson` """
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._dumps = ujson.dumps
+        self._loads = ujson.loads
+        self.DecodeError = getattr(ujson, 'JSONDecodeError', ValueError)
+
+    def encode(self, obj) -> str:
+        return self._dumps(obj, ensure_ascii=False)
+
+    def decode(self, data):
+        return self._loads(data)
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    OrjsonCodec.name: OrjsonCodec,
+    MsgspecCodec.name: MsgspecCodec,
+    UjsonCodec.name: UjsonCodec,
+}
+
+# codecs tried, in order, when none is asked for
+_PREFERRED_CODECS = (OrjsonCodec, MsgspecCodec)
+
+
+def get_codec(codec=None) -> JSONCodec:
+    """
+    Returns a codec instance. `codec` can be a codec instance (returned as-is),
+    the name of a codec ('json', 'orjson', 'msgspec' or 'ujson'), or None for
+    the fastest installed one.
+    """
+    if codec is None:
+        for codec_class in _PREFERRED_CODECS:
+            try:
+                return codec_class()
+            except ImportError:
+                continue
+        return JSONCodec()
+
+    if isinstance(codec, str):
+        try:
+            return CODECS[codec]()
+        except KeyError:
+            raise ValueError(f'unknown codec {codec!r}, expected one of {list(CODECS)}') from None
+
+    return codec
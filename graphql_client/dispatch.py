@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Runs subscription callbacks on an executor instead of the receiver thread,
+so that a slow callback does not hold up the other operations of the
+connection.
+"""
+
+import collections
+import threading
+import logging
+from concurrent.futures import Executor
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class CallbackDispatcher():
+    """
+    Submits callbacks to an `concurrent.futures.Executor`, keeping them in
+    order per key (the operation id): callbacks of one operation run one at a
+    time and in the order they were dispatched, while callbacks of different
+    operations can run in parallel.
+
+    At most `max_batch` callbacks of one operation run back to back on a
+    worker, before it is handed back to the executor, so a busy operation
+    does not starve the others.
+    """
+    def __init__(self, executor: Executor, max_batch: int = 32):
+        self._executor = executor
+        self._max_batch = max_batch
+        self._lock = threading.Lock()
+        # notified when the last key is done
+        self._idle = threading.Condition(self._lock)
+        # map of key to the callbacks waiting to run for it. A key is present
+        # as long as a task for it is scheduled on the executor.
+        self._pending = {}
+
+    def dispatch(self, key, fn, *args) -> None:
+        """ run `fn(*args)` on the executor, after the earlier callbacks of `key` """
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending.append((fn, args))
+                return
+            self._pending[key] = collections.deque([(fn, args)])
+        self._executor.submit(self._run, key)
+
+    def _run(self, key):
+        for _ in range(self._max_batch):
+            with self._lock:
+                pending = self._pending[key]
+                if not pending:
+                    del self._pending[key]
+                    if not self._pending:
+                        self._idle.notify_all()
+                    return
+                fn, args = pending.popleft()
+            try:
+                fn(*args)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Subscription callback for operation %s raised', key)
+        # give the other operations a turn
+        self._executor.submit(self._run, key)
+
+    def pending(self) -> int:
+        """ number of callbacks waiting to run """
+        with self._lock:
+            return sum(len(pending) for pending in self._pending.values())
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """ wait until no callback is waiting or running; returns False on timeout """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Runs queries and mutations over plain HTTP(S) `POST`s, without the websocket
+protocol: no `connection_init`, and no `start`/`complete` exchange per query.
+Connections are kept alive and reused, and with many urls (say, the replicas
+of a gateway) the requests are spread over them round-robin.
+
+    transport = HTTPTransport(['https://gw-1/graphql', 'https://gw-2/graphql'])
+    transport.post({'query': query, 'variables': variables})
+"""
+
+import collections
+import gzip
+import http.client
+import itertools
+import selectors
+import socket
+import ssl
+import threading
+import zlib
+import logging
+from urllib.parse import urlsplit
+
+from .codec import get_codec
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# errors writing to a kept-alive connection which the server closed while it
+# was idle; the server can't have run an incomplete request, so it is sent
+# again on a fresh connection. Errors once it is written are never retried,
+# since the server may have run it (think of a mutation).
+_STALE_CONNECTION_ERRORS = (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+
+class HTTPTransportException(Exception):
+    """ Exception thrown when a request to the GraphQL server fails """
+
+
+class HTTPTransportTimeout(HTTPTransportException):
+    """ Exception thrown when the GraphQL server does not answer in time """
+
+
+def _decompress(data, encoding):
+    """ decode a response body as per its `Content-Encoding` """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # some servers send a raw deflate stream, without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    if encoding == 'br' and brotli is not None:
+        return brotli.decompress(data)
+    if encoding == 'identity':
+        return data
+    raise HTTPTransportException(f'unsupported response encoding {encoding!r}')
+
+
+def _is_response(res):
+    # GraphQL servers answer errors in the query with a 4xx and a body with
+    # `errors`; anything else is a failure of the server itself
+    return isinstance(res, dict) and ('data' in res or 'errors' in res)
+
+
+def _is_dropped(conn):
+    """
+    whether the server has closed an idle connection: it has nothing to say
+    between requests, so a readable socket is at its end (or out of sync)
+    """
+    if conn.sock is None:
+        return True
+    with selectors.DefaultSelector() as selector:
+        selector.register(conn.sock, selectors.EVENT_READ)
+        return bool(selector.select(0))
+
+
+def _bad_response(status, data):
+    return HTTPTransportException(
+        f'The GraphQL server answered with HTTP {status}: {data[:200]!r}')
+
+
+class _Endpoint():
+    """ one url, with a pool of idle kept-alive connections to it """
+    def __init__(self, url, pool_size, timeout, ssl_context):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'expected an http(s) url, got {url!r}')
+        self.url = url
+        self._https = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port
+        self.path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._ssl_context = ssl_context
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        # number of connections opened so far, for inspection
+        self.connections_opened = 0
+
+    def _new_connection(self, timeout=None):
+        self.connections_opened += 1
+        timeout = self._timeout if timeout is None else timeout
+        if self._https:
+            return http.client.HTTPSConnection(self._host, self._port, timeout=timeout,
+                                               context=self._ssl_context)
+        return http.client.HTTPConnection(self._host, self._port, timeout=timeout)
+
+    def _checkout(self, timeout):
+        """ an idle connection (the most recently used one), or a new one """
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return self._new_connection(timeout), False
+            if not _is_dropped(conn):
+                break
+            conn.close()
+        conn.timeout = self._timeout if timeout is None else timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+        return conn, True
+
+    def _checkin(self, conn):
+        with self._lock:
+            if len(self._idle) < self._pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, body, headers, timeout=None):
+        """ `POST` the body, returns `(status, headers, body)` """
+        conn, reused = self._checkout(timeout)
+        try:
+            try:
+                conn.request('POST', self.path, body, headers)
+            except _STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                conn.close()
+                conn = self._new_connection(timeout)
+                conn.request('POST', self.path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except BaseException:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(conn)
+        return response.status, response.headers, data
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+
+class HTTPTransport():
+    """
+    Sends GraphQL requests as HTTP `POST`s over kept-alive connections.
+
+    Parameters:
+    url (str or list): the http(s) url of the GraphQL server. If a list of
+    urls is passed, the requests are spread over them round-robin, and a
+    request whose server can't be reached is tried on the next one.
+    pool_size (int): number of idle connections kept open per url
+    timeout (float): seconds to wait for the server, per request
+    codec (str or JSONCodec): (optional) how requests and responses are
+    encoded and decoded; see `graphql_client.codec`
+    compression (bool): ask the server for gzip/deflate (and brotli, if the
+    `brotli` library is installed) compressed responses
+    http2 (bool): multiplex the requests over HTTP/2 connections. Needs the
+    `httpx` library, installed with its `http2` extra.
+    ssl_context (ssl.SSLContext): (optional) for https urls
+    """
+    def __init__(self, url, pool_size: int = 10, timeout: float = 30.0, codec=None,
+                 compression: bool = True, http2: bool = False,
+                 ssl_context: ssl.SSLContext = None):
+        urls = [url] if isinstance(url, str) else list(url)
+        if not urls:
+            raise ValueError('the argument `url` should have at least one url')
+        if pool_size < 1:
+            raise ValueError('the argument `pool_size` should be at least 1')
+        self._codec = get_codec(codec)
+        self._next = itertools.count()
+        self._headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Connection': 'keep-alive',
+        }
+        if compression:
+            self._headers['Accept-Encoding'] = 'gzip, deflate' + (', br' if brotli else '')
+
+        self._httpx = None
+        self._errors = (OSError, http.client.HTTPException)
+        self._connect_errors = (ConnectionRefusedError, socket.gaierror)
+        self._timeout_errors = (socket.timeout,)
+        if http2:
+            import httpx
+            self._errors += (httpx.HTTPError,)
+            self._connect_errors += (httpx.ConnectError,)
+            self._timeout_errors += (httpx.TimeoutException,)
+            self._httpx = httpx.Client(
+                http2=True, timeout=timeout, verify=ssl_context or True,
+                limits=httpx.Limits(max_keepalive_connections=pool_size * len(urls)))
+            self._endpoints = urls
+        else:
+            ssl_context = ssl_context or ssl.create_default_context()
+            self._endpoints = [_Endpoint(u, pool_size, timeout, ssl_context) for u in urls]
+
+    @property
+    def urls(self) -> list:
+        """ the urls the requests are spread over """
+        return [getattr(endpoint, 'url', endpoint) for endpoint in self._endpoints]
+
+    def post(self, payload: dict, headers: dict = None, timeout: float = None) -> dict:
+        """
+        Send a GraphQL request (`{'query': ..., 'variables': ...}`) and return
+        the decoded response body. Raises `HTTPTransportException` if no
+        server could be reached, or if one answered without a GraphQL
+        response, and `HTTPTransportTimeout` if the server did not answer
+        within `timeout` seconds (the `timeout` of the transport by default).
+        """
+        status, data = self._post(payload, headers, timeout)
+        res = self._decode(data)
+        if not _is_response(res):
+            raise _bad_response(status, data)
+        return res
+
+    def post_batch(self, payloads: list, headers: dict = None, timeout: float = None) -> list:
+        """
+        Send many GraphQL requests as one array-batched request, and return
+        their response bodies in the same order. The server has to support
+        batching (Apollo Server, graphql-java, Hasura and others do). Raises
+        like `post`.
+        """
+        status, data = self._post(payloads, headers, timeout)
+        res = self._decode(data)
+        if not isinstance(res, list) or len(res) != len(payloads) \
+                or not all(_is_response(r) for r in res):
+            raise _bad_response(status, data)
+        return res
+
+    def _post(self, payload, headers, timeout=None):
+        """ returns `(status, body)`; `payload` can be encoded already """
+        body = payload if isinstance(payload, bytes) else self._codec.encode(payload)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        request_headers = dict(self._headers, **headers) if headers else self._headers
+
+        start = next(self._next)
+        count = len(self._endpoints)
+        for i in range(count):
+            endpoint = self._endpoints[(start + i) % count]
+            try:
+                return self._request(endpoint, body, request_headers, timeout)
+            except self._errors as exc:
+                # the server was never reached, so it is safe to try another
+                if i + 1 < count and isinstance(exc, self._connect_errors):
+                    logger.warning('Could not connect to %s, trying the next server: %s',
+                                   getattr(endpoint, 'url', endpoint), exc)
+                    continue
+                if isinstance(exc, self._timeout_errors):
+                    raise HTTPTransportTimeout(f'The GraphQL server did not answer in time: {exc}') \
+                        from exc
+                raise HTTPTransportException(f'Request to the GraphQL server failed: {exc}') \
+                    from exc
+
+    def _request(self, endpoint, body, headers, timeout=None):
+        if self._httpx is not None:
+            options = {} if timeout is None else {'timeout': timeout}
+            response = self._httpx.post(endpoint, content=body, headers=headers, **options)
+            # httpx has decompressed the body already
+            return response.status_code, response.content
+        status, response_headers, data = endpoint.request(body, headers, timeout)
+        return status, _decompress(data, response_headers.get('Content-Encoding'))
+
+    def _decode(self, data):
+        try:
+            return self._codec.decode(data)
+        except self._codec.DecodeError:
+            return None
+
+    def close(self) -> None:
+        """ close the kept-alive connections """
+        if self._httpx is not None:
+            self._httpx.close()
+            return
+        for endpoint in self._endpoints:
+            endpoint.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
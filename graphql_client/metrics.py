@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the client. The client reports what it does to a metrics
+sink; pick one of the sinks here, or subclass `MetricsSink` to export the
+numbers anywhere else.
+
+    client = GraphQLClient(url, metrics=InMemorySink())
+    ...
+    client.metrics.snapshot()
+"""
+
+import bisect
+import collections
+import threading
+
+# seconds from sending `start` to the first `data` of an operation
+FIRST_DATA_SECONDS = 'graphql_client_first_data_seconds'
+# seconds from sending `start` to the `complete` (or `error`) of an operation
+COMPLETE_SECONDS = 'graphql_client_complete_seconds'
+# seconds spent in a subscription callback
+CALLBACK_SECONDS = 'graphql_client_callback_seconds'
+FRAMES_RECEIVED = 'graphql_client_frames_received_total'
+BYTES_RECEIVED = 'graphql_client_bytes_received_total'
+FRAMES_SENT = 'graphql_client_frames_sent_total'
+BYTES_SENT = 'graphql_client_bytes_sent_total'
+RECONNECTS = 'graphql_client_reconnects_total'
+# number of messages waiting in the buffer of a subscription
+BUFFER_DEPTH = 'graphql_client_buffer_depth'
+
+# the labels each metric is reported with
+METRIC_LABELS = {
+    FIRST_DATA_SECONDS: ('operation',),
+    COMPLETE_SECONDS: ('operation',),
+    CALLBACK_SECONDS: ('operation',),
+    FRAMES_RECEIVED: (),
+    BYTES_RECEIVED: (),
+    FRAMES_SENT: (),
+    BYTES_SENT: (),
+    RECONNECTS: (),
+    BUFFER_DEPTH: ('operation',),
+}
+
+# upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsSink():
+    """
+    Receives the metrics of a client. This base sink discards everything;
+    subclasses override the methods they care about. `enabled` tells the
+    client whether it should bother measuring at all.
+    """
+    enabled = False
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        """ add `value` to the counter `name` """
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """ record `value` in the histogram `name` """
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        """ set the gauge `name` to `value` """
+
+
+class CallbackSink(MetricsSink):
+    """
+    Calls plain functions with every metric, as `fn(name, value, labels)`.
+    Any of the functions can be left out.
+    """
+    enabled = True
+
+    def __init__(self, on_increment=None, on_observe=None, on_gauge=None):
+        self._on_increment = on_increment
+        self._on_observe = on_observe
+        self._on_gauge = on_gauge
+
+    def increment(self, name, value=1, **labels):
+        if self._on_increment:
+            self._on_increment(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        if self._on_observe:
+            self._on_observe(name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        if self._on_gauge:
+            self._on_gauge(name, value, labels)
+
+
+class Histogram():
+    """ a fixed-bucket histogram, with the count and sum of the observed values """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for the values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """ an estimate of the `q` quantile: the upper bound of its bucket """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class InMemorySink(MetricsSink):
+    """
+    Keeps the metrics in memory: counters, histograms and gauges keyed by the
+    metric name and its labels. Use `snapshot` to read them.
+    """
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def snapshot(self) -> dict:
+        """
+        The current value of all the metrics, as
+        `{'counters': {...}, 'histograms': {...}, 'gauges': {...}}`, each keyed
+        by `(name, ((label, value), ...))`.
+        """
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'histograms': {key: h.to_dict() for key, h in self._histograms.items()},
+                'gauges': dict(self._gauges),
+            }
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Exports the metrics to a `prometheus_client` registry (the default
+    registry, unless one is passed). Needs the `prometheus_client` library.
+    """
+    enabled = True
+
+    def __init__(self, registry=None, buckets=DEFAULT_BUCKETS):
+        import prometheus_client
+        self._prometheus = prometheus_client
+        self._registry = registry if registry is not None else prometheus_client.REGISTRY
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _metric(self, name, kind):
+        metric = self._metrics.get(name)
+        if metric is not None:
+            return metric
+        with self._lock:
+            if name not in self._metrics:
+                kwargs = {'registry': self._registry}
+                if kind is self._prometheus.Histogram:
+                    kwargs['buckets'] = self._buckets
+                # prometheus_client adds the `_total` suffix of counters itself
+                metric_name = name[:-len('_total')] if name.endswith('_total') else name
+                self._metrics[name] = kind(metric_name, name.replace('_', ' '),
+                                           METRIC_LABELS.get(name, ()), **kwargs)
+            return self._metrics[name]
+
+    @staticmethod
+    def _labelled(metric, labels):
+        return metric.labels(**labels) if labels else metric
+
+    def increment(self, name, value=1, **labels):
+        self._labelled(self._metric(name, self._prometheus.Counter), labels).inc(value)
+
+    def observe(self, name, value, **labels):
+        self._labelled(self._metric(name, self._prometheus.Histogram), labels).observe(value)
+
+    def gauge(self, name, value, **labels):
+        self._labelled(self._metric(name, self._prometheus.Gauge), labels).set(value)
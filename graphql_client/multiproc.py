@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+Subscriptions sharded across worker processes. Reading the websocket,
+decoding the frames and routing the messages of a busy subscription is bound
+by the GIL, so one process tops out at one core however many subscriptions it
+holds. Here every worker process owns its own `GraphQLClient`, with its own
+connection, and hands the decoded messages to the parent in batches over a
+pipe; the parent only unpickles the batches and runs the callbacks.
+
+    with MultiprocessSubscriber(url, processes=4) as subscriber:
+        subscriber.subscribe(query, callback=on_message)
+
+Work which can run in the workers, like filtering or reducing the messages,
+goes into `transform`, so that it scales with the processes too.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from typing import Callable, Union
+
+from . import GQL_COMPLETE, GQL_ERROR, GraphQLClient, _materialize, counter_op_ids
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# the records sent by a worker to the parent, as `(kind, sub_id, value)`
+_MESSAGE = 'message'
+_SUBSCRIBED = 'subscribed'
+# the server ended a subscription, with a complete or an error
+_ENDED = 'ended'
+
+# the commands sent by the parent to a worker
+_SUBSCRIBE = 'subscribe'
+_STOP = 'stop'
+_CLOSE = 'close'
+
+# how many batches a worker holds for a parent which falls behind, before it
+# stops reading its connection
+_MAX_PENDING_BATCHES = 64
+
+
+class _Outbox():
+    """
+    The records of a worker waiting to be sent to the parent. A thread sends
+    them in batches, of up to `batch_size` records or whatever arrived within
+    `flush_interval` seconds of the first one.
+    """
+    def __init__(self, conn, batch_size, flush_interval):
+        self._conn = conn
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = batch_size * _MAX_PENDING_BATCHES
+        self._records = []
+        self._urgent = False
+        self._closed = False
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='gql-outbox', daemon=True)
+        self._thread.start()
+
+    def put(self, record, flush=False) -> None:
+        """ queue a record, sent right away with `flush` """
+        with self._changed:
+            while len(self._records) >= self._max_pending and not self._closed:
+                self._changed.wait()
+            self._records.append(record)
+            self._urgent = self._urgent or flush
+            # the first record starts the wait for a batch, and a full batch ends it
+            if self._urgent or len(self._records) in (1, self._batch_size):
+                self._changed.notify_all()
+
+    def close(self) -> None:
+        """ send what is left, and stop """
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._records and not self._closed:
+                    self._changed.wait()
+                if not self._urgent and not self._closed \
+                        and len(self._records) < self._batch_size:
+                    self._changed.wait(self._flush_interval)
+                records, self._records = self._records, []
+                self._urgent = False
+                closed = self._closed
+                self._changed.notify_all()
+            if records:
+                try:
+                    self._conn.send(records)
+                except OSError:
+                    # the parent is gone
+                    return
+            if closed:
+                return
+
+
+def _worker_main(conn, url, client_kwargs, transform, batch_size, flush_interval):
+    """ the main function of a worker process """
+    outbox = _Outbox(conn, batch_size, flush_interval)
+    # map of parent subscription id to the operation id in this worker's client
+    op_ids = {}
+    # the subscriptions which ended before `subscribe` returned their id
+    ended = set()
+    # guards `op_ids` and `ended`, shared with the receiver thread of the client
+    lock = threading.Lock()
+    client = None
+    try:
+        client = GraphQLClient(url, **client_kwargs)
+
+        def forward(sub_id):
+            def callback(_op_id, msg):
+                over = msg.get('type') in [GQL_COMPLETE, GQL_ERROR]
+                msg = _materialize(dict(msg, id=sub_id))
+                if transform is not None:
+                    msg = transform(msg)
+                if msg is not None:
+                    outbox.put((_MESSAGE, sub_id, msg))
+                if over:
+                    with lock:
+                        if op_ids.pop(sub_id, None) is None:
+                            ended.add(sub_id)
+                    outbox.put((_ENDED, sub_id, None))
+            return callback
+
+        while True:
+            command = conn.recv()
+            if command[0] == _SUBSCRIBE:
+                _, sub_id, query, variables, headers = command
+                try:
+                    op_id = client.subscribe(query, variables=variables, headers=headers,
+                                             callback=forward(sub_id))
+                    with lock:
+                        if sub_id in ended:
+                            ended.discard(sub_id)
+                        else:
+                            op_ids[sub_id] = op_id
+                    error = None
+                except Exception as exc:  # pylint: disable=broad-except
+                    error = exc
+                outbox.put((_SUBSCRIBED, sub_id, error), flush=True)
+            elif command[0] == _STOP:
+                with lock:
+                    op_id = op_ids.pop(command[1], None)
+                if op_id is not None:
+                    client.stop_subscribe(op_id)
+            else:
+                return
+    except (EOFError, KeyboardInterrupt):
+        # the parent is gone
+        pass
+    finally:
+        if client is not None:
+            client.close()
+        outbox.close()
+        conn.close()
+
+
+class _Worker():
+    """ a worker process, along with the end of its pipe and its subscriptions """
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.subscriptions = set()
+        # sends can come from many threads at once
+        self.send_lock = threading.Lock()
+
+    def send(self, command):
+        with self.send_lock:
+            self.conn.send(command)
+
+
+class MultiprocessSubscriber():
+    """
+    Runs subscriptions on a pool of worker processes, each with a connection
+    of its own, and delivers their messages to callbacks in this process.
+
+    New subscriptions go to the worker with the fewest. The callbacks are run
+    one at a time on a thread of the subscriber, with the same `(op_id, msg)`
+    arguments as for `GraphQLClient.subscribe`, `msg` being fully decoded.
+    That thread also reads the answers to `subscribe`, so the callbacks can't
+    subscribe themselves. A subscription which the server ends is forgotten
+    after its last message.
+
+    Parameters:
+    url (str): the websocket url of the GraphQL server
+    processes (int): (optional) number of worker processes. Defaults to the
+    number of CPUs.
+    client_kwargs (dict): (optional) the arguments of the `GraphQLClient` of
+    every worker, like its `codec` or `reconnect_policy`. They are pickled.
+    transform (function): (optional) run in the worker on every message,
+    returning what to send to the callback, or None to drop the message. It
+    is pickled, so it has to be a module level function.
+    batch_size (int): the most messages sent to this process at once
+    flush_interval (float): the most seconds a message waits in a worker for
+    its batch to fill up
+    mp_context (str or context): (optional) the `multiprocessing` start
+    method, or context, of the workers. Defaults to 'spawn', which doesn't
+    copy the threads of this process.
+    """
+    def __init__(self, url: str, processes: int = None, client_kwargs: dict = None,
+                 transform: Callable[[dict], dict] = None, batch_size: int = 256,
+                 flush_interval: float = 0.002,
+                 mp_context: Union[str, multiprocessing.context.BaseContext] = 'spawn'):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes < 1:
+            raise ValueError('the argument `processes` should be at least 1')
+        if batch_size < 1:
+            raise ValueError('the argument `batch_size` should be at least 1')
+        if isinstance(mp_context, str):
+            mp_context = multiprocessing.get_context(mp_context)
+
+        self._new_sub_id = counter_op_ids()
+        # guards the workers' subscriptions, the callbacks and the pending subscribes
+        self._lock = threading.Lock()
+        # map of subscription id to its worker and callback
+        self._subscriptions = {}
+        # map of subscription id to the future of its `subscribe`
+        self._pending = {}
+        self._closed = False
+        self._workers = []
+        for _ in range(processes):
+            conn, child_conn = mp_context.Pipe()
+            process = mp_context.Process(
+                target=_worker_main, name='gql-worker', daemon=True,
+                args=(child_conn, url, client_kwargs or {}, transform, batch_size,
+                      flush_interval))
+            process.start()
+            child_conn.close()
+            self._workers.append(_Worker(process, conn))
+
+        self._reader_thread = threading.Thread(target=self._reader_task,
+                                               name='gql-multiproc-reader', daemon=True)
+        self._reader_thread.start()
+
+    def subscribe(self, query: str, variables: dict = None, headers: dict = None,
+                  callback: Callable[[str, dict], None] = None) -> str:
+        """
+        Run a GraphQL subscription on the worker with the fewest. Raises the
+        exception of the worker's `GraphQLClient.subscribe`, if any, and
+        `RuntimeError` if called from a callback.
+
+        Returns:
+        op_id (str): The id of this subscription
+        """
+        if not callback or not callable(callback):
+            raise TypeError('the argument `callback` is mandatory and it should be a function')
+        if threading.current_thread() is self._reader_thread:
+            # it would wait for itself to read the answer
+            raise RuntimeError('cannot subscribe from a callback of the subscriber')
+
+        sub_id = self._new_sub_id()
+        started = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('the subscriber is closed')
+            live = [worker for worker in self._workers if worker.process.is_alive()]
+            if not live:
+                raise RuntimeError('all the worker processes have exited')
+            worker = min(live, key=lambda w: len(w.subscriptions))
+            worker.subscriptions.add(sub_id)
+            # registered upfront, since messages may arrive before the ack
+            self._subscriptions[sub_id] = (worker, callback)
+            self._pending[sub_id] = started
+        try:
+            worker.send((_SUBSCRIBE, sub_id, query, variables, headers))
+            started.result()
+        except BaseException:
+            self._forget(sub_id)
+            raise
+        return sub_id
+
+    def stop_subscribe(self, op_id: str) -> None:
+        """
+        Stop a subscription. Takes the id returned by `subscribe`.
+        """
+        worker = self._forget(op_id)
+        if worker is None:
+            # the server has ended it already
+            return
+        try:
+            worker.send((_STOP, op_id))
+        except OSError:
+            pass
+
+    def _forget(self, sub_id):
+        with self._lock:
+            worker, _ = self._subscriptions.pop(sub_id, (None, None))
+            self._pending.pop(sub_id, None)
+            if worker is not None:
+                worker.subscriptions.discard(sub_id)
+        return worker
+
+    def _reader_task(self):
+        workers = {worker.conn: worker for worker in self._workers}
+        while workers:
+            for conn in wait(list(workers)):
+                try:
+                    records = conn.recv()
+                except (EOFError, OSError):
+                    self._worker_exited(workers.pop(conn))
+                    continue
+                for kind, sub_id, value in records:
+                    if kind == _MESSAGE:
+                        self._deliver(sub_id, value)
+                    elif kind == _ENDED:
+                        self._ended(sub_id)
+                    else:
+                        self._subscribed(sub_id, value)
+
+    def _ended(self, sub_id):
+        # a pending `subscribe` still gets its answer, which comes after this
+        # if the subscription ended right away
+        with self._lock:
+            worker, _ = self._subscriptions.pop(sub_id, (None, None))
+            if worker is not None:
+                worker.subscriptions.discard(sub_id)
+
+    def _deliver(self, sub_id, msg):
+        entry = self._subscriptions.get(sub_id)
+        if entry is None:
+            # stopped meanwhile
+            return
+        try:
+            entry[1](sub_id, msg)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Subscription callback for %s raised', sub_id)
+
+    def _subscribed(self, sub_id, error):
+        with self._lock:
+            started = self._pending.pop(sub_id, None)
+        if started is None:
+            return
+        if error is not None:
+            started.set_exception(error)
+        else:
+            started.set_result(None)
+
+    def _worker_exited(self, worker):
+        with self._lock:
+            lost = list(worker.subscriptions)
+            worker.subscriptions.clear()
+            for sub_id in lost:
+                del self._subscriptions[sub_id]
+            pending = [self._pending.pop(sub_id) for sub_id in lost if sub_id in self._pending]
+            closed = self._closed
+        for started in pending:
+            started.set_exception(RuntimeError('the worker process exited'))
+        if lost and not closed:
+            logger.error('Worker process %d exited, losing %d subscriptions',
+                         worker.process.pid, len(lost))
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Close the connections of the workers, and stop them, within about
+        `timeout` seconds in total. Workers which are still running then are
+        terminated.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for worker in self._workers:
+            try:
+                worker.send((_CLOSE,))
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logger.warning('Worker process %d did not stop in time, terminating it',
+                               worker.process.pid)
+                worker.process.terminate()
+                worker.process.join()
+        self._reader_thread.join(max(0.0, deadline - time.monotonic()))
+        for worker in self._workers:
+            worker.conn.close()
+
+    def __enter__(self):
+        """ enter method for context manager """
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ exit method for context manager """
+        self.close()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Automatic persisted queries, as implemented by Apollo Server and others:
+operations are sent as the sha256 hash of their document, and the document
+itself is only sent when the server doesn't know the hash yet.
+https://www.apollographql.com/docs/apollo-server/performance/apq/
+"""
+
+import functools
+import hashlib
+
+PERSISTED_QUERY_VERSION = 1
+# the errors of a server which doesn't know the hash, or doesn't do APQ at all
+PERSISTED_QUERY_NOT_FOUND = 'PersistedQueryNotFound'
+PERSISTED_QUERY_NOT_SUPPORTED = 'PersistedQueryNotSupported'
+
+_ERROR_CODES = {
+    'PERSISTED_QUERY_NOT_FOUND': PERSISTED_QUERY_NOT_FOUND,
+    'PERSISTED_QUERY_NOT_SUPPORTED': PERSISTED_QUERY_NOT_SUPPORTED,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def query_hash(query: str) -> str:
+    """ the sha256 hash of a document, hex encoded """
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+def persisted_query_extension(query: str) -> dict:
+    """ the `extensions` of a request for a persisted query """
+    return {'persistedQuery': {'version': PERSISTED_QUERY_VERSION,
+                               'sha256Hash': query_hash(query)}}
+
+
+def persisted_query_error(payload):
+    """
+    `PERSISTED_QUERY_NOT_FOUND` or `PERSISTED_QUERY_NOT_SUPPORTED` if the
+    response (or error) payload says so, otherwise None
+    """
+    if isinstance(payload, dict):
+        errors = payload.get('errors', [payload])
+    elif isinstance(payload, list):
+        errors = payload
+    else:
+        return None
+    for error in errors or ():
+        if not isinstance(error, dict):
+            continue
+        message = error.get('message')
+        if message in (PERSISTED_QUERY_NOT_FOUND, PERSISTED_QUERY_NOT_SUPPORTED):
+            return message
+        code = (error.get('extensions') or {}).get('code')
+        if code in _ERROR_CODES:
+            return _ERROR_CODES[code]
+    return None
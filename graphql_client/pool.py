@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+A pool of warm `GraphQLClient` connections. Operations are handed out to the
+least loaded connection, and dead connections are replaced in the background,
+so that no operation has to wait for a websocket handshake.
+"""
+
+import functools
+import itertools
+import threading
+import time
+import uuid
+import logging
+from typing import Callable
+
+from . import GQL_COMPLETE, GQL_ERROR, ConnectionException, GraphQLClient
+from .reconnect import ReconnectPolicy
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class _PooledConnection():
+    """ a client in the pool, along with the count of its in-flight operations """
+    def __init__(self, client):
+        self.client = client
+        self.inflight = 0
+
+
+class GraphQLClientPool():
+    """
+    A pool of `GraphQLClient` connections to one or more servers.
+
+    The pool opens `size` connections upfront (and finishes `connection_init`
+    on them), runs every operation on the least loaded connection, and never
+    puts more than `max_inflight` operations on one connection at a time. If
+    all the connections are at capacity, callers wait for one to free up.
+    Connections which aren't connected are skipped; if none is left,
+    operations raise a `ConnectionException`.
+
+    Connections which die are replaced by a background thread, and the
+    subscriptions which were running on them are started again on the new
+    connection. The subscription ids handed out by the pool stay the same.
+
+    Parameters:
+    url (str or list): the websocket url of the server. If a list of urls is
+    passed, the connections are spread over them round-robin.
+    size (int): number of connections to keep open
+    max_inflight (int): maximum number of in-flight operations per connection
+    headers (dict): (optional) headers used to warm up the connections
+    health_check_interval (float): seconds between checks for dead connections
+    client_factory (function): (optional) a function taking an url and
+    returning a connected client. Defaults to a `GraphQLClient` which doesn't
+    reconnect on its own, since the pool replaces it; clients which do would
+    be replaced while they reconnect.
+    """
+    def __init__(self, url, size: int = 4, max_inflight: int = 100, headers: dict = None,
+                 health_check_interval: float = 1.0, client_factory: Callable = None):
+        if size < 1:
+            raise ValueError('the argument `size` should be at least 1')
+        if max_inflight < 1:
+            raise ValueError('the argument `max_inflight` should be at least 1')
+
+        if client_factory is None:
+            client_factory = functools.partial(
+                GraphQLClient, reconnect_policy=ReconnectPolicy(max_attempts=0))
+
+        self._urls = itertools.cycle([url] if isinstance(url, str) else list(url))
+        self._size = size
+        self._max_inflight = max_inflight
+        self._headers = headers
+        self._client_factory = client_factory
+        self._health_check_interval = health_check_interval
+        # guards the connections, the load counters and the subscriptions
+        self._lock = threading.Condition()
+        self._connections = []
+        # map of pool subscription id to the details needed to restart it
+        self._subscriptions = {}
+        self._closed = threading.Event()
+
+        for _ in range(size):
+            self._connections.append(self._open())
+
+        self._health_thread = threading.Thread(target=self._health_task, daemon=True)
+        self._health_thread.start()
+
+    def _open(self):
+        client = self._client_factory(next(self._urls))
+        # warm up the connection, so that operations don't pay for the init
+        client._connection_init(self._headers)
+        return _PooledConnection(client)
+
+    def _acquire(self):
+        with self._lock:
+            while True:
+                if self._closed.is_set():
+                    raise ConnectionException('The pool is closed')
+                live = [conn for conn in self._connections if conn.client.is_connected]
+                if not live:
+                    raise ConnectionException('No connection of the pool is connected')
+                candidates = [conn for conn in live if conn.inflight < self._max_inflight]
+                if candidates:
+                    conn = min(candidates, key=lambda c: c.inflight)
+                    conn.inflight += 1
+                    return conn
+                self._lock.wait()
+
+    def _release(self, conn):
+        with self._lock:
+            conn.inflight -= 1
+            self._lock.notify()
+
+    def _health_task(self):
+        while not self._closed.wait(self._health_check_interval):
+            try:
+                with self._lock:
+                    dead = [conn for conn in self._connections if not conn.client.is_connected]
+                for conn in dead:
+                    self._replace(conn)
+                self._restart_orphans()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Pool health check failed, will retry')
+
+    def _replace(self, dead):
+        logger.info('Replacing dead connection to %s', dead.client.ws_url)
+        try:
+            conn = self._open()
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning('Could not open a new connection, will retry: %s', err)
+            return
+
+        with self._lock:
+            self._connections[self._connections.index(dead)] = conn
+            subscriptions = [(sub_id, sub) for sub_id, sub in self._subscriptions.items()
+                             if sub['connection'] is dead]
+            self._lock.notify_all()
+
+        for sub_id, sub in subscriptions:
+            self._move_subscription(sub_id, sub, conn)
+
+        try:
+            dead.client.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    def _move_subscription(self, sub_id, sub, conn):
+        """ start a subscription on another connection, or leave it to be retried """
+        try:
+            self._start_subscription(sub_id, sub, conn)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning('Could not restart subscription %s, will retry: %s', sub_id, err)
+            with self._lock:
+                if sub['connection'] is not conn:
+                    # an orphan, without a connection
+                    sub['connection'] = None
+
+    def _restart_orphans(self):
+        """ retry the subscriptions which could not be restarted on a new connection """
+        with self._lock:
+            orphans = [(sub_id, sub) for sub_id, sub in self._subscriptions.items()
+                       if sub['connection'] is None]
+        for sub_id, sub in orphans:
+            with self._lock:
+                live = [conn for conn in self._connections if conn.client.is_connected]
+            if not live:
+                return
+            self._move_subscription(sub_id, sub, min(live, key=lambda c: c.inflight))
+
+    def _start_subscription(self, sub_id, sub, conn):
+        callback = sub['callback']
+
+        def pool_callback(_op_id, msg):
+            try:
+                callback(sub_id, msg)
+            finally:
+                if msg.get('type') in [GQL_COMPLETE, GQL_ERROR]:
+                    self._end_subscription(sub_id, sub, conn)
+
+        op_id = conn.client.subscribe(sub['query'], variables=sub['variables'],
+                                      headers=sub['headers'], callback=pool_callback)
+        with self._lock:
+            ended = sub['ended']
+            if not ended:
+                if sub['connection'] is not conn:
+                    conn.inflight += 1
+                sub['connection'] = conn
+                sub['op_id'] = op_id
+        if ended:
+            # it ended, or it was stopped, while moving to this connection
+            conn.client.stop_subscribe(op_id)
+        return op_id
+
+    def _end_subscription(self, sub_id, sub, conn):
+        """ forget a subscription which the server has ended, freeing its slot """
+        with self._lock:
+            if sub['ended']:
+                return
+            sub['ended'] = True
+            self._subscriptions.pop(sub_id, None)
+            # not counted yet, if it ended before `_start_subscription` returned
+            if sub['connection'] is conn:
+                conn.inflight -= 1
+                self._lock.notify()
+
+    def query(self, query: str, variables: dict = None, headers: dict = None,
+              timeout: float = None) -> dict:
+        """
+        Run a GraphQL query or mutation on the least loaded connection.
+        See `GraphQLClient.query`.
+        """
+        conn = self._acquire()
+        try:
+            return conn.client.query(query, variables=variables, headers=headers,
+                                     timeout=timeout)
+        finally:
+            self._release(conn)
+
+    def subscribe(self, query: str, variables: dict = None, headers: dict = None,
+                  callback: Callable[[str, dict], None] = None) -> str:
+        """
+        Run a GraphQL subscription on the least loaded connection. The
+        subscription counts towards the load of the connection until it is
+        stopped. See `GraphQLClient.subscribe`.
+
+        Returns:
+        op_id (str): The id of this subscription in the pool
+        """
+        if not callback or not callable(callback):
+            raise TypeError('the argument `callback` is mandatory and it should be a function')
+
+        conn = self._acquire()
+        sub = {'query': query, 'variables': variables, 'headers': headers,
+               'callback': callback, 'connection': conn, 'op_id': None, 'ended': False}
+        # the callback may fire before `subscribe` returns, so the pool id is
+        # allocated upfront
+        sub_id = uuid.uuid4().hex
+        try:
+            self._start_subscription(sub_id, sub, conn)
+        except Exception:
+            self._release(conn)
+            raise
+        with self._lock:
+            if not sub['ended']:
+                self._subscriptions[sub_id] = sub
+        return sub_id
+
+    def stop_subscribe(self, op_id: str) -> None:
+        """
+        Stop a subscription. Takes the id returned by `subscribe`.
+        """
+        with self._lock:
+            sub = self._subscriptions.pop(op_id, None)
+            if sub is not None:
+                sub['ended'] = True
+        if sub is None:
+            # the server has ended it already
+            return
+        conn = sub['connection']
+        if conn is None:
+            # an orphan, running nowhere
+            return
+        try:
+            conn.client.stop_subscribe(sub['op_id'])
+        finally:
+            self._release(conn)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Close all the connections in the pool, within about `timeout` seconds
+        in total, see `GraphQLClient.close`.
+        """
+        deadline = time.monotonic() + timeout
+        self._closed.set()
+        with self._lock:
+            connections = list(self._connections)
+            self._lock.notify_all()
+        self._health_thread.join()
+        for conn in connections:
+            conn.client.close(timeout=max(0.0, deadline - time.monotonic()))
+
+    def __enter__(self):
+        """ enter method for context manager """
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ exit method for context manager """
+        self.close()
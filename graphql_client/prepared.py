@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Operations prepared once and run many times. Preparing checks the syntax of
+the document, and encodes the parts of the messages which never change, so
+that running the operation only has to encode its variables.
+
+    get_user = client.prepare('query getUser($id: Int!) { user(id: $id) { name } }')
+    client.query(get_user, variables={'id': 1})
+"""
+
+import re
+
+from .cache import normalize_query
+
+_LEXER = re.compile(r'''
+    (?P<ignored>[\s,\ufeff]+|\#[^\n\r]*)
+  | (?P<block_string>"""(?:\\"""|[\s\S])*?""")
+  | (?P<string>"(?:[^"\\\n\r]|\\(?:["\\/bfnrt]|u[0-9A-Fa-f]{4}))*")
+  | (?P<spread>\.\.\.)
+  | (?P<punctuator>[!$&():=@\[\]{|}])
+  | (?P<number>-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)
+  | (?P<name>[_A-Za-z][_0-9A-Za-z]*)
+''', re.VERBOSE)
+
+_CLOSING = {'(': ')', '[': ']', '{': '}'}
+_OPERATION_TYPES = ('query', 'mutation', 'subscription')
+
+
+class GraphQLSyntaxError(ValueError):
+    """ Exception thrown when a GraphQL document can't be parsed """
+    def __init__(self, message, document, position):
+        self.line = document.count('\n', 0, position) + 1
+        self.column = position - (document.rfind('\n', 0, position) + 1) + 1
+        super().__init__(f'Syntax Error: {message} (line {self.line}, column {self.column})')
+
+
+def _tokenize(document):
+    """ the significant tokens of a document, as `(kind, text, position)` """
+    tokens = []
+    position = 0
+    while position < len(document):
+        match = _LEXER.match(document, position)
+        if match is None:
+            char = document[position]
+            if char == '"':
+                raise GraphQLSyntaxError('Unterminated string', document, position)
+            raise GraphQLSyntaxError(f'Unexpected character {char!r}', document, position)
+        if match.lastgroup != 'ignored':
+            tokens.append((match.lastgroup, match.group(), position))
+        position = match.end()
+    return tokens
+
+
+def _match_brackets(tokens, document):
+    """ map of the index of every opening bracket to the index of its closing one """
+    matches = {}
+    stack = []
+    for i, (kind, text, position) in enumerate(tokens):
+        if kind != 'punctuator':
+            continue
+        if text in _CLOSING:
+            stack.append(i)
+        elif text in (')', ']', '}'):
+            if not stack or _CLOSING[tokens[stack[-1]][1]] != text:
+                raise GraphQLSyntaxError(f'Unexpected {text!r}', document, position)
+            matches[stack.pop()] = i
+    if stack:
+        _, text, position = tokens[stack[-1]]
+        raise GraphQLSyntaxError(f'Unclosed {text!r}', document, position)
+    return matches
+
+
+def parse_operations(document: str) -> list:
+    """
+    Check the syntax of a document, at the level of its definitions: every
+    operation and fragment is well formed, and brackets are balanced. The
+    selections themselves are only lexed. Returns the `(type, name)` of
+    every operation, with a name of None for anonymous ones.
+    """
+    tokens = _tokenize(document)
+    if not tokens:
+        raise GraphQLSyntaxError('Unexpected end of document', document, len(document))
+    matches = _match_brackets(tokens, document)
+
+    def expect_selection_set(i):
+        if i >= len(tokens) or tokens[i][1] != '{':
+            position = tokens[i][2] if i < len(tokens) else len(document)
+            raise GraphQLSyntaxError('Expected a selection set', document, position)
+        if matches[i] == i + 1:
+            raise GraphQLSyntaxError('Expected a field', document, tokens[i + 1][2])
+        return matches[i] + 1
+
+    def skip_directives(i):
+        while i < len(tokens) and tokens[i][1] == '@':
+            if i + 1 >= len(tokens) or tokens[i + 1][0] != 'name':
+                raise GraphQLSyntaxError('Expected a directive name', document, tokens[i][2])
+            i += 2
+            if i < len(tokens) and tokens[i][1] == '(':
+                i = matches[i] + 1
+        return i
+
+    operations = []
+    i = 0
+    while i < len(tokens):
+        kind, text, position = tokens[i]
+        if text == '{':
+            operations.append(('query', None))
+            i = expect_selection_set(i)
+        elif kind == 'name' and text in _OPERATION_TYPES:
+            i += 1
+            name = None
+            if i < len(tokens) and tokens[i][0] == 'name':
+                name = tokens[i][1]
+                i += 1
+            if i < len(tokens) and tokens[i][1] == '(':
+                i = matches[i] + 1
+            i = expect_selection_set(skip_directives(i))
+            operations.append((text, name))
+        elif kind == 'name' and text == 'fragment':
+            if i + 3 >= len(tokens) or tokens[i + 1][0] != 'name' or tokens[i + 2][1] != 'on' \
+                    or tokens[i + 3][0] != 'name':
+                raise GraphQLSyntaxError('Expected `fragment Name on Type`', document, position)
+            i = expect_selection_set(skip_directives(i + 4))
+        else:
+            raise GraphQLSyntaxError(f'Unexpected {text!r}', document, position)
+    if not operations:
+        raise GraphQLSyntaxError('Expected an operation', document, 0)
+    return operations
+
+
+def _to_bytes(data):
+    return data.encode('utf-8') if isinstance(data, str) else bytes(data)
+
+
+class PreparedOperation():
+    """
+    An operation ready to be run with `GraphQLClient.query` or `subscribe`,
+    made with `GraphQLClient.prepare`.
+
+    Attributes:
+    document (str): the normalized document
+    operation_type (str): 'query', 'mutation' or 'subscription'
+    operation_name (str): the name of the operation, None if anonymous
+    """
+    __slots__ = ('document', 'operation_type', 'operation_name', '_send_name',
+                 '_encode', '_start_prefix', '_http_prefix')
+
+    def __init__(self, document: str, codec, operation_name: str = None):
+        operations = parse_operations(document)
+        if operation_name is None:
+            if len(operations) > 1:
+                raise ValueError('the document has many operations, '
+                                 'pass the `operation_name` of the one to run')
+            operation_type, operation_name = operations[0]
+            send_name = False
+        else:
+            types = {name: operation_type for operation_type, name in operations}
+            if operation_name not in types:
+                raise ValueError(f'no operation named {operation_name!r} in the document')
+            operation_type = types[operation_name]
+            send_name = len(operations) > 1
+
+        self.document = normalize_query(document)
+        self.operation_type = operation_type
+        self.operation_name = operation_name
+        self._send_name = send_name
+        self._encode = lambda value: _to_bytes(codec.encode(value))
+
+        static = b'"query":' + self._encode(self.document)
+        if send_name:
+            static += b',"operationName":' + self._encode(operation_name)
+        self._start_prefix = b'{"type":"start","payload":{' + static + b',"variables":'
+        self._http_prefix = b'{' + static + b',"variables":'
+
+    def payload(self, variables: dict = None, headers: dict = None) -> dict:
+        """ the payload of a `start` message running this operation """
+        payload = {'headers': headers, 'query': self.document, 'variables': variables}
+        if self._send_name:
+            payload['operationName'] = self.operation_name
+        return payload
+
+    def start_frame(self, op_id: str, variables: dict = None, headers: dict = None) -> bytes:
+        """ the encoded `start` message running this operation """
+        return b''.join((self._start_prefix, self._encode(variables), b',"headers":',
+                         self._encode(headers), b'},"id":', self._encode(op_id), b'}'))
+
+    def http_body(self, variables: dict = None) -> bytes:
+        """ the encoded body of an HTTP request running this operation """
+        return b''.join((self._http_prefix, self._encode(variables), b'}'))
+
+    def __repr__(self):
+        name = self.operation_name or '(anonymous)'
+        return f'<PreparedOperation {self.operation_type} {name}>'
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+A reactor: one thread reading the connections of many clients, instead of a
+receiver thread per client. The sockets are watched with `selectors` (epoll
+or kqueue where available), so the number of threads stays the same however
+many connections there are.
+
+    reactor = Reactor()
+    clients = [GraphQLClient(url, reactor=reactor) for url in urls]
+
+Subscription callbacks run on the reactor thread, so a slow one holds up
+every connection of the reactor; give such clients a `callback_executor`.
+Reconnecting is scheduled on the reactor's timers, and the (blocking)
+connection attempts run on a small pool of threads.
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from websocket import ABNF, WebSocketException
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# bytes read from a socket every time it is readable
+_RECV_SIZE = 262144
+
+
+class _FrameReader():
+    """ reassembles the websocket messages in a stream of bytes """
+    def __init__(self):
+        self._buffer = b''
+        self._fragments = []
+        self._fragments_opcode = None
+
+    def feed(self, data: bytes) -> list:
+        """ the complete messages so far, as `(opcode, payload)` """
+        if self._buffer:
+            data = self._buffer + data
+        messages = []
+        pos = 0
+        size = len(data)
+        while size - pos >= 2:
+            first, second = data[pos], data[pos + 1]
+            length = second & 0x7f
+            header = 2
+            if length == 126:
+                if size - pos < 4:
+                    break
+                length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+                header = 4
+            elif length == 127:
+                if size - pos < 10:
+                    break
+                length = int.from_bytes(data[pos + 2:pos + 10], 'big')
+                header = 10
+            masked = second & 0x80
+            if masked:
+                header += 4
+            end = pos + header + length
+            if end > size:
+                break
+            payload = data[pos + header:end]
+            if masked:
+                payload = ABNF.mask(data[pos + header - 4:pos + header], payload)
+            pos = end
+
+            opcode = first & 0x0f
+            if opcode >= ABNF.OPCODE_CLOSE:
+                # control frames can come in the middle of a fragmented message
+                messages.append((opcode, payload))
+            elif opcode == ABNF.OPCODE_CONT:
+                self._fragments.append(payload)
+                if first & 0x80:
+                    messages.append((self._fragments_opcode, b''.join(self._fragments)))
+                    self._fragments = []
+            elif first & 0x80:
+                messages.append((opcode, payload))
+            else:
+                self._fragments_opcode = opcode
+                self._fragments = [payload]
+        self._buffer = data[pos:]
+        return messages
+
+
+class _Timer():
+    """ a call scheduled on the reactor, see `Reactor.call_later` """
+    __slots__ = ('when', 'fn', 'args', 'cancelled')
+
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Reactor():
+    """
+    A thread serving the connections of many `GraphQLClient`s, passed to
+    them with their `reactor` argument. It also runs their timers, for
+    reconnecting and restarting subscriptions.
+
+    Parameters:
+    reconnect_workers (int): the most threads connecting at the same time,
+    started as clients need to reconnect
+    """
+    def __init__(self, reconnect_workers: int = 2):
+        self._selector = selectors.DefaultSelector()
+        # written to from other threads, to wake the reactor up for their calls
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
+        # calls from other threads, to run on the reactor thread
+        self._calls = collections.deque()
+        # heap of (time, sequence, timer)
+        self._timers = []
+        self._sequence = itertools.count()
+        self._reconnect_workers = reconnect_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='gql-reactor', daemon=True)
+        self._thread.start()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread.is_alive()
+
+    def in_reactor_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def call_soon(self, fn, *args) -> None:
+        """ run `fn(*args)` on the reactor thread; safe to call from any thread """
+        self._calls.append((fn, args))
+        try:
+            self._wakeup_writer.send(b'\0')
+        except OSError:
+            # the buffer is full, so the reactor is awake already
+            pass
+
+    def call_later(self, delay: float, fn, *args) -> _Timer:
+        """ run `fn(*args)` on the reactor thread in `delay` seconds; returns a cancellable timer """
+        timer = _Timer(time.monotonic() + delay, fn, args)
+        self.call_soon(self._add_timer, timer)
+        return timer
+
+    def run_blocking(self, fn, *args):
+        """ run a blocking `fn(*args)` on the workers, returns its future """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._reconnect_workers,
+                                                    thread_name_prefix='gql-reconnect')
+        return self._executor.submit(fn, *args)
+
+    def channel(self, client) -> '_Channel':
+        """ the channel reading the connections of a client """
+        return _Channel(self, client)
+
+    def stop(self, timeout: float = None) -> None:
+        """ stop the reactor thread; close its clients first """
+        self._stopping = True
+        self.call_soon(lambda: None)
+        if not self.in_reactor_thread():
+            self._thread.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def _add_timer(self, timer):
+        heapq.heappush(self._timers, (timer.when, next(self._sequence), timer))
+
+    def _register(self, sock, on_readable):
+        self._selector.register(sock, selectors.EVENT_READ, on_readable)
+
+    def _unregister(self, sock):
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _run(self):
+        try:
+            while not self._stopping:
+                self._run_once()
+        finally:
+            self._selector.close()
+            self._wakeup_reader.close()
+            self._wakeup_writer.close()
+
+    def _run_once(self):
+        if self._calls:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0.0, self._timers[0][0] - time.monotonic())
+        else:
+            timeout = None
+        for key, _ in self._selector.select(timeout):
+            if key.data is None:
+                self._drain_wakeups()
+            else:
+                self._call(key.data)
+
+        # only the calls queued so far; the ones they queue wait for the next round
+        for _ in range(len(self._calls)):
+            fn, args = self._calls.popleft()
+            self._call(fn, *args)
+
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self._call(timer.fn, *timer.args)
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def _call(fn, *args):
+        try:
+            fn(*args)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Reactor call %r raised', fn)
+
+
+class _Channel():
+    """
+    Reads the connection of one client on the reactor thread, and hands its
+    messages to the client. When the connection is lost, it fails the
+    client's queries and reconnects it, as the receiver thread of a client
+    does.
+    """
+    def __init__(self, reactor, client):
+        self._reactor = reactor
+        self._client = client
+        self._sock = None
+        self._reader = None
+        self._resubscribe_timer = None
+        # whether the client's connection is served, or being registered
+        self.attached = False
+
+    def attach(self) -> None:
+        """ start serving the current connection of the client """
+        self.attached = True
+        self._reactor.call_soon(self._register, self._client._connection.sock)
+
+    def detach(self, timeout: float = None) -> None:
+        """ stop serving the connection, waiting up to `timeout` seconds for the reactor """
+        self.attached = False
+        if self._reactor.in_reactor_thread():
+            self._unregister()
+            return
+        detached = threading.Event()
+
+        def detach():
+            self._unregister()
+            detached.set()
+
+        self._reactor.call_soon(detach)
+        detached.wait(timeout)
+
+    def _register(self, sock):
+        if not self.attached or self._client._shutdown_receiver.is_set():
+            return
+        self._sock = sock
+        self._reader = _FrameReader()
+        # a readable socket may hold only part of a TLS record; reading it
+        # must not block the reactor until the rest arrives
+        sock.setblocking(False)
+        self._reactor._register(sock, self._on_readable)
+        if self._client._pending_resubscribes:
+            self._resubscribe()
+
+    def _unregister(self):
+        if self._resubscribe_timer is not None:
+            self._resubscribe_timer.cancel()
+            self._resubscribe_timer = None
+        if self._sock is not None:
+            self._reactor._unregister(self._sock)
+            try:
+                # websocket-client expects it blocking, to close it
+                self._sock.settimeout(None)
+            except OSError:
+                pass
+            self._sock = None
+
+    def _on_readable(self):
+        sock = self._sock
+        try:
+            data = sock.recv(_RECV_SIZE)
+            # an SSL socket can hold decrypted data which the selector can't see
+            while data and isinstance(sock, ssl.SSLSocket) and sock.pending():
+                data += sock.recv(sock.pending())
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._lost()
+            return
+
+        client = self._client
+        for opcode, payload in self._reader.feed(data):
+            if opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                try:
+                    client._handle_frame(payload)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Failed to handle a message from %s', client.ws_url)
+            elif opcode == ABNF.OPCODE_PING:
+                client._pong(payload)
+            elif opcode == ABNF.OPCODE_CLOSE:
+                self._lost()
+                return
+
+    def _lost(self):
+        self._unregister()
+        self.attached = False
+        client = self._client
+        if client._shutdown_receiver.is_set():
+            return
+        client._connection_lost()
+        if client._reconnect_policy.should_retry(0):
+            self._reactor.call_later(client._reconnect_policy.delay(0), self._attempt, 0)
+
+    def _attempt(self, attempt):
+        if self._client._shutdown_receiver.is_set():
+            return
+        future = self._reactor.run_blocking(self._client._reopen)
+        future.add_done_callback(
+            lambda future: self._reactor.call_soon(self._attempted, attempt, future))
+
+    def _attempted(self, attempt, future):
+        client = self._client
+        exc = future.exception()
+        if client._shutdown_receiver.is_set():
+            # the client was closed meanwhile
+            if exc is None:
+                client._connection.close()
+            return
+        if exc is not None:
+            attempt += 1
+            logger.warning('Reconnect attempt %d to %s failed: %s', attempt, client.ws_url, exc)
+            policy = client._reconnect_policy
+            if policy.should_retry(attempt):
+                self._reactor.call_later(policy.delay(attempt), self._attempt, attempt)
+            else:
+                logger.error('Giving up reconnecting to %s after %d attempts',
+                             client.ws_url, attempt)
+            return
+        client._reconnected()
+        self.attached = True
+        self._register(client._connection.sock)
+
+    def _resubscribe(self):
+        self._resubscribe_timer = None
+        if self._sock is None:
+            return
+        try:
+            wait = self._client._resubscribe_some()
+        except (OSError, WebSocketException) as exc:
+            # the read side notices the lost connection
+            logger.debug('Failed to restart subscriptions: %s', exc)
+            return
+        if wait is not None:
+            self._resubscribe_timer = self._reactor.call_later(wait, self._resubscribe)
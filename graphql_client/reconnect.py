@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+How a client reconnects after it loses the connection to the server: how
+long it waits between attempts, when it gives up, and how fast it starts its
+subscriptions again once it is back.
+"""
+
+import random
+import time
+
+
+class ReconnectPolicy():
+    """
+    Exponential backoff with jitter for reconnecting, and a rate limit for
+    restarting subscriptions afterwards. Without the jitter and the rate
+    limit, all the clients of a restarting server would come back and
+    resubscribe at the same instant, and knock it over again.
+
+    Parameters:
+    initial_delay (float): seconds to wait before the first attempt
+    max_delay (float): the longest wait between two attempts, in seconds
+    multiplier (float): how much the wait grows after every failed attempt
+    jitter (float): between 0 and 1, the fraction of each wait which is
+    randomized. With 1, the wait is anywhere between 0 and the full delay.
+    max_attempts (int): give up after these many failed attempts in a row;
+    None to keep trying forever
+    resubscribe_rate (float): restart at most these many subscriptions per
+    second after reconnecting; None for no limit
+    resubscribe_burst (int): how many subscriptions can be restarted at once,
+    before the rate limit kicks in
+    connect_timeout (float): seconds to wait for the server while connecting
+    and during `connection_init`
+    """
+    def __init__(self, initial_delay: float = 0.5, max_delay: float = 30.0,
+                 multiplier: float = 2.0, jitter: float = 0.5, max_attempts: int = None,
+                 resubscribe_rate: float = 100.0, resubscribe_burst: int = 10,
+                 connect_timeout: float = 10.0):
+        if not 0 <= jitter <= 1:
+            raise ValueError('the argument `jitter` should be between 0 and 1')
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.resubscribe_rate = resubscribe_rate
+        self.resubscribe_burst = resubscribe_burst
+        self.connect_timeout = connect_timeout
+
+    def delay(self, attempt: int) -> float:
+        """ seconds to wait before the `attempt`-th attempt (counting from 0) """
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def should_retry(self, attempt: int) -> bool:
+        """ whether to make the `attempt`-th attempt (counting from 0) """
+        return self.max_attempts is None or attempt < self.max_attempts
+
+    def rate_limiter(self) -> 'TokenBucket':
+        """ a fresh rate limiter for restarting subscriptions """
+        return TokenBucket(self.resubscribe_rate, self.resubscribe_burst)
+
+
+class TokenBucket():
+    """
+    A token bucket: `take` hands out up to `burst` tokens at once, refilled at
+    `rate` tokens per second. A `rate` of None never runs out.
+    """
+    def __init__(self, rate: float = None, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def take(self, wanted: int) -> int:
+        """ take up to `wanted` tokens, returns how many were taken """
+        if self.rate is None:
+            return wanted
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        taken = min(wanted, int(self._tokens))
+        self._tokens -= taken
+        return taken
+
+    def wait_time(self) -> float:
+        """ seconds until the next token is available """
+        if self.rate is None or self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+A normalized store of the objects seen in query results and subscription
+messages, in the style of Apollo's `InMemoryCache`: every object with a
+`__typename` and an `id` is kept once, as an entity, and results refer to it.
+A subscription message updating an entity updates every result which
+contains it.
+
+    client = GraphQLClient(url, store=EntityStore())
+    client.query(query)                  # asks the server
+    client.query(query)                  # answered from the store
+    client.store.entity('User', 2)
+"""
+
+import collections
+import json
+import threading
+
+from .cache import normalize_query
+
+
+class _Ref():
+    """ a reference to an entity of the store """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return isinstance(other, _Ref) and other.key == self.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f'_Ref({self.key!r})'
+
+
+class _Missing(Exception):
+    """ the store doesn't have everything a result needs """
+
+
+class EntityStore():
+    """
+    Keeps the entities of query results and subscription data normalized,
+    keyed by `__typename` and `id` (ask for `__typename` in your queries).
+
+    The results of queries are kept as the shape of the response (which
+    fields were selected) pointing to the entities, so that asking the same
+    query again is answered from the current state of the entities. If an
+    entity (or a field of it) is gone, the query goes to the server again.
+
+    Fields are stored by their response key, ignoring their arguments:
+    selecting one field of an entity with different arguments in different
+    queries overwrites it.
+
+    Parameters:
+    id_fields (list): the fields identifying an entity, the first one an
+    object has is used. Objects with none of them are stored inline.
+    max_queries (int): the most query results kept, least recently used first
+    out
+    """
+    def __init__(self, id_fields=('id',), max_queries: int = 1024):
+        self._id_fields = tuple(id_fields)
+        self._max_queries = max_queries
+        self._lock = threading.RLock()
+        # map of `typename:id` to the fields of the entity
+        self._entities = {}
+        # map of query key to (normalized data, selection), least recently used first
+        self._queries = collections.OrderedDict()
+
+    @staticmethod
+    def query_key(query: str, variables: dict = None, headers: dict = None,
+                  operation_name: str = None) -> tuple:
+        """ the key of a query result in the store, for its operation named `operation_name` """
+        return (normalize_query(query),
+                json.dumps(variables, sort_keys=True, default=str) if variables else '',
+                json.dumps(headers, sort_keys=True, default=str) if headers else '',
+                operation_name or '')
+
+    def _entity_key(self, obj):
+        typename = obj.get('__typename')
+        if typename is None:
+            return None
+        for field in self._id_fields:
+            value = obj.get(field)
+            if value is not None:
+                return f'{typename}:{value}'
+        return None
+
+    def _normalize(self, value):
+        """ merge the entities in `value` into the store; returns `(normalized, selection)` """
+        if isinstance(value, list):
+            normalized, selections = [], []
+            for item in value:
+                item, selection = self._normalize(item)
+                normalized.append(item)
+                selections.append(selection)
+            return normalized, selections
+        if not isinstance(value, dict):
+            return value, None
+
+        fields, selection = {}, {}
+        for name, field_value in value.items():
+            fields[name], selection[name] = self._normalize(field_value)
+        key = self._entity_key(value)
+        if key is None:
+            return fields, selection
+        self._entities.setdefault(key, {}).update(fields)
+        return _Ref(key), selection
+
+    def _denormalize(self, value, selection):
+        if selection is None:
+            # this was a scalar (or null) when the result was stored
+            if isinstance(value, (_Ref, dict, list)):
+                raise _Missing()
+            return value
+        if isinstance(value, _Ref):
+            fields = self._entities.get(value.key)
+            if fields is None:
+                raise _Missing(value.key)
+            value = fields
+        if value is None:
+            return None
+        if isinstance(selection, list):
+            if not isinstance(value, list) or len(value) != len(selection):
+                raise _Missing()
+            return [self._denormalize(item, sel) for item, sel in zip(value, selection)]
+        if not isinstance(value, dict):
+            raise _Missing()
+        try:
+            return {name: self._denormalize(value[name], sel) for name, sel in selection.items()}
+        except KeyError:
+            raise _Missing() from None
+
+    def merge(self, data: dict) -> None:
+        """ merge the entities of a result (or subscription data) into the store """
+        with self._lock:
+            self._normalize(data)
+
+    def write_query(self, query: str, variables: dict, headers: dict, data: dict,
+                    operation_name: str = None) -> None:
+        """ store the `data` of a query result, and merge its entities """
+        key = self.query_key(query, variables, headers, operation_name)
+        with self._lock:
+            self._queries[key] = self._normalize(data)
+            self._queries.move_to_end(key)
+            while len(self._queries) > self._max_queries:
+                self._queries.popitem(last=False)
+
+    def read_query(self, query: str, variables: dict = None, headers: dict = None,
+                   operation_name: str = None):
+        """ the `data` of a query from the store, or None if it can't be answered """
+        key = self.query_key(query, variables, headers, operation_name)
+        with self._lock:
+            stored = self._queries.get(key)
+            if stored is None:
+                return None
+            try:
+                data = self._denormalize(*stored)
+            except _Missing:
+                del self._queries[key]
+                return None
+            self._queries.move_to_end(key)
+            return data
+
+    def entity(self, typename: str, entity_id) -> dict:
+        """ the fields of an entity (nested entities as `{'__ref': key}`), or None """
+        with self._lock:
+            fields = self._entities.get(f'{typename}:{entity_id}')
+            if fields is None:
+                return None
+            return {name: _export(value) for name, value in fields.items()}
+
+    def evict(self, typename: str, entity_id) -> bool:
+        """ drop an entity; the queries which need it go to the server again """
+        with self._lock:
+            return self._entities.pop(f'{typename}:{entity_id}', None) is not None
+
+    def clear(self) -> None:
+        """ drop everything """
+        with self._lock:
+            self._entities.clear()
+            self._queries.clear()
+
+    def __len__(self):
+        """ number of entities """
+        return len(self._entities)
+
+
+def _export(value):
+    if isinstance(value, _Ref):
+        return {'__ref': value.key}
+    if isinstance(value, list):
+        return [_export(item) for item in value]
+    if isinstance(value, dict):
+        return {name: _export(item) for name, item in value.items()}
+    return value
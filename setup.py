@@ -12,6 +12,15 @@ requirements = [
     'websocket-client==0.54.0'
 ]
 
+extras_requirements = {
+    'asyncio': ['websockets>=10.0'],
+    'orjson': ['orjson'],
+    'msgspec': ['msgspec'],
+    'prometheus': ['prometheus_client'],
+    'http2': ['httpx[http2]'],
+    'brotli': ['brotli'],
+}
+
 test_requirements = []
 
 setup(
@@ -23,12 +32,13 @@ setup(
     author="Anon Ray",
     author_email='rayanon004@gmail.com',
     url='https://github.com/ecthiender/py-graphql-client',
-    packages=find_packages(exclude=['tests', 'tests.*']),
+    packages=find_packages(exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*']),
     package_data={'': ['LICENSE']},
     package_dir={'graphql_client': 'graphql_client'},
     python_requires=">=3.4",
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="BSD3",
     zip_safe=False,
     keywords=['graphql', 'websocket', 'subscriptions', 'graphql-client'],
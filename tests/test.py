@@ -1,10 +1,36 @@
 import time
 import json
+import gzip
+import hashlib
+import socket
+import http.server
+import importlib.util
+import queue
+import asyncio
 import threading
 import unittest
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 
 from .websocket_server import WebsocketServer
 from graphql_client import *
+from graphql_client.buffer import OperationBuffer
+from graphql_client.reconnect import TokenBucket
+from graphql_client.dispatch import CallbackDispatcher
+from graphql_client.batch import Batcher
+from graphql_client.cache import QueryCache, normalize_query, is_mutation
+from graphql_client.store import EntityStore
+from graphql_client.prepared import PreparedOperation, parse_operations
+from graphql_client.codec import get_codec, LazyPayload
+from graphql_client.metrics import (
+    InMemorySink, FIRST_DATA_SECONDS, COMPLETE_SECONDS, CALLBACK_SECONDS,
+    FRAMES_SENT, BYTES_RECEIVED,
+)
+from graphql_client.aio import AsyncGraphQLClient
+from graphql_client.http_transport import HTTPTransport
+from graphql_client.reactor import Reactor, _FrameReader
+from benchmarks import cases as benchmark_cases
+from benchmarks.results import make_run, compare_runs
+from benchmarks.server import BenchmarkServer
 
 # The protocol:
 # https://github.com/apollographql/subscriptions-transport-ws/blob/master/PROTOCOL.md
@@ -28,7 +54,8 @@ def message_received(client, server, message):
     # print("[TEST_SERVER] => Client(%d) said: %s" % (client['id'], message))
     frame = json.loads(message)
     response = mock_server(frame)
-    response.send(client, server)
+    if response:
+        response.send(client, server)
 
 
 class GQLResponse():
@@ -56,13 +83,40 @@ class GQLResponse():
             server.send_message(client, json.dumps(self.payload))
 
 
+# documents registered as automatic persisted queries, by their hash
+persisted_queries = {}
+# the payloads of all the `start` messages received
+received_starts = []
+
+
+def persisted_query_not_found(op_id):
+    return GQLResponse([
+        {'id': op_id, 'type': GQL_DATA,
+         'payload': {'errors': [{'message': 'PersistedQueryNotFound'}]}},
+        {'id': op_id, 'type': GQL_COMPLETE}
+    ], time_between=0.1)
+
+
 def mock_server(frame):
     if frame['type'] == GQL_CONNECTION_INIT:
         return GQLResponse({'type': GQL_CONNECTION_ACK})
 
     elif frame['type'] == GQL_START:
         op_id = frame['id']
-        if frame['payload']['query'].strip().startswith('subscription'):
+        received_starts.append(frame['payload'])
+        query = frame['payload'].get('query')
+        persisted = frame['payload'].get('extensions', {}).get('persistedQuery')
+        if persisted and query is None:
+            query = persisted_queries.get(persisted['sha256Hash'])
+            if query is None:
+                return persisted_query_not_found(op_id)
+        elif persisted:
+            persisted_queries[persisted['sha256Hash']] = query
+
+        if 'noAnswer' in query:
+            return None
+
+        if query.strip().startswith('subscription'):
             return GQLResponse([
                 {'id': op_id, 'type': GQL_DATA, 'payload': {'data': {'msg': 'hello world'}}},
                 {'id': op_id, 'type': GQL_DATA, 'payload': {'data': {'msg': 'hello world'}}},
@@ -106,10 +160,21 @@ class ApolloProtocolServer():
         self.is_running = True
         # print('[TEST_SERVER] => [DEBUG] => end of start server..')
 
+    def drop_clients(self):
+        """ abruptly close the connections of all the clients """
+        for client in list(self.server.clients):
+            try:
+                client['handler'].request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
     def stop_server(self):
         # print('[TEST_SERVER] => [DEBUG] => inside stop server..')
         if self.is_running:
             self.is_running = False
+            # stop serving before closing, or the serving thread keeps polling
+            # the closed socket's fd, which a later server may get
+            self.server.shutdown()
             # print('[TEST_SERVER] => [DEBUG] => calling server_close..')
             self.server.server_close()
             # print('[TEST_SERVER] => [DEBUG] => called server_close..')
@@ -118,6 +183,75 @@ class ApolloProtocolServer():
             # print('[TEST_SERVER] => [DEBUG] => called thread.join..')
 
 
+class GraphQLHTTPHandler(http.server.BaseHTTPRequestHandler):
+    """
+    answers every POSTed query (or array of queries), remembering the client
+    ports it saw and counting the requests
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _answer(self, request):
+        return {'data': {'msg': 'hello world', 'variables': request.get('variables'),
+                         'port': self.server.server_port}}
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.client_ports.add(self.client_address[1])
+        self.server.requests += 1
+        self.server.bodies.append(request)
+        requests = request if isinstance(request, list) else [request]
+        if any('noAnswer' in item.get('query', '') for item in requests):
+            time.sleep(1)
+            self.close_connection = True
+            return
+        if any('dropConnection' in item.get('query', '') for item in requests):
+            # ran it, but the connection drops before the answer
+            self.close_connection = True
+            return
+        # answers, then closes the connection without telling the client
+        self.close_connection = any('closeConnection' in item.get('query', '')
+                                    for item in requests)
+        persisted = request.get('extensions', {}).get('persistedQuery') \
+            if isinstance(request, dict) else None
+        if persisted and 'query' not in request \
+                and persisted['sha256Hash'] not in self.server.persisted_queries:
+            body = json.dumps({'errors': [{'message': 'PersistedQueryNotFound'}]}).encode()
+        elif persisted:
+            self.server.persisted_queries.add(persisted['sha256Hash'])
+            body = json.dumps(self._answer(request)).encode()
+        elif isinstance(request, list):
+            body = json.dumps([self._answer(r) for r in request]).encode()
+        else:
+            body = json.dumps(self._answer(request)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GraphQLHTTPServer():
+    def __init__(self, port):
+        self.server = http.server.ThreadingHTTPServer(('localhost', port), GraphQLHTTPHandler)
+        self.server.daemon_threads = True
+        self.server.client_ports = set()
+        self.server.requests = 0
+        self.server.bodies = []
+        self.server.persisted_queries = set()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 query = """
 query getUser($userId: Int!) {
   user (id: $userId) {
@@ -136,6 +270,12 @@ subscription getUser($userId: Int!) {
 }
 """
 
+
+def only_data(msg):
+    """ a `transform` of the multiprocess subscriber, run in its workers """
+    return msg if msg['type'] == GQL_DATA else None
+
+
 class TestClient(unittest.TestCase):
 
     def __init__(self, *args, **kwargs):
@@ -179,6 +319,80 @@ class TestClient(unittest.TestCase):
             # print('[TEST] => Got response inside the test', res)
             self.assertTrue(res['type'] == GQL_DATA)
 
+    def test_concurrent_queries(self):
+        results = []
+        def run_query(user_id):
+            results.append(self.client.query(query, variables={'userId': user_id}))
+
+        threads = [threading.Thread(target=run_query, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        self.assertEqual(len(results), 4)
+        for res in results:
+            self.assertEqual(res['type'], GQL_DATA)
+
+    def test_batched_queries(self):
+        results = []
+        def run_query(client, user_id):
+            results.append(client.query(query, variables={'userId': user_id}))
+
+        with GraphQLClient('ws://localhost:9001', batch_window=0.2) as client:
+            client.query(query, variables={'userId': 0})
+            threads = [threading.Thread(target=run_query, args=(client, i)) for i in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len({res['id'] for res in results}), 3)
+        for res in results:
+            self.assertEqual(res['type'], GQL_DATA)
+
+    def test_persisted_queries(self):
+        with GraphQLClient('ws://localhost:9001', persisted_queries=True) as client:
+            res = client.query(query, variables={'userId': 2})
+            self.assertEqual(res['payload']['data'], {'msg': 'hello world'})
+            self.assertIn('query', received_starts[-1])
+            res = client.query(query, variables={'userId': 2})
+            self.assertEqual(res['payload']['data'], {'msg': 'hello world'})
+            self.assertNotIn('query', received_starts[-1])
+            # the server forgot it
+            persisted_queries.clear()
+            res = client.query(query, variables={'userId': 2})
+            self.assertEqual(res['payload']['data'], {'msg': 'hello world'})
+            self.assertIn('query', received_starts[-1])
+
+    def test_prepared(self):
+        get_user = self.client.prepare(query)
+        for user_id in range(2):
+            res = self.client.query(get_user, variables={'userId': user_id})
+            self.assertEqual(res['type'], GQL_DATA)
+        self.assertEqual(received_starts[-1],
+                         {'query': get_user.document, 'variables': {'userId': 1}, 'headers': None})
+
+        all_datas = []
+        sub_id = self.client.subscribe(self.client.prepare(subscription), variables={'userId': 2},
+                                       callback=lambda op_id, data: all_datas.append(data))
+        time.sleep(3)
+        self.client.stop_subscribe(sub_id)
+        self.assertEqual([data['type'] for data in all_datas], [GQL_DATA] * 3 + [GQL_COMPLETE])
+        self.assertRaises(GraphQLSyntaxError, self.client.prepare, 'query { user { id }')
+
+    def test_op_ids(self):
+        op_ids = []
+        sub_id = self.client.subscribe(subscription, callback=lambda op_id, data: None)
+        self.client.stop_subscribe(sub_id)
+        op_ids.append(self.client.query(query, variables={'userId': 2})['id'])
+        self.assertEqual([sub_id] + op_ids, ['1', '2'])
+
+        with GraphQLClient('ws://localhost:9001', op_id_factory=uuid_op_id) as client:
+            res = client.query(query, variables={'userId': 2})
+            self.assertEqual(len(res['id']), 32)
+
     def test_multiple_subscriptions(self):
         op_ids1 = []
         op_ids2 = []
@@ -221,6 +435,281 @@ class TestClient(unittest.TestCase):
 
         self.assertEqual(all_datas2[-1]['type'], GQL_COMPLETE)
 
+    def test_buffered_subscription(self):
+        sub_id = self.client.subscribe(subscription, variables={'userId': 2},
+                                       buffer_size=2, overflow=OVERFLOW_DROP_OLDEST)
+        # wait for the subscription to finish, while nobody consumes it
+        time.sleep(2.5)
+
+        msgs = [self.client.receive(sub_id, timeout=1) for _ in range(3)]
+        self.client.stop_subscribe(sub_id)
+
+        self.assertEqual([msg['type'] for msg in msgs], [GQL_DATA, GQL_DATA, GQL_COMPLETE])
+
+    def test_stop_blocked_subscription(self):
+        sub_id = self.client.subscribe(subscription, variables={'userId': 2},
+                                       buffer_size=1, overflow=OVERFLOW_BLOCK)
+        # nobody consumes it: the receiver waits for room for the second message
+        time.sleep(0.8)
+        self.client.stop_subscribe(sub_id)
+        self.assertEqual(self.client.query(query, timeout=2)['type'], GQL_DATA)
+
+    def test_subscribe_batches(self):
+        with self.client.subscribe_batches(subscription, variables={'userId': 2},
+                                           max_items=2, max_wait=5) as batches:
+            # the batch is full before `max_wait`, and the complete ends the last one
+            payloads = list(batches)
+        self.assertEqual([len(batch) for batch in payloads], [2, 1])
+        self.assertEqual(payloads[0][0], {'data': {'msg': 'hello world'}})
+        self.assertNotIn(batches.op_id, self.client._subscriber_queues)
+
+        batches = self.client.subscribe_iter(subscription, variables={'userId': 2})
+        self.assertEqual(len(next(batches)), 1)
+        batches.close()
+        self.assertRaises(StopIteration, next, batches)
+        self.assertNotIn(batches.op_id, self.client._subscriber_queues)
+
+    def test_slow_callback_does_not_block_query(self):
+        client = GraphQLClient('ws://localhost:9001', callback_executor=2)
+        try:
+            slow = threading.Event()
+            def slow_callback(op_id, data):
+                slow.wait(5)
+
+            sub_id = client.subscribe(subscription, variables={'userId': 2}, callback=slow_callback)
+            time.sleep(0.2)
+            started = time.monotonic()
+            res = client.query(query, variables={'userId': 2})
+            self.assertEqual(res['type'], GQL_DATA)
+            self.assertLess(time.monotonic() - started, 4)
+            slow.set()
+            client.stop_subscribe(sub_id)
+        finally:
+            client.close()
+
+    def test_close(self):
+        client = GraphQLClient('ws://localhost:9001')
+        sub_id = client.subscribe(subscription, buffer_size=10)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(client.query, '{ noAnswer }')
+            time.sleep(0.3)
+            started = time.monotonic()
+            client.close(timeout=0.5)
+            self.assertLess(time.monotonic() - started, 1.5)
+            self.assertRaises(ConnectionException, future.result, timeout=1)
+        self.assertFalse(client._recevier_thread.is_alive())
+        # the buffered messages are still there, then the subscription fails
+        self.assertEqual(client.receive(sub_id, timeout=1)['type'], GQL_DATA)
+        with self.assertRaises(ConnectionException):
+            while True:
+                client.receive(sub_id, timeout=1)
+        self.assertRaises(ConnectionException, client.query, query)
+
+    def test_close_stuck_callback(self):
+        client = GraphQLClient('ws://localhost:9001', callback_executor=1)
+        release = threading.Event()
+        called = threading.Event()
+
+        def stuck(op_id, msg):
+            called.set()
+            release.wait(10)
+
+        client.subscribe(subscription, callback=stuck)
+        self.assertTrue(called.wait(5))
+        started = time.monotonic()
+        client.close(timeout=0.5)
+        self.assertLess(time.monotonic() - started, 1.5)
+        release.set()
+
+    def test_close_blocked_receiver(self):
+        client = GraphQLClient('ws://localhost:9001')
+        client.subscribe(subscription, variables={'userId': 2},
+                         buffer_size=1, overflow=OVERFLOW_BLOCK)
+        # nobody consumes it: the receiver waits for room for the second message
+        time.sleep(0.8)
+        started = time.monotonic()
+        client.close(timeout=1)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertFalse(client._recevier_thread.is_alive())
+        self.assertTrue(client._recevier_thread.daemon)
+
+    def test_query_timeout(self):
+        with self.assertRaises(QueryTimeoutException):
+            self.client.query('{ noAnswer }', timeout=0.3)
+        self.assertEqual(self.client._queries_in_flight, 0)
+        self.assertEqual(self.client.debug_snapshot()['operations'], {})
+        self.assertEqual(self.client.query(query, timeout=5)['type'], GQL_DATA)
+
+        with GraphQLClient('ws://localhost:9001', query_timeout=0.3) as client:
+            self.assertRaises(QueryTimeoutException, client.query, '{ noAnswer }')
+
+        # another thread is in the middle of a `connection_init`, or of reconnecting
+        self.client._connection_init_done = False
+        with self.client._init_lock:
+            started = time.monotonic()
+            self.assertRaises(QueryTimeoutException, self.client.query, query, timeout=0.3)
+            self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.client.query(query, timeout=5)['type'], GQL_DATA)
+
+    def test_cancel_query(self):
+        handle = self.client.start_query(query, variables={'userId': 2})
+        self.assertEqual(handle.result()['type'], GQL_DATA)
+        self.assertFalse(handle.cancel())
+
+        handle = self.client.start_query('{ noAnswer }')
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(handle.result)
+            time.sleep(0.2)
+            self.assertTrue(handle.cancel())
+            self.assertRaises(CancelledError, future.result, timeout=1)
+        self.assertRaises(CancelledError, handle.result)
+        self.assertFalse(handle.cancel())
+        self.assertEqual(self.client._queries_in_flight, 0)
+        self.assertNotIn(handle.op_id, self.client.debug_snapshot()['operations'])
+
+    def test_debug_snapshot(self):
+        sub_id = self.client.subscribe(subscription, variables={'userId': 2}, buffer_size=10)
+        time.sleep(1)
+        snapshot = self.client.debug_snapshot()
+        self.client.stop_subscribe(sub_id)
+
+        self.assertTrue(snapshot['connected'])
+        self.assertGreaterEqual(snapshot['counters']['frames_sent'], 2)
+        self.assertGreaterEqual(snapshot['counters']['frames_received'], 2)
+        self.assertGreaterEqual(snapshot['operations'][sub_id]['buffered'], 1)
+        self.assertFalse(snapshot['operations'][sub_id]['has_callback'])
+
+    def test_metrics(self):
+        sink = InMemorySink()
+        with GraphQLClient('ws://localhost:9001', metrics=sink) as client:
+            client.query(query, variables={'userId': 2})
+            client.query(client.prepare('query A { a } query B { b }', 'B'))
+            sub_id = client.subscribe(subscription, variables={'userId': 2},
+                                      callback=lambda op_id, data: None)
+            time.sleep(3.5)
+            client.stop_subscribe(sub_id)
+
+        snapshot = sink.snapshot()
+        histograms = snapshot['histograms']
+        self.assertEqual(histograms[(FIRST_DATA_SECONDS, (('operation', 'getUser'),))]['count'], 2)
+        self.assertEqual(histograms[(COMPLETE_SECONDS, (('operation', 'getUser'),))]['count'], 2)
+        self.assertEqual(histograms[(CALLBACK_SECONDS, (('operation', 'getUser'),))]['count'], 4)
+        # labelled with the operation which ran, not the first in the document
+        self.assertEqual(histograms[(COMPLETE_SECONDS, (('operation', 'B'),))]['count'], 1)
+        self.assertNotIn((COMPLETE_SECONDS, (('operation', 'A'),)), histograms)
+        self.assertGreaterEqual(snapshot['counters'][(FRAMES_SENT, ())], 3)
+        self.assertGreater(snapshot['counters'][(BYTES_RECEIVED, ())], 0)
+
+    def test_reconnect(self):
+        policy = ReconnectPolicy(initial_delay=0.1, jitter=0)
+        op_ids = []
+        all_datas = []
+        def my_callback(op_id, data):
+            op_ids.append(op_id)
+            all_datas.append(data)
+
+        with GraphQLClient('ws://localhost:9001', reconnect_policy=policy) as client:
+            sub_id = client.subscribe(subscription, variables={'userId': 2}, callback=my_callback)
+            stopped_id = client.subscribe(subscription, variables={'userId': 3},
+                                          callback=my_callback)
+            client.stop_subscribe(stopped_id)
+            time.sleep(0.2)
+            self.ws_server.drop_clients()
+            time.sleep(3)
+            res = client.query(query, variables={'userId': 2})
+            reconnects = client.counters['reconnects']
+
+        self.assertEqual(reconnects, 1)
+        self.assertEqual(res['type'], GQL_DATA)
+        # only the live subscription was restarted, with the same id, and it
+        # ran to completion
+        self.assertEqual(set(op_ids), {sub_id})
+        self.assertEqual(all_datas[-1]['type'], GQL_COMPLETE)
+
+    def test_reconnect_while_resubscribing(self):
+        policy = ReconnectPolicy(initial_delay=0.1, jitter=0)
+        msgs = []
+        with GraphQLClient('ws://localhost:9001', reconnect_policy=policy) as client:
+            send_batch = client._send_batch
+
+            def drop_while_resubscribing(frames):
+                # the server drops the new connection as the subscriptions restart
+                client._send_batch = send_batch
+                client._connection.sock.shutdown(socket.SHUT_RDWR)
+                raise BrokenPipeError('connection dropped')
+
+            sub_id = client.subscribe(subscription, variables={'userId': 2},
+                                      callback=lambda op_id, msg: msgs.append(msg))
+            time.sleep(0.2)
+            client._send_batch = drop_while_resubscribing
+            self.ws_server.drop_clients()
+            time.sleep(3.5)
+            self.assertTrue(client.is_connected)
+            reconnects = client.counters['reconnects']
+
+        self.assertEqual(reconnects, 2)
+        self.assertEqual({msg['id'] for msg in msgs}, {sub_id})
+        self.assertEqual(msgs[-1]['type'], GQL_COMPLETE)
+
+    def test_shared_subscriptions(self):
+        received = {}
+        def my_callback(op_id, data):
+            received.setdefault(op_id, []).append(data)
+
+        with GraphQLClient('ws://localhost:9001', share_subscriptions=True) as client:
+            sub_id1 = client.subscribe(subscription, variables={'userId': 2}, callback=my_callback)
+            sub_id2 = client.subscribe(subscription, variables={'userId': 2}, callback=my_callback)
+            other_id = client.subscribe(subscription, variables={'userId': 3}, callback=my_callback)
+            # one server operation per distinct subscription
+            self.assertEqual(len(client._fanouts), 2)
+            time.sleep(4.5)
+            frames_sent = client.counters['frames_sent']
+            client.stop_subscribe(sub_id1)
+            # the server operation is still used by the other subscriber
+            self.assertEqual(client.counters['frames_sent'], frames_sent)
+            client.stop_subscribe(sub_id2)
+            client.stop_subscribe(other_id)
+
+        self.assertEqual(set(received), {sub_id1, sub_id2, other_id})
+        for op_id, datas in received.items():
+            self.assertEqual([data['type'] for data in datas], [GQL_DATA] * 3 + [GQL_COMPLETE])
+            for data in datas:
+                self.assertEqual(data['id'], op_id)
+
+    def test_shared_subscription_replay_order(self):
+        with GraphQLClient('ws://localhost:9001', share_subscriptions=True) as client:
+            first = client.subscribe(subscription, variables={'userId': 2},
+                                     callback=lambda op_id, data: None)
+            time.sleep(0.2)
+            deliver = client._deliver
+            order = []
+
+            def slow_deliver(handle, callback, msg):
+                if handle == first:
+                    return deliver(handle, callback, msg)
+                if threading.current_thread() is threading.main_thread():
+                    # the replay to the new subscriber, while the next message arrives
+                    time.sleep(0.7)
+                    order.append('replay')
+                else:
+                    order.append(msg['type'])
+                return deliver(handle, callback, msg)
+
+            client._deliver = slow_deliver
+            second = client.subscribe(subscription, variables={'userId': 2},
+                                      callback=lambda op_id, data: None)
+            time.sleep(1.5)
+            client.stop_subscribe(first)
+            client.stop_subscribe(second)
+
+        self.assertEqual(order, ['replay', GQL_DATA, GQL_DATA, GQL_COMPLETE])
+
+    def test_callback_subscription_keeps_no_buffer(self):
+        sub_id = self.client.subscribe(subscription, variables={'userId': 2},
+                                       callback=lambda op_id, data: None)
+        self.assertNotIn(sub_id, self.client._subscriber_queues)
+        self.client.stop_subscribe(sub_id)
+
     # TODO: one more testcase with multiple queries and multiple subscriptions mixed
 
     def tearDown(self):
@@ -229,5 +718,788 @@ class TestClient(unittest.TestCase):
         self.ws_server.stop_server()
 
 
+class TestOperationBuffer(unittest.TestCase):
+
+    @staticmethod
+    def _fill(buf, count):
+        for i in range(count):
+            buf.put({'type': GQL_DATA, 'payload': i})
+        buf.put({'type': GQL_COMPLETE})
+        return [msg.get('payload') for msg in list(buf.queue)]
+
+    def test_drop_oldest(self):
+        buf = OperationBuffer(2, OVERFLOW_DROP_OLDEST)
+        self.assertEqual(self._fill(buf, 4), [2, 3, None])
+        self.assertEqual(buf.dropped, 2)
+
+    def test_drop_newest(self):
+        buf = OperationBuffer(2, OVERFLOW_DROP_NEWEST)
+        self.assertEqual(self._fill(buf, 4), [0, 1, None])
+        self.assertEqual(buf.dropped, 2)
+
+    def test_latest(self):
+        buf = OperationBuffer(2, OVERFLOW_LATEST)
+        # a full buffer collapses to the newest message
+        self.assertEqual(self._fill(buf, 4), [2, 3, None])
+        self.assertEqual(buf.dropped, 2)
+
+    def test_block(self):
+        buf = OperationBuffer(1, OVERFLOW_BLOCK)
+        buf.put({'type': GQL_DATA, 'payload': 0})
+        producer = threading.Thread(target=buf.put, args=({'type': GQL_DATA, 'payload': 1},))
+        producer.start()
+        producer.join(timeout=0.2)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(buf.get()['payload'], 0)
+        producer.join(timeout=1)
+        self.assertEqual(buf.get(timeout=1)['payload'], 1)
+
+    def test_close(self):
+        buf = OperationBuffer(1, OVERFLOW_BLOCK)
+        buf.put({'type': GQL_DATA, 'payload': 0})
+        producer = threading.Thread(target=buf.put, args=({'type': GQL_DATA, 'payload': 1},))
+        producer.start()
+        producer.join(timeout=0.2)
+        self.assertTrue(producer.is_alive())
+        # the consumer leaves: the producer is released, and what follows is discarded
+        buf.close()
+        producer.join(timeout=1)
+        self.assertFalse(producer.is_alive())
+        buf.put({'type': GQL_COMPLETE})
+        self.assertEqual([msg['payload'] for msg in buf.get_many()], [0])
+
+    def test_get_timeout(self):
+        buf = OperationBuffer()
+        self.assertRaises(queue.Empty, buf.get, timeout=0.01)
+
+    def test_get_many(self):
+        buf = OperationBuffer()
+        for i in range(5):
+            buf.put({'type': GQL_DATA, 'payload': i})
+        self.assertEqual([msg['payload'] for msg in buf.get_many(3)], [0, 1, 2])
+
+        # a batch which isn't full waits for `max_wait`, unless it is over
+        started = time.monotonic()
+        self.assertEqual(len(buf.get_many(3, max_wait=0.2)), 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        threading.Timer(0.05, buf.put, args=({'type': GQL_COMPLETE},)).start()
+        self.assertEqual(buf.get_many(3, max_wait=5), [{'type': GQL_COMPLETE}])
+        self.assertRaises(queue.Empty, buf.get_many, timeout=0.01)
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_codecs_roundtrip(self):
+        frame = {'id': '1', 'type': GQL_DATA, 'payload': {'data': {'msg': 'héllo'}}}
+        for name in ['json', 'orjson', 'msgspec', 'ujson']:
+            try:
+                codec = get_codec(name)
+            except ImportError:
+                continue
+            encoded = codec.encode(frame)
+            self.assertEqual(codec.decode(encoded), frame)
+            if isinstance(encoded, str):
+                encoded = encoded.encode('utf-8')
+            self.assertEqual(codec.decode(encoded), frame)
+            self.assertRaises(codec.DecodeError, codec.decode, b'{not json')
+
+    @unittest.skipUnless(importlib.util.find_spec('msgspec'), 'needs msgspec')
+    def test_lazy_payloads(self):
+        server = ApolloProtocolServer()
+        server.start_server()
+        payloads = []
+        try:
+            with GraphQLClient('ws://localhost:9001', codec='msgspec', lazy_payloads=True) as client:
+                sub_id = client.subscribe(subscription, variables={'userId': 2},
+                                          callback=lambda op_id, msg: payloads.append(msg.get('payload')))
+                res = client.query(query, variables={'userId': 2})
+                client.stop_subscribe(sub_id)
+        finally:
+            server.stop_server()
+
+        self.assertIsInstance(res['payload'], dict)
+        self.assertTrue(payloads)
+        for payload in payloads[:-1]:
+            self.assertIsInstance(payload, LazyPayload)
+            self.assertFalse(payload.is_decoded)
+            self.assertEqual(json.loads(payload.raw), {'data': {'msg': 'hello world'}})
+            self.assertEqual(payload['data']['msg'], 'hello world')
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, get_codec, 'yaml')
+
+    def test_query_with_stdlib_codec(self):
+        server = ApolloProtocolServer()
+        server.start_server()
+        try:
+            with GraphQLClient('ws://localhost:9001', codec='json') as client:
+                res = client.query(query, variables={'userId': 2})
+            self.assertEqual(res['type'], GQL_DATA)
+        finally:
+            server.stop_server()
+
+
+class TestReconnectPolicy(unittest.TestCase):
+
+    def test_backoff(self):
+        policy = ReconnectPolicy(initial_delay=1, max_delay=5, multiplier=2, jitter=0.5,
+                                 max_attempts=3)
+        for attempt, full_delay in enumerate([1, 2, 4, 5, 5]):
+            delay = policy.delay(attempt)
+            self.assertGreaterEqual(delay, full_delay / 2)
+            self.assertLessEqual(delay, full_delay)
+        self.assertTrue(policy.should_retry(2))
+        self.assertFalse(policy.should_retry(3))
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=5)
+        self.assertEqual(bucket.take(8), 5)
+        self.assertEqual(bucket.take(8), 0)
+        self.assertGreater(bucket.wait_time(), 0)
+        time.sleep(0.25)
+        self.assertIn(bucket.take(8), (2, 3))
+        self.assertEqual(TokenBucket(rate=None).take(1000), 1000)
+
+
+class TestBatcher(unittest.TestCase):
+
+    def test_batches(self):
+        batches = []
+        def flush(items):
+            batches.append(items)
+            return [ValueError(item) if item == 3 else item * 2 for item in items]
+
+        batcher = Batcher(flush, window=0.2, max_size=4)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            futures = list(executor.map(batcher.submit, range(10)))
+
+        for i, future in enumerate(futures):
+            if i == 3:
+                self.assertRaises(ValueError, future.result, timeout=5)
+            else:
+                self.assertEqual(future.result(timeout=5), i * 2)
+        self.assertEqual(sorted(sum(batches, [])), list(range(10)))
+        self.assertLess(len(batches), 10)
+        for batch in batches:
+            self.assertLessEqual(len(batch), 4)
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize_query('query {\n  a,  b # comment\n  c(s: "x  y")\n}'),
+                         'query { a b c(s: "x  y") }')
+        self.assertTrue(is_mutation('# comment\n  mutation { a }'))
+        self.assertFalse(is_mutation('query { mutation }'))
+
+    def test_key(self):
+        cache = QueryCache(vary_headers=['Authorization'])
+        self.assertEqual(cache.key('{ a }', {'x': 1, 'y': 2}, {'Authorization': 't', 'X-Id': 1}),
+                         cache.key('{  a }', {'y': 2, 'x': 1}, {'authorization': 't', 'X-Id': 2}))
+        self.assertNotEqual(cache.key('{ a }', None, {'Authorization': 't'}),
+                            cache.key('{ a }', None, {'Authorization': 'u'}))
+        self.assertNotEqual(cache.key('query A { a } query B { b }', operation_name='A'),
+                            cache.key('query A { a } query B { b }', operation_name='B'))
+
+    def test_lru_and_ttl(self):
+        cache = QueryCache(max_size=2, ttl=0.2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        time.sleep(0.3)
+        self.assertIsNone(cache.get('a'))
+
+    def test_invalidate(self):
+        cache = QueryCache()
+        for user_id in range(3):
+            cache.put(cache.key('{ a }', {'id': user_id}), user_id)
+        cache.put(cache.key('{ b }'), 'b')
+        self.assertEqual(cache.invalidate('{ a }', {'id': 0}), 1)
+        self.assertEqual(cache.invalidate('{ a }'), 2)
+        self.assertEqual(cache.get(cache.key('{ b }')), 'b')
+        self.assertEqual(cache.invalidate(), 1)
+
+    def test_single_flight(self):
+        cache = QueryCache()
+        loads = []
+        def load():
+            loads.append(1)
+            time.sleep(0.2)
+            return {'type': GQL_DATA}
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda _: cache.get_or_load('k', load), range(5)))
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, [{'type': GQL_DATA}] * 5)
+
+
+class TestEntityStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = EntityStore()
+        self.data = {'posts': [
+            {'__typename': 'Post', 'id': 1, 'title': 'a',
+             'author': {'__typename': 'User', 'id': 7, 'name': 'ann'}},
+            {'__typename': 'Post', 'id': 2, 'title': 'b',
+             'author': {'__typename': 'User', 'id': 7, 'name': 'ann'}},
+        ], 'total': {'count': 2}}
+        self.store.write_query('{ posts { id } }', None, None, self.data)
+
+    def test_read(self):
+        self.assertEqual(self.store.read_query('{ posts  { id } }'), self.data)
+        self.assertIsNone(self.store.read_query('{ posts { id } }', {'first': 1}))
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.entity('Post', 1)['author'], {'__ref': 'User:7'})
+
+    def test_merge(self):
+        # a subscription message updating the author of both posts
+        self.store.merge({'userChanged': {'__typename': 'User', 'id': 7, 'name': 'bob'}})
+        data = self.store.read_query('{ posts { id } }')
+        self.assertEqual([post['author']['name'] for post in data['posts']], ['bob', 'bob'])
+        self.assertEqual(data['posts'][0]['title'], 'a')
+
+    def test_missing(self):
+        self.store.evict('User', 7)
+        self.assertIsNone(self.store.read_query('{ posts { id } }'))
+        self.store.write_query('{ posts { id } }', None, None, self.data)
+        self.store.merge({'__typename': 'Post', 'id': 1, 'author': None})
+        self.assertIsNone(self.store.read_query('{ posts { id } }')['posts'][0]['author'])
+
+
+class TestPreparedOperation(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_operations(query), [('query', 'getUser')])
+        self.assertEqual(parse_operations('{ a } mutation M($x: Int = 1) @live { b(x: $x) }'
+                                          ' fragment F on T { c }'),
+                         [('query', None), ('mutation', 'M')])
+
+    def test_syntax_errors(self):
+        for document, line, column in [('query {\n  user { id }', 1, 7),
+                                       ('{ user(name: "x) }', 1, 14),
+                                       ('query getUser', 1, 14),
+                                       ('{\n  }', 2, 3),
+                                       ('{ a }\nfoo { b }', 2, 1),
+                                       ('{ a ; }', 1, 5)]:
+            with self.assertRaises(GraphQLSyntaxError) as ctx:
+                parse_operations(document)
+            self.assertEqual((ctx.exception.line, ctx.exception.column), (line, column), document)
+
+    def test_frames(self):
+        document = 'query A { a }\nquery B($id: Int) { b(id: $id) }'
+        self.assertRaises(ValueError, PreparedOperation, document, get_codec('json'))
+        for codec in ('json', 'orjson'):
+            prepared = PreparedOperation(document, get_codec(codec), 'B')
+            self.assertEqual(prepared.operation_type, 'query')
+            payload = prepared.payload({'id': 1}, {'token': 'x'})
+            self.assertEqual(payload['operationName'], 'B')
+            self.assertEqual(json.loads(prepared.start_frame('abc', {'id': 1}, {'token': 'x'})),
+                             {'id': 'abc', 'type': GQL_START, 'payload': payload})
+            del payload['headers']
+            self.assertEqual(json.loads(prepared.http_body({'id': 1})), payload)
+
+
+class TestCallbackDispatcher(unittest.TestCase):
+
+    def test_ordering_per_operation(self):
+        calls = {'a': [], 'b': []}
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            dispatcher = CallbackDispatcher(executor, max_batch=2)
+            for i in range(50):
+                dispatcher.dispatch('a', calls['a'].append, i)
+                dispatcher.dispatch('b', calls['b'].append, i)
+            while dispatcher.pending():
+                time.sleep(0.01)
+        self.assertEqual(calls['a'], list(range(50)))
+        self.assertEqual(calls['b'], list(range(50)))
+
+
+class TestReactor(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ws_server = ApolloProtocolServer()
+
+    def setUp(self):
+        self.ws_server.start_server()
+        self.reactor = Reactor()
+
+    def test_many_clients(self):
+        clients = [GraphQLClient('ws://localhost:9001', reactor=self.reactor) for _ in range(10)]
+        try:
+            receivers = [t for t in threading.enumerate() if t.name == 'gql-receiver']
+            self.assertEqual(receivers, [])
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                results = list(executor.map(lambda client: client.query(query), clients))
+            self.assertEqual([res['type'] for res in results], [GQL_DATA] * 10)
+
+            msgs = queue.Queue()
+            clients[0].subscribe(subscription, callback=lambda op_id, msg: msgs.put(msg))
+            types = [msgs.get(timeout=5)['type'] for _ in range(4)]
+            self.assertEqual(types, [GQL_DATA] * 3 + [GQL_COMPLETE])
+            self.assertTrue(all(client.is_connected for client in clients))
+        finally:
+            for client in clients:
+                client.close()
+        self.assertFalse(any(client.is_connected for client in clients))
+
+    def test_reconnect(self):
+        policy = ReconnectPolicy(initial_delay=0.1, jitter=0)
+        msgs = []
+        with GraphQLClient('ws://localhost:9001', reactor=self.reactor,
+                           reconnect_policy=policy) as client:
+            sub_id = client.subscribe(subscription, callback=lambda op_id, msg: msgs.append(msg))
+            time.sleep(0.2)
+            self.ws_server.drop_clients()
+            time.sleep(3)
+            res = client.query(query)
+            reconnects = client.counters['reconnects']
+
+        self.assertEqual(reconnects, 1)
+        self.assertEqual(res['type'], GQL_DATA)
+        self.assertEqual({msg['id'] for msg in msgs}, {sub_id})
+        self.assertEqual(msgs[-1]['type'], GQL_COMPLETE)
+
+    def test_nonblocking_socket(self):
+        with GraphQLClient('ws://localhost:9001', reactor=self.reactor) as client:
+            # reads never block the reactor, and large writes wait for room
+            res = client.query(query, variables={'userId': 2, 'padding': 'x' * 4000000})
+            self.assertEqual(res['type'], GQL_DATA)
+            self.assertEqual(client._connection.sock.gettimeout(), 0)
+
+    def test_frame_reader(self):
+        def frame(opcode, payload, fin=True):
+            header = bytes([(0x80 if fin else 0) | opcode])
+            if len(payload) < 126:
+                return header + bytes([len(payload)]) + payload
+            return header + bytes([126]) + len(payload).to_bytes(2, 'big') + payload
+
+        big = b'x' * 1000
+        data = frame(0x1, b'{}') + frame(0x1, big[:500], fin=False) + frame(0x9, b'ping') + \
+            frame(0x0, big[500:]) + frame(0x8, b'')
+        reader = _FrameReader()
+        # fed in small chunks, as they may come from the socket
+        messages = sum((reader.feed(data[i:i + 7]) for i in range(0, len(data), 7)), [])
+        self.assertEqual(messages, [(0x1, b'{}'), (0x9, b'ping'), (0x1, big), (0x8, b'')])
+
+    def tearDown(self):
+        self.reactor.stop(timeout=2)
+        self.ws_server.stop_server()
+
+
+class TestClientPool(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ws_server = ApolloProtocolServer()
+
+    def setUp(self):
+        self.ws_server.start_server()
+        self.pool = GraphQLClientPool('ws://localhost:9001', size=2, max_inflight=1)
+
+    def test_query(self):
+        results = []
+        def run_query():
+            results.append(self.pool.query(query, variables={'userId': 2}))
+
+        threads = [threading.Thread(target=run_query) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        self.assertEqual(len(results), 3)
+        for res in results:
+            self.assertEqual(res['type'], GQL_DATA)
+
+    def test_subscription(self):
+        all_datas = []
+        def my_callback(op_id, data):
+            all_datas.append((op_id, data))
+
+        sub_id = self.pool.subscribe(subscription, variables={'userId': 2}, callback=my_callback)
+        time.sleep(2.5)
+        self.pool.stop_subscribe(sub_id)
+
+        self.assertEqual(all_datas[-1][1]['type'], GQL_COMPLETE)
+        for op_id, _ in all_datas:
+            self.assertEqual(op_id, sub_id)
+
+    def test_replace_dead_connection(self):
+        self.assertRaises(QueryTimeoutException, self.pool.query, '{ noAnswer }', timeout=0.3)
+
+        msgs = []
+        with GraphQLClientPool('ws://localhost:9001', size=1, health_check_interval=0.1) as pool:
+            sub_id = pool.subscribe(subscription, callback=lambda op_id, msg: msgs.append(msg))
+            start_subscription = pool._start_subscription
+            failures = []
+
+            def fail_once(sub_id, sub, conn):
+                # the new connection drops as the subscription moves to it
+                if not failures:
+                    failures.append(sub_id)
+                    raise ConnectionException('Lost the connection to the server')
+                return start_subscription(sub_id, sub, conn)
+
+            pool._start_subscription = fail_once
+            dead = pool._connections[0].client
+            time.sleep(0.2)
+            self.ws_server.drop_clients()
+            time.sleep(3)
+            self.assertTrue(pool._health_thread.is_alive())
+            # the pool replaced the connection, which didn't reconnect on its own
+            self.assertEqual(dead.counters['reconnects'], 0)
+            self.assertEqual(failures, [sub_id])
+
+        self.assertEqual([msg['type'] for msg in msgs][-4:], [GQL_DATA] * 3 + [GQL_COMPLETE])
+
+    def test_no_live_connection(self):
+        with GraphQLClientPool('ws://localhost:9001', size=2,
+                               health_check_interval=60) as pool:
+            self.ws_server.drop_clients()
+            time.sleep(0.5)
+            # the health check hasn't replaced them yet
+            self.assertRaises(ConnectionException, pool.query, query)
+        self.assertRaises(ConnectionException, pool.query, query)
+
+    def test_ended_subscription(self):
+        msgs = []
+        with GraphQLClientPool('ws://localhost:9001', size=1, health_check_interval=0.1) as pool:
+            pool.subscribe(subscription, callback=lambda op_id, msg: msgs.append(msg))
+            time.sleep(2.5)
+            # the server has ended it: it is forgotten, and frees its slot
+            self.assertEqual(pool._subscriptions, {})
+            self.assertEqual(pool._connections[0].inflight, 0)
+            self.ws_server.drop_clients()
+            time.sleep(1)
+            self.assertTrue(pool._connections[0].client.is_connected)
+
+        # not started again on the new connection
+        self.assertEqual([msg['type'] for msg in msgs], [GQL_DATA] * 3 + [GQL_COMPLETE])
+
+    def tearDown(self):
+        self.pool.close()
+        self.ws_server.stop_server()
+
+
+class TestMultiprocessSubscriber(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ws_server = ApolloProtocolServer()
+
+    def setUp(self):
+        self.ws_server.start_server()
+
+    def test_subscribe(self):
+        msgs = queue.Queue()
+        with MultiprocessSubscriber('ws://localhost:9001', processes=2) as subscriber:
+            sub_ids = [subscriber.subscribe(subscription, variables={'userId': 2},
+                                            callback=lambda op_id, msg: msgs.put((op_id, msg)))
+                       for _ in range(3)]
+            self.assertEqual(sorted(len(worker.subscriptions) for worker in subscriber._workers),
+                             [1, 2])
+            subscriber.stop_subscribe(sub_ids[2])
+            received = [msgs.get(timeout=5) for _ in range(8)]
+
+        for sub_id in sub_ids[:2]:
+            types = [msg['type'] for op_id, msg in received if op_id == sub_id]
+            self.assertEqual(types, [GQL_DATA] * 3 + [GQL_COMPLETE])
+        self.assertTrue(all(msg['payload']['data'] for _, msg in received if msg['type'] == GQL_DATA))
+
+    def test_transform(self):
+        msgs = queue.Queue()
+        errors = []
+
+        def callback(op_id, msg):
+            msgs.put(msg)
+            try:
+                subscriber.subscribe(subscription, callback=callback)
+            except RuntimeError as exc:
+                errors.append(exc)
+
+        with MultiprocessSubscriber('ws://localhost:9001', processes=1,
+                                    transform=only_data) as subscriber:
+            sub_id = subscriber.subscribe(subscription, variables={'userId': 2},
+                                          callback=callback)
+            time.sleep(3)
+            # ended by the server, although the transform dropped the complete
+            self.assertEqual(subscriber._subscriptions, {})
+            self.assertEqual(subscriber._workers[0].subscriptions, set())
+        # the callbacks can't subscribe, instead of waiting for themselves
+        self.assertEqual(len(errors), 3)
+        self.assertEqual([msg['type'] for msg in msgs.queue], [GQL_DATA] * 3)
+        self.assertEqual({msg['id'] for msg in msgs.queue}, {sub_id})
+
+    def tearDown(self):
+        self.ws_server.stop_server()
+
+
+class TestAsyncClient(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ws_server = ApolloProtocolServer()
+
+    def setUp(self):
+        self.ws_server.start_server()
+
+    def test_query(self):
+        async def run():
+            async with AsyncGraphQLClient('ws://localhost:9001', close_timeout=0.1) as client:
+                return await client.query(query, variables={'userId': 2})
+
+        res = asyncio.run(run())
+        self.assertEqual(res['type'], GQL_DATA)
+
+    def test_concurrent_queries(self):
+        async def run():
+            async with AsyncGraphQLClient('ws://localhost:9001', close_timeout=0.1) as client:
+                return await asyncio.gather(*[
+                    client.query(query, variables={'userId': i}) for i in range(3)
+                ])
+
+        for res in asyncio.run(run()):
+            self.assertEqual(res['type'], GQL_DATA)
+
+    def test_subscription(self):
+        async def run():
+            async with AsyncGraphQLClient('ws://localhost:9001', close_timeout=0.1) as client:
+                sub = client.subscribe(subscription, variables={'userId': 2})
+                return [msg async for msg in sub], sub.op_id
+
+        msgs, sub_id = asyncio.run(run())
+        self.assertEqual(len(msgs), 3)
+        for msg in msgs:
+            self.assertEqual(msg['id'], sub_id)
+            self.assertEqual(msg['type'], GQL_DATA)
+
+    def test_concurrent_first_use(self):
+        async def run():
+            # not connected upfront: the first queries connect it, once
+            client = AsyncGraphQLClient('ws://localhost:9001', close_timeout=0.1)
+            try:
+                return await asyncio.wait_for(
+                    asyncio.gather(*(client.query(query, timeout=5) for _ in range(3))), 10)
+            finally:
+                await client.close()
+
+        for res in asyncio.run(run()):
+            self.assertEqual(res['type'], GQL_DATA)
+
+    def test_reconnect_after_drop(self):
+        async def run():
+            async with AsyncGraphQLClient('ws://localhost:9001', close_timeout=0.1) as client:
+                await client.query(query, timeout=5)
+                self.ws_server.drop_clients()
+                await asyncio.sleep(0.3)
+                # the next operation connects again
+                return await client.query(query, timeout=5)
+
+        self.assertEqual(asyncio.run(run())['type'], GQL_DATA)
+
+    def test_subscribe_batches(self):
+        async def run():
+            async with AsyncGraphQLClient('ws://localhost:9001', close_timeout=0.1) as client:
+                batches = client.subscribe_batches(subscription, variables={'userId': 2},
+                                                   max_items=2, max_wait=5)
+                return [payloads async for payloads in batches]
+
+        payloads = asyncio.run(run())
+        self.assertEqual([len(batch) for batch in payloads], [2, 1])
+        self.assertEqual(payloads[0][0], {'data': {'msg': 'hello world'}})
+
+    def test_query_timeout(self):
+        async def run():
+            async with AsyncGraphQLClient('ws://localhost:9001', close_timeout=0.1,
+                                          query_timeout=0.3) as client:
+                with self.assertRaises(QueryTimeoutException):
+                    await client.query('{ noAnswer }')
+                self.assertEqual(client._subscriber_queues, {})
+                # another operation is in the middle of a `connection_init`
+                client._connection_init_done = False
+                async with client._init_lock:
+                    started = time.monotonic()
+                    with self.assertRaises(QueryTimeoutException):
+                        await asyncio.wait_for(client.query(query), 5)
+                    self.assertLess(time.monotonic() - started, 1)
+                return await client.query(query, timeout=5)
+
+        self.assertEqual(asyncio.run(run())['type'], GQL_DATA)
+
+    def tearDown(self):
+        self.ws_server.stop_server()
+
+
+class TestHTTPTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [GraphQLHTTPServer(9011), GraphQLHTTPServer(9012)]
+
+    def test_query(self):
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql') as client:
+            for i in range(3):
+                res = client.query(query, variables={'userId': i})
+                self.assertEqual(res['type'], GQL_DATA)
+                self.assertEqual(res['payload']['data']['variables'], {'userId': i})
+            with self.assertRaises(ConnectionException):
+                client.subscribe(subscription, callback=lambda op_id, data: None)
+        # the (gzipped) responses all came over one kept-alive connection
+        self.assertEqual(len(self.servers[0].server.client_ports), 1)
+
+    def test_batching(self):
+        results = {}
+        def run_query(client, i):
+            results[i] = client.query(query, variables={'userId': i})
+
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql',
+                           batch_window=0.2, batch_size=4) as client:
+            threads = [threading.Thread(target=run_query, args=(client, i)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+
+        self.assertEqual(sorted(results), list(range(8)))
+        for i, res in results.items():
+            self.assertEqual(res['type'], GQL_DATA)
+            self.assertEqual(res['payload']['data']['variables'], {'userId': i})
+        self.assertLess(self.servers[0].server.requests, 8)
+
+    def test_cache(self):
+        mutation = 'mutation { addUser(name: "x") { id } }'
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql',
+                           cache=QueryCache(ttl=60)) as client:
+            for _ in range(3):
+                res = client.query(query, variables={'userId': 2})
+                self.assertEqual(res['payload']['data']['variables'], {'userId': 2})
+            self.assertEqual(self.servers[0].server.requests, 1)
+            client.query(query, variables={'userId': 2}, use_cache=False)
+            client.query(query, variables={'userId': 3})
+            client.query(mutation)
+            client.query(mutation)
+            self.assertEqual(self.servers[0].server.requests, 5)
+            client.cache.invalidate(query)
+            client.query(query, variables={'userId': 2})
+            self.assertEqual(self.servers[0].server.requests, 6)
+
+    def test_dropped_connections(self):
+        server = self.servers[0].server
+        with HTTPTransport('http://localhost:9011/graphql') as transport:
+            transport.post({'query': '{ closeConnection }'})
+            time.sleep(0.1)
+            # the idle connection which the server closed is not used
+            self.assertEqual(transport.post({'query': query})['data']['msg'], 'hello world')
+            self.assertEqual(transport._endpoints[0].connections_opened, 2)
+
+            # once it is sent, a request is not sent again: the server may have run it
+            self.assertRaises(HTTPTransportException, transport.post,
+                              {'query': 'mutation { dropConnection }'})
+        self.assertEqual(server.requests, 3)
+
+    def test_cache_prepared_operations(self):
+        document = 'query A { a } query B { b }'
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql',
+                           cache=QueryCache(ttl=60), store=EntityStore()) as client:
+            operation_a = client.prepare(document, 'A')
+            operation_b = client.prepare(document, 'B')
+            for _ in range(2):
+                client.query(operation_a)
+                client.query(operation_b)
+            # each operation is cached on its own
+            self.assertEqual(self.servers[0].server.requests, 2)
+
+    def test_store(self):
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql',
+                           store=EntityStore()) as client:
+            first = client.query(query, variables={'userId': 2})
+            self.assertEqual(client.query(query, variables={'userId': 2}), first)
+            self.assertEqual(self.servers[0].server.requests, 1)
+            client.query(query, variables={'userId': 2}, use_cache=False)
+            self.assertEqual(self.servers[0].server.requests, 2)
+
+    def test_persisted_queries(self):
+        server = self.servers[0].server
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql',
+                           persisted_queries=True) as client:
+            for _ in range(2):
+                res = client.query(query, variables={'userId': 2})
+                self.assertEqual(res['payload']['data']['variables'], {'userId': 2})
+            # registered with the first query, only the hash afterwards
+            self.assertIn('query', server.bodies[0])
+            self.assertNotIn('query', server.bodies[1])
+            self.assertEqual(server.bodies[1]['extensions']['persistedQuery']['sha256Hash'],
+                             hashlib.sha256(query.encode()).hexdigest())
+            # the server forgot it
+            server.persisted_queries.clear()
+            res = client.query(query, variables={'userId': 2})
+            self.assertEqual(res['payload']['data']['variables'], {'userId': 2})
+            self.assertEqual(['query' in body for body in server.bodies[2:]], [False, True])
+
+    def test_prepared(self):
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql') as client:
+            get_user = client.prepare(query)
+            res = client.query(get_user, variables={'userId': 2})
+            self.assertEqual(res['payload']['data']['variables'], {'userId': 2})
+        self.assertEqual(self.servers[0].server.bodies,
+                         [{'query': get_user.document, 'variables': {'userId': 2}}])
+
+    def test_timeout(self):
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql') as client:
+            started = time.monotonic()
+            self.assertRaises(QueryTimeoutException, client.query, '{ noAnswer }', timeout=0.2)
+            self.assertLess(time.monotonic() - started, 0.9)
+            self.assertEqual(client.query(query)['type'], GQL_DATA)
+
+        # the caller sending a batch is bound by the earliest deadline in it
+        with GraphQLClient(None, http_url='http://localhost:9011/graphql',
+                           batch_window=0.05) as client:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                started = time.monotonic()
+                futures = [executor.submit(client.query, '{ noAnswer }', timeout=timeout)
+                           for timeout in (0.2, 5)]
+                for future in futures:
+                    self.assertRaises(QueryTimeoutException, future.result)
+                self.assertLess(time.monotonic() - started, 0.9)
+
+    def test_round_robin(self):
+        urls = ['http://localhost:9011/graphql', 'http://localhost:9012/graphql']
+        with HTTPTransport(urls) as transport:
+            ports = [transport.post({'query': query})['data']['port'] for _ in range(4)]
+        self.assertEqual(sorted(ports), [9011, 9011, 9012, 9012])
+
+    def test_failover(self):
+        # nothing listens on the first url
+        urls = ['http://localhost:9013/graphql', 'http://localhost:9011/graphql']
+        with HTTPTransport(urls) as transport:
+            for _ in range(2):
+                self.assertEqual(transport.post({'query': query})['data']['port'], 9011)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_run(self):
+        with BenchmarkServer(9102) as server:
+            results = benchmark_cases.query_latency(server, quick=True)
+        self.assertEqual(sorted(results['query_latency']), ['mean_ms', 'p50_ms', 'p90_ms', 'p99_ms'])
+
+    def test_compare(self):
+        baseline = make_run({'query': {'p50_ms': 1.0, 'queries_per_s': 1000},
+                             'memory': {'growth_kib': 10}})
+        current = make_run({'query': {'p50_ms': 1.05, 'queries_per_s': 800},
+                            'memory': {'growth_kib': 40}})
+        rows = compare_runs(baseline, current, threshold=0.1)
+        regressed = {(name, metric): regressed for name, metric, *_, regressed in rows}
+        # slower by 5% is within the threshold, and 30 KiB is noise
+        self.assertEqual(regressed, {('query', 'p50_ms'): False, ('query', 'queries_per_s'): True,
+                                     ('memory', 'growth_kib'): False})
+
 if __name__ == '__main__':
     unittest.main()